@@ -0,0 +1,308 @@
+"""Benchmark the scripts offline, against a local stand-in for the Wikimedia APIs.
+
+Each script is run on synthetic categories of the given sizes, served by stand_in.py, and the
+files processed per second, the requests made per file and the peak memory are reported. Every
+run takes place in a fresh process, so that its peak memory is measured on its own, with all of
+its http(s) requests routed to the stand-in.
+
+The results are saved, together with the commit and settings they were measured at. Pass an
+earlier results file as --baseline to flag any regressions against it.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta, timezone
+from urllib.parse import urlsplit
+
+from requests.adapters import BaseAdapter
+
+from stand_in import TREE_DEPTH, StandInServer, write_mediacounts
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+SCRIPTS = ('mediaviews', 'mediaviews_dumps', 'wp_captions', 'deriv_detector', 'file_count',
+           'diff_stats', 'category_tree')
+DEFAULT_SIZES = (1000, 10000)
+DEFAULT_OUTPUT = 'benchmark_results.json'
+DEFAULT_TOLERANCE = 0.1
+DUMP_DAYS = 31  # days of mediacounts dumps read by the mediaviews_dumps benchmark
+
+
+class StandInAdapter(BaseAdapter):
+    """Transport adapter sending every request to the stand-in, with the host in the path.
+
+    The requests are made through the wrapped adapter, keeping its pooling and retries.
+    """
+
+    def __init__(self, adapter: BaseAdapter, stand_in_url: str):
+        super().__init__()
+        self.adapter = adapter
+        self.stand_in_url = stand_in_url
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        request.url = f'{self.stand_in_url}/{url.netloc}{url.path}'
+        if url.query:
+            request.url += f'?{url.query}'
+        return self.adapter.send(request, **kwargs)
+
+    def close(self):
+        self.adapter.close()
+
+
+def route_to_stand_in(stand_in_url: str) -> None:
+    """Make all sessions from http_client.make_session() use the stand-in."""
+    from common import http_client
+
+    make_session = http_client.make_session
+
+    def make_stand_in_session(*args, **kwargs):
+        s = make_session(*args, **kwargs)
+        adapter = StandInAdapter(s.get_adapter('https://'), stand_in_url)
+        s.mount('https://', adapter)
+        s.mount('http://', adapter)
+        return s
+
+    http_client.make_session = make_stand_in_session
+
+
+def import_script(directory: str, module: str):
+    """Import the module of a script the way it is run, i.e. with its directory on the path."""
+    sys.path.insert(0, os.path.join(ROOT, directory))
+    return __import__(module)
+
+
+def run_mediaviews(category: str, size: int, args: argparse.Namespace) -> None:
+    get_media_views = import_script('mediaviews', 'get_media_views')
+    stats = get_media_views.get_cat_media_views(
+        category, '20220101', '20231231', output_type='summary', workers=args.workers,
+        rate=args.rate)
+    get_media_views.output_result(stats, 'stats_output.json')
+
+
+def prepare_mediaviews_dumps(size: int) -> str:
+    """Write synthetic mediacounts dumps of January 2023, outside of the measured time."""
+    os.makedirs('dumps')
+    for n in range(DUMP_DAYS):
+        day = date(2023, 1, 1) + timedelta(days=n)
+        write_mediacounts(f'dumps/mediacounts.{day.isoformat()}.v00.tsv.bz2', day, size)
+    return 'dumps'
+
+
+def run_mediaviews_dumps(dump_dir: str, size: int, args: argparse.Namespace) -> None:
+    get_media_views = import_script('mediaviews', 'get_media_views')
+    end = (date(2023, 1, 1) + timedelta(days=DUMP_DAYS - 1)).strftime('%Y%m%d')
+    stats = get_media_views.get_cat_media_views(
+        f'Category:Benchmark {size}', '20230101', end, output_type='summary',
+        workers=args.workers, rate=args.rate, dump_dir=dump_dir)
+    get_media_views.output_result(stats, 'stats_output.json')
+
+
+def run_wp_captions(category: str, size: int, args: argparse.Namespace) -> None:
+    get_caption = import_script('wp_captions', 'get_caption')
+    captions, _, _ = get_caption.get_category_captions(
+        category, retrieve_gallery=True, workers=args.workers, host_rate=args.rate)
+    get_caption.output_result(captions, 'caption_output.json')
+
+
+def run_deriv_detector(category: str, size: int, args: argparse.Namespace) -> None:
+    deriv_detector = import_script('deriv_detector', 'deriv_detector')
+    deriv_detector.output_graph(category, deriv_detector.build_derivative_graph(category))
+
+
+def run_file_count(category: str, size: int, args: argparse.Namespace) -> None:
+    files_by_month = import_script('file_count', 'files_by_month')
+    periods, mark = files_by_month.count_new_files(category)
+    files_by_month.output_results(category, periods, mark=mark)
+
+
+def prepare_diff_stats(size: int) -> str:
+    """Write a synthetic commons-diff output, outside of the measured time."""
+    benchmark_stream = import_script('diff_stats', 'benchmark_stream')
+    path = f'diff_{size}.json'
+    benchmark_stream.write_synthetic(path, size)
+    return path
+
+
+def run_diff_stats(path: str, size: int, args: argparse.Namespace) -> None:
+    get_diff_stats = import_script('diff_stats', 'get_diff_stats')
+    get_diff_stats.process_output(path)
+
+
+def prepare_category_tree(size: int) -> str:
+    return f'Category:Benchmark {size} tree'
+
+
+def run_category_tree(category: str, size: int, args: argparse.Namespace) -> None:
+    """Walk a cyclic tree of subcategories for its files, as the scripts do with --recurse."""
+    from common import action_api, http_client
+
+    s = http_client.make_session({}, pool_maxsize=max(args.workers, 1) * 2)
+    tree = dict(action_api.category_tree(
+        s, category, depth=TREE_DEPTH + 1, workers=args.workers))
+    files = action_api.category_files(
+        s, category, prop_params={'prop': 'imageinfo', 'iiprop': 'url'},
+        recurse=TREE_DEPTH + 1, categories=tree, workers=args.workers)
+    print(f'{sum(1 for _ in files)} of {sum(tree.values())} files in {len(tree)} categories.')
+
+
+def run(script: str, size: int, args: argparse.Namespace) -> None:
+    """Run a script on a category of the given size and print the time taken and peak memory."""
+    sys.path.insert(0, ROOT)
+    route_to_stand_in(args.stand_in)
+    target = f'Category:Benchmark {size}'
+    if f'prepare_{script}' in globals():
+        target = globals()[f'prepare_{script}'](size)
+    start = time.perf_counter()
+    globals()[f'run_{script}'](target, size, args)
+    print(json.dumps({
+        'seconds': time.perf_counter() - start,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))
+
+
+def measure(script: str, size: int, server: StandInServer, args: argparse.Namespace) -> dict:
+    """Run a single benchmark in a fresh process and in a temporary directory."""
+    server.counts.clear()
+    env = {**os.environ, 'TQDM_DISABLE': '1'}
+    env.setdefault('PYWIKIBOT_NO_USER_CONFIG', '2')
+    command = [
+        sys.executable, os.path.abspath(__file__), '--run', script, str(size),
+        '--stand_in', server.url, '--workers', str(args.workers)]
+    if args.rate:
+        command += ['--rate', str(args.rate)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        process = subprocess.run(
+            command, cwd=tmp_dir, env=env, capture_output=True, text=True)
+    if process.returncode:
+        sys.stderr.write(process.stderr[-2000:])
+        raise RuntimeError(f'{script} failed on {size} files')
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+    requests = server.counts['action'] + server.counts['rest']
+    return {
+        'script': script,
+        'files': size,
+        'seconds': round(result['seconds'], 3),
+        'files_per_sec': round(size / result['seconds'], 1),
+        'requests': requests,
+        'requests_per_file': round(requests / size, 4),
+        'refused': server.counts['refused'],
+        'peak_rss_mb': round(result['peak_rss_kb'] / 1024, 1)
+    }
+
+
+def compare(results: list, baseline: dict, tolerance: float) -> list:
+    """Return a description of each result which is worse than in the baseline."""
+    previous = {(result['script'], result['files']): result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        before = previous.get((result['script'], result['files']))
+        if not before:
+            continue
+        checks = (
+            ('files_per_sec', result['files_per_sec'] < before['files_per_sec'] * (1 - tolerance)),
+            ('requests_per_file',
+             result['requests_per_file'] > before['requests_per_file'] * (1 + tolerance)),
+            ('peak_rss_mb', result['peak_rss_mb'] > before['peak_rss_mb'] * (1 + tolerance)))
+        for key, worse in checks:
+            if worse:
+                regressions.append(
+                    f'{result["script"]} on {result["files"]} files: {key} went from '
+                    f'{before[key]} to {result[key]}')
+    return regressions
+
+
+def get_commit() -> str:
+    """Return the commit of the working tree, if it is a git checkout."""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+            check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def make_meta(args: argparse.Namespace) -> dict:
+    """Output metadata about the run."""
+    return {
+        'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'commit': get_commit(),
+        'python': platform.python_version(),
+        'latency_ms': args.latency,
+        'error_rate': args.error_rate,
+        'workers': args.workers,
+        'rate': args.rate
+    }
+
+
+def handle_args(argv: list = None) -> argparse.Namespace:
+    """
+    Parse and handle command line arguments.
+
+    @param argv: arguments to parse. Defaults to sys.argv[1:].
+    """
+    parser = argparse.ArgumentParser(description=__doc__.partition('\n')[0])
+    parser.add_argument('-s', '--scripts', nargs='+', choices=SCRIPTS, default=SCRIPTS,
+                        help='scripts to benchmark. Defaults to all of them')
+    parser.add_argument('-n', '--sizes', nargs='+', type=int, default=DEFAULT_SIZES,
+                        metavar='N', help=('numbers of files in the synthetic categories. '
+                                           'Defaults to 1000 and 10000'))
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='milliseconds the stand-in delays each response. Defaults to 0')
+    parser.add_argument('--error_rate', type=float, default=0.0,
+                        help=('fraction of requests the stand-in refuses with maxlag/429. '
+                              'Defaults to 0'))
+    parser.add_argument('-w', '--workers', type=int, default=8,
+                        help='concurrent requests for the scripts which support it')
+    parser.add_argument('--rate', type=float,
+                        help='maximum requests per second per host. Defaults to unlimited')
+    parser.add_argument('-o', '--output', default=DEFAULT_OUTPUT,
+                        help=f'file to save the results to. Defaults to {DEFAULT_OUTPUT}')
+    parser.add_argument('-b', '--baseline',
+                        help='earlier results file to check for regressions against')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='relative change regarded as a regression. Defaults to 0.1')
+    parser.add_argument('--run', nargs=2, metavar=('SCRIPT', 'SIZE'), help=argparse.SUPPRESS)
+    parser.add_argument('--stand_in', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main() -> None:
+    """Command line entrypoint."""
+    args = handle_args()
+    if args.run:
+        run(args.run[0], int(args.run[1]), args)
+        return
+
+    server = StandInServer(latency=args.latency / 1000, error_rate=args.error_rate).start()
+    columns = ('script', 'files', 'seconds', 'files_per_sec', 'requests_per_file', 'refused',
+               'peak_rss_mb')
+    print('\t'.join(columns))
+    results = []
+    for script in args.scripts:
+        for size in args.sizes:
+            result = measure(script, size, server, args)
+            results.append(result)
+            print('\t'.join(str(result[column]) for column in columns))
+    server.shutdown()
+
+    with open(args.output, 'w', encoding='utf8') as fp:
+        json.dump({'meta': make_meta(args), 'results': results}, fp, indent=2)
+    print(f'Results saved to {args.output}')
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf8') as fp:
+            regressions = compare(results, json.load(fp), args.tolerance)
+        for regression in regressions:
+            print(f'Regression: {regression}')
+        if regressions:
+            sys.exit(1)
+        print('No regressions against the baseline.')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,568 @@
+"""Local stand-in for the Wikimedia APIs used by the scripts.
+
+Serves synthetic categories of any size without storing them: Category:Benchmark N contains the
+files File:Benchmark 0.jpg to File:Benchmark N-1.jpg, and everything else about a file (its
+uploads, global usage, derivatives, redirects and media requests) is derived from its number.
+Category:Benchmark N tree spreads the same files over a tree of subcategories, see tree_files().
+
+Requests are routed by the host of the original url, which is expected as the first part of the
+path, i.e. https://commons.wikimedia.org/w/api.php is served at
+http://<stand-in>/commons.wikimedia.org/w/api.php. The following endpoints are supported:
+
+* Action API (any host): sitematrix, the categoryinfo, imageinfo, globalusage, info, linkshere
+  and redirects prop modules, list=categorymembers and generator=categorymembers, as well as titles
+  and pageids queries. Prop and generator continuation follows that of MediaWiki.
+* REST-API (wikimedia.org): metrics/mediarequests/per-file.
+* REST-API (wiki hosts): page/media-list and page/html, with ETags.
+
+The daily mediacounts dumps matching the daily media requests can be written by
+write_mediacounts().
+
+Every response can be delayed by a fixed latency, and a fraction of the requests can be refused
+with a maxlag error (Action API) or a 429 response (REST-API).
+"""
+import argparse
+import bz2
+import json
+import random
+import re
+import threading
+import time
+import zlib
+from collections import Counter
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+BATCH_LIMIT = 500  # generator and list limit for 'max'
+PROP_LIMIT = 500  # prop values per response, across the pages of a batch
+WIKIS = ('sv.wikipedia.org', 'en.wikipedia.org', 'fi.wikipedia.org')
+FILES_PER_PAGE = 10  # roughly, for the pages using the files of a category
+CATEGORY = re.compile(r'Category:Benchmark (\d+)$')
+TREE = re.compile(r'Category:Benchmark (\d+) tree((?:/\d)*)$')
+TREE_BRANCHES = 3  # subcategories per category of a tree
+TREE_DEPTH = 3  # levels of subcategories below the root of a tree
+TREE_SHARED = 10  # files also directly in the root of a tree
+FILE = re.compile(r'File:Benchmark (\d+)( \(cropped\))?( \(retouched\))?( \(old name\))?\.jpg$')
+PAGE = re.compile(r'Benchmark (\d+) article (\d+)$')
+FILE_PATH = re.compile(r'/wikipedia/commons/[0-9a-f]/[0-9a-f]{2}/Benchmark_(\d+)\.jpg$')
+ADDED = datetime(2023, 1, 1)  # when file 0 was added to the categories, one file per second
+TOUCHED = '2023-01-01T00:00:00Z'  # when every page was last touched
+
+
+def file_title(i: int, suffix: str = '') -> str:
+    return f'File:Benchmark {i}{suffix}.jpg'
+
+
+def category_size(title: str) -> int:
+    """Return the number of files in a benchmark category, 0 for any other category."""
+    match = CATEGORY.match(title or '')
+    return int(match.group(1)) if match else 0
+
+
+def tree_nodes() -> list[str]:
+    """Return the path of each category of a tree, breadth first, '' being the root."""
+    nodes = ['']
+    for node in nodes:
+        if len(node) < TREE_DEPTH:
+            nodes.extend(node + str(branch) for branch in range(TREE_BRANCHES))
+    return nodes
+
+
+TREE_NODES = tree_nodes()
+
+
+def tree_node(title: str) -> tuple[int, str]:
+    """Return the size of the tree of a category and its path in it, or None."""
+    match = TREE.match(title or '')
+    if not match:
+        return None
+    path = match.group(2).replace('/', '')
+    if len(path) > TREE_DEPTH or any(int(branch) >= TREE_BRANCHES for branch in path):
+        return None
+    return int(match.group(1)), path
+
+
+def tree_title(size: int, path: str) -> str:
+    return f'Category:Benchmark {size} tree' + ''.join(f'/{branch}' for branch in path)
+
+
+def tree_files(size: int, path: str) -> list:
+    """Return the numbers of the files directly in a category of a tree.
+
+    The files of the benchmark category of the same size are dealt out over the categories of
+    the tree, while the first TREE_SHARED files are also in the root. The deepest categories
+    have the root as their only subcategory, making the tree cyclic.
+    """
+    files = range(TREE_NODES.index(path), size, len(TREE_NODES))
+    if path:
+        return files
+    return list(files) + [i for i in range(min(TREE_SHARED, size)) if i % len(TREE_NODES)]
+
+
+def category_files(title: str) -> tuple:
+    """Return the numbers of the files directly in a category and the size of the benchmark."""
+    node = tree_node(title)
+    if node:
+        return tree_files(*node), node[0]
+    size = category_size(title)
+    return range(size), size
+
+
+def subcategories(title: str) -> list:
+    """Return the titles of the subcategories of a category."""
+    node = tree_node(title)
+    if not node:
+        return []
+    size, path = node
+    if len(path) == TREE_DEPTH:
+        return [tree_title(size, '')]
+    return [tree_title(size, path + str(branch)) for branch in range(TREE_BRANCHES)]
+
+
+def page_data(title: str) -> dict:
+    """Return the basic page data of a title."""
+    match = FILE.match(title)
+    if match and not any(match.groups()[1:]):
+        return {'pageid': int(match.group(1)) + 1, 'ns': 6, 'title': title}
+    ns = 14 if title.startswith('Category:') else 6 if title.startswith('File:') else 0
+    return {'pageid': zlib.crc32(title.encode()) + 10 ** 10, 'ns': ns, 'title': title}
+
+
+def uploads(i: int) -> list:
+    """Return the upload timestamps of a file, newest first. Every 10th file was reuploaded."""
+    first = f'2022-{1 + i % 12:02d}-{1 + i % 28:02d}T{i % 24:02d}:00:00Z'
+    return (['2023-06-01T00:00:00Z'] if i % 10 == 0 else []) + [first]
+
+
+def file_url(i: int) -> str:
+    digest = f'{zlib.crc32(str(i).encode()):08x}'
+    return (f'https://upload.wikimedia.org/wikipedia/commons/{digest[0]}/{digest[:2]}/'
+            f'Benchmark_{i}.jpg')
+
+
+def page_count(size: int) -> int:
+    """Return the number of wiki pages using the files of a category."""
+    return max(1, size // (3 * FILES_PER_PAGE))
+
+
+def global_usage(i: int, size: int) -> list:
+    """Return the global usage of a file in a category. Every third file is used on a page."""
+    if i % 3:
+        return []
+    k = (i // 3) % page_count(size)
+    return [{'title': f'Benchmark_{size}_article_{k}', 'wiki': WIKIS[k % len(WIKIS)]}]
+
+
+def page_files(size: int, k: int) -> list:
+    """Return the numbers of the files used on a page, the inverse of global_usage()."""
+    return [3 * j for j in range(k, (size + 2) // 3, page_count(size))]
+
+
+def linking_files(title: str) -> list:
+    """Return the titles of the files linking to a file.
+
+    Every 20th file has a cropped derivative, every 40th derivative has been retouched in turn,
+    and every 50th file links to the next file.
+    """
+    match = FILE.match(title)
+    if not match:
+        return []
+    i = int(match.group(1))
+    cropped, retouched, old_name = match.groups()[1:]
+    if old_name:
+        return [file_title(i, ' (retouched)')]
+    if retouched:
+        return []
+    if cropped:
+        return [file_title(i, ' (cropped) (retouched)')] if i % 40 == 0 else []
+    return ([file_title(i, ' (cropped)')] if i % 20 == 0 else []) + (
+        [file_title(i + 1)] if i % 50 == 0 else [])
+
+
+def redirects(title: str) -> list:
+    """Return the titles of the redirects to a file. Every 100th file has been renamed."""
+    match = FILE.match(title)
+    if not match or any(match.groups()[1:]) or int(match.group(1)) % 100:
+        return []
+    return [file_title(int(match.group(1)), ' (old name)')]
+
+
+def media_requests(i: int, frequency: str, start: str, end: str) -> list:
+    """Return the mediarequests of a file. Every 7th file was never viewed."""
+    if i % 7 == 0:
+        return []
+    day = date(int(start[:4]), int(start[4:6]), int(start[6:8]))
+    last = date(int(end[:4]), int(end[4:6]), int(end[6:8]))
+    if frequency == 'monthly':
+        day = day.replace(day=1)
+    items = []
+    while day <= last:
+        items.append({
+            'referer': 'all-referers', 'file_path': f'/Benchmark_{i}.jpg',
+            'granularity': frequency, 'timestamp': f'{day.strftime("%Y%m%d")}00',
+            'agent': 'user', 'requests': (i + day.toordinal()) % 97})
+        if frequency == 'daily':
+            day += timedelta(days=1)
+        else:
+            day = (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return items
+
+
+def write_mediacounts(path: str, day: date, size: int, others: int = 3) -> None:
+    """Write the mediacounts dump of a day for the files of a category.
+
+    The requests of each file equal its daily media requests, they are interleaved with those
+    of `others` times as many files outside of the category.
+    """
+    padding = '\t'.join(['0'] * 22)  # the remaining columns, split by type of request
+    with bz2.open(path, 'wt', encoding='utf8') as fp:
+        for i in range(size * (others + 1)):
+            if i % (others + 1):
+                file_path = f'/wikipedia/commons/0/00/Other_{size}_{i}.jpg'
+                requests = i % 13
+            else:
+                n = i // (others + 1)
+                file_path = file_url(n).partition('.org')[2]
+                requests = (n + day.toordinal()) % 97 if n % 7 else 0
+            if requests:
+                fp.write(f'{file_path}\t{requests * 51200}\t{requests}\t{padding}\n')
+
+
+def caption(i: int) -> str:
+    """Return the caption of a file on a page. Every second file has none."""
+    return f'Benchmark {i} in use' if i % 2 == 0 else ''
+
+
+def media_list(size: int, k: int) -> dict:
+    """Return the page/media-list response of a page. Every 5th file is in a gallery."""
+    items = []
+    for i in page_files(size, k):
+        item = {'title': file_title(i).replace(' ', '_'), 'type': 'image', 'showInGallery': True}
+        if i % 5 and caption(i):
+            item['caption'] = {'html': caption(i), 'text': caption(i)}
+        items.append(item)
+    return {'revision': '1', 'tid': '1', 'items': items}
+
+
+def page_html(size: int, k: int) -> str:
+    """Return the Parsoid HTML of a page, with figures and a gallery."""
+    parts = [f'<html><head><title>Benchmark {size} article {k}</title></head><body>']
+    gallery = []
+    for i in page_files(size, k):
+        name = f'./File:Benchmark_{i}.jpg'
+        img = (f'<img resource="{name}" src="//upload.wikimedia.org/Benchmark_{i}.jpg" '
+               'class="mw-file-element" width="220" height="150"/>')
+        if i % 5 == 0:
+            gallery.append(
+                f'<li class="gallerybox"><div class="thumb"><span typeof="mw:File">'
+                f'<a href="{name}" class="mw-file-description" title="{caption(i)}">{img}</a>'
+                '</span></div>'
+                f'<div class="gallerytext">{caption(i)}</div></li>')
+        elif caption(i):
+            parts.append(
+                f'<p>Paragraph on file {i}.</p><figure typeof="mw:File/Thumb"><a href="{name}" '
+                f'class="mw-file-description">{img}</a><figcaption>{caption(i)}</figcaption>'
+                '</figure>')
+        else:
+            parts.append(
+                f'<p>Inline <span typeof="mw:File"><a href="{name}" class="mw-file-description">'
+                f'{img}</a></span> file {i}.</p>')
+    if gallery:
+        parts.append(
+            f'<ul class="gallery mw-gallery-traditional" id="mwGallery">{"".join(gallery)}</ul>')
+    parts.append('</body></html>')
+    return ''.join(parts)
+
+
+def site_matrix() -> dict:
+    return {'sitematrix': {
+        'count': len(WIKIS) + 1,
+        **{str(n): {'code': wiki.partition('.')[0],
+                    'site': [{'url': f'https://{wiki}', 'dbname': f'{wiki.partition(".")[0]}wiki'}]}
+           for n, wiki in enumerate(WIKIS)},
+        'specials': [{'url': 'https://commons.wikimedia.org', 'dbname': 'commonswiki'}]}}
+
+
+def prop_values(prop: str, params: dict, page: dict, size: int) -> list:
+    """Return all values of a prop module for a page."""
+    title = page.get('title')
+    match = FILE.match(title)
+    i = int(match.group(1)) if match and not any(match.groups()[1:]) else None
+    if prop == 'imageinfo':
+        if i is None:
+            return []
+        fields = (params.get('iiprop') or 'timestamp').split('|')
+        values = []
+        for timestamp in uploads(i):
+            value = {}
+            if 'timestamp' in fields:
+                value['timestamp'] = timestamp
+            if 'url' in fields:
+                value['url'] = file_url(i)
+            values.append(value)
+        return values if params.get('iilimit') == 'max' else values[:1]
+    if prop == 'globalusage':
+        return global_usage(i, size) if i is not None else []
+    if prop == 'linkshere':
+        return [page_data(link) for link in linking_files(title)]
+    if prop == 'redirects':
+        return [page_data(redirect) for redirect in redirects(title)]
+    raise ValueError(prop)
+
+
+PROP_PREFIXES = {'imageinfo': 'ii', 'globalusage': 'gu', 'linkshere': 'lh', 'redirects': 'rd'}
+
+
+def query(params: dict) -> dict:
+    """Answer an action=query request."""
+    props = [prop for prop in (params.get('prop') or '').split('|') if prop]
+    if params.get('list') == 'categorymembers':
+        return list_categorymembers(params)
+
+    generator_continue = None
+    if params.get('generator') == 'categorymembers':
+        types = (params.get('gcmtype') or 'page|subcat|file').split('|')
+        files, size = category_files(params.get('gcmtitle'))
+        subcats = subcategories(params.get('gcmtitle')) if 'subcat' in types else []
+        files = files if 'file' in types else []
+        start = int(params.get('gcmcontinue') or 0)
+        end = start + BATCH_LIMIT
+        pages = [page_data(title) for title in subcats[start:end]]
+        pages.extend(page_data(file_title(i)) for i in files[
+            max(start - len(subcats), 0):max(end - len(subcats), 0)])
+        if end < len(subcats) + len(files):
+            generator_continue = str(end)
+    elif 'titles' in params:
+        size = 0
+        pages = [page_data(title) for title in params.get('titles').split('|')]
+    elif 'pageids' in params:
+        size = 0
+        pages = [page_data(file_title(int(pageid) - 1))
+                 for pageid in params.get('pageids').split('|')]
+    else:
+        return {'error': {'code': 'badparams', 'info': 'Unsupported query.'}}
+
+    if 'categoryinfo' in props:
+        props.remove('categoryinfo')
+        for page in pages:
+            files = len(category_files(page.get('title'))[0])
+            subcats = len(subcategories(page.get('title')))
+            page['categoryinfo'] = {
+                'size': files + subcats, 'pages': 0, 'files': files, 'subcats': subcats}
+
+    if 'info' in props:
+        props.remove('info')
+        for page in pages:
+            page.update({'touched': TOUCHED, 'lastrevid': page.get('pageid')})
+
+    continuing = params.get('continue', '').endswith('||') and params.get('continue') != '-||'
+    continuation = {}
+    for prop in props:
+        key = f'{PROP_PREFIXES[prop]}continue'
+        if continuing and key not in params:
+            continue  # already returned in full for this batch
+        offset = int(params.get(key) or 0)
+        values = [(page, value) for page in pages
+                  for value in prop_values(prop, params, page, size)]
+        for page, value in values[offset:offset + PROP_LIMIT]:
+            page.setdefault(prop, []).append(value)
+        if offset + PROP_LIMIT < len(values):
+            continuation[key] = str(offset + PROP_LIMIT)
+
+    data = {'query': {'pages': pages}}
+    if continuation:
+        if params.get('generator'):
+            continuation['gcmcontinue'] = params.get('gcmcontinue') or '0'
+            continuation['continue'] = 'gcmcontinue||'
+        else:
+            continuation['continue'] = '||'
+        data['continue'] = continuation
+    else:
+        data['batchcomplete'] = True
+        if generator_continue:
+            data['continue'] = {'gcmcontinue': generator_continue, 'continue': '-||'}
+    return data
+
+
+def list_categorymembers(params: dict) -> dict:
+    """Answer a list=categorymembers request, sorted by the time each file was added.
+
+    Subcategories are only listed on their own, without any files.
+    """
+    size = category_size(params.get('cmtitle'))
+    types = (params.get('cmtype') or 'page|subcat|file').split('|')
+    if 'file' not in types:
+        subcats = subcategories(params.get('cmtitle')) if 'subcat' in types else []
+        members = [page_data(title) for title in subcats]
+        return {'batchcomplete': True, 'query': {'categorymembers': members}}
+    limit = BATCH_LIMIT if params.get('cmlimit') in (None, 'max') else int(params.get('cmlimit'))
+    newer = params.get('cmdir') in ('newer', 'asc')
+    if 'cmcontinue' in params:
+        first = int(params.get('cmcontinue'))
+    elif 'cmstart' in params:
+        start = datetime.strptime(params.get('cmstart'), '%Y-%m-%dT%H:%M:%SZ')
+        first = int((start - ADDED).total_seconds())
+        first = max(first, 0) if newer else min(first, size - 1)
+    else:
+        first = 0 if newer else size - 1
+    step = 1 if newer else -1
+    members = []
+    for i in range(first, size if newer else -1, step)[:limit]:
+        added = (ADDED + timedelta(seconds=i)).strftime('%Y-%m-%dT%H:%M:%SZ')
+        members.append({**page_data(file_title(i)), 'timestamp': added})
+    data = {'query': {'categorymembers': members}}
+    following = first + step * len(members)
+    if 0 <= following < size:
+        data['continue'] = {'cmcontinue': str(following), 'continue': '-||'}
+    else:
+        data['batchcomplete'] = True
+    return data
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Request handler of the stand-in, see the module documentation."""
+
+    protocol_version = 'HTTP/1.1'  # keep-alive, as with the real servers
+    # the headers and body are written separately, which with Nagle's algorithm on a kept-alive
+    # connection stalls each response until the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.sleep()
+        url = urlsplit(self.path)
+        host, _, path = url.path.lstrip('/').partition('/')
+        path = '/' + path
+        params = dict(parse_qsl(url.query))
+        if path.endswith('/api.php'):
+            server.count('action')
+            if server.refuse():
+                self.reply(200, {'error': {'code': 'maxlag', 'info': 'Waiting for a database'}},
+                           {'MediaWiki-API-Error': 'maxlag', 'Retry-After': '0'})
+            else:
+                self.reply(200, action(params))
+            return
+
+        server.count('rest')
+        if server.refuse():
+            self.reply(429, {'type': 'about:blank', 'title': 'Too many requests'})
+            return
+        if path.startswith('/api/rest_v1/metrics/mediarequests/per-file/'):
+            parts = path.split('/')
+            file_path, frequency, start, end = unquote(parts[-4]), *parts[-3:]
+            match = FILE_PATH.search(file_path)
+            items = media_requests(int(match.group(1)), frequency, start, end) if match else []
+            if items:
+                self.reply(200, {'items': items})
+            else:
+                self.reply(404, {'type': 'https://mediawiki.org/wiki/HyperSwitch/errors/not_found'})
+            return
+        match = PAGE.match(unquote(path.rpartition('/')[2]).replace('_', ' '))
+        if host in WIKIS and match and '/api/rest_v1/page/' in path:
+            size, k = int(match.group(1)), int(match.group(2))
+            etag = f'"{size}/{k}"'
+            if self.headers.get('If-None-Match') == etag:
+                self.reply(304, None, {'ETag': etag})
+            elif '/page/media-list/' in path:
+                self.reply(200, media_list(size, k), {'ETag': etag})
+            elif '/page/html/' in path:
+                self.reply(200, page_html(size, k), {'ETag': etag})
+            return
+        self.reply(404, {'type': 'https://mediawiki.org/wiki/HyperSwitch/errors/not_found'})
+
+    def reply(self, status: int, body, headers: dict = None) -> None:
+        if body is None:
+            data = b''
+        elif isinstance(body, str):
+            data = body.encode('utf8')
+        else:
+            data = json.dumps(body).encode('utf8')
+        self.send_response(status)
+        content_type = 'text/html' if isinstance(body, str) else 'application/json'
+        self.send_header('Content-Type', f'{content_type}; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+        self.wfile.flush()
+
+
+def action(params: dict) -> dict:
+    """Answer an Action API request."""
+    if params.get('action') == 'sitematrix':
+        return site_matrix()
+    if params.get('action') == 'query':
+        return query(params)
+    return {'error': {'code': 'badvalue', 'info': f'Unsupported action {params.get("action")}.'}}
+
+
+class StandInServer(ThreadingHTTPServer):
+    """Threaded server of the stand-in, counting the requests it receives.
+
+    @param latency: seconds to delay each response.
+    @param error_rate: fraction of requests to refuse, asking the client to back off.
+    """
+
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, address: tuple = ('127.0.0.1', 0), latency: float = 0.0,
+                 error_rate: float = 0.0, seed: int = 0):
+        super().__init__(address, StandInHandler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f'http://{self.server_address[0]}:{self.server_port}'
+
+    def sleep(self) -> None:
+        if self.latency:
+            time.sleep(self.latency)
+
+    def count(self, api: str) -> None:
+        with self.lock:
+            self.counts[api] += 1
+
+    def refuse(self) -> bool:
+        """Whether to refuse the current request, counting it if so."""
+        with self.lock:
+            refused = self.error_rate and self.random.random() < self.error_rate
+            if refused:
+                self.counts['refused'] += 1
+        return bool(refused)
+
+    def start(self) -> 'StandInServer':
+        """Serve in a background thread."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def main() -> None:
+    """Command line entrypoint, serving until interrupted."""
+    parser = argparse.ArgumentParser(description=__doc__.partition('\n')[0])
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='milliseconds to delay each response')
+    parser.add_argument('--error_rate', type=float, default=0.0,
+                        help='fraction of requests to refuse')
+    args = parser.parse_args()
+    server = StandInServer(('127.0.0.1', args.port), latency=args.latency / 1000,
+                           error_rate=args.error_rate)
+    print(f'Serving on {server.url}, e.g. {server.url}/commons.wikimedia.org/w/api.php')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,5 @@
+"""Code shared between the scripts in this repo.
+
+The scripts are run directly from their own directories, so each of them adds the repo root to
+the module search path before importing from here.
+"""
@@ -0,0 +1,312 @@
+"""Batched queries against the MediaWiki Action API.
+
+Rather than creating a pywikibot page object, and making at least one request, per file these
+helpers combine a generator (e.g. categorymembers) with prop modules so that the data for up to
+500 files is returned per request. Continuation of both the generator and the prop modules is
+followed, and the partial page data from each response is merged. Category trees are walked
+breadth first, listing the subcategories, and retrieving the files, of several categories
+concurrently.
+
+All requests are counted in REQUEST_COUNTS, making it possible to check how many requests a run
+needed (e.g. against a local API stub).
+"""
+import queue
+import threading
+from collections import Counter, deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import chain
+
+import requests
+from pywikibot.exceptions import APIError
+
+COMMONS_API = 'https://commons.wikimedia.org/w/api.php'
+MAXLAG = 5
+MAX_TITLES = 50  # titles per request for clients without apihighlimits
+WALK_WORKERS = 4  # categories of a tree retrieved concurrently
+REQUEST_COUNTS = Counter()  # number of requests made per API
+
+_count_lock = threading.Lock()
+
+
+def count_request(api: str) -> None:
+    """Count a request made to the given API."""
+    with _count_lock:
+        REQUEST_COUNTS[api] += 1
+
+
+def category_title(name: str) -> str:
+    """Return a category name with the Category:-prefix."""
+    if name.startswith('Category:'):
+        return name
+    return f'Category:{name}'
+
+
+def api_request(s: requests.Session, params: dict, api_url: str = None) -> dict:
+    """Make a single Action API request and return the decoded response.
+
+    The request asks the servers to refuse it if they are lagged. Sessions from
+    http_client.make_session() then wait and retry.
+
+    @param api_url: the api.php endpoint to use. Defaults to COMMONS_API.
+    """
+    api_url = api_url or COMMONS_API
+    params = {'format': 'json', 'formatversion': 2, 'maxlag': MAXLAG, **params}
+    count_request('action')
+    res = s.get(api_url, params=params, timeout=60)
+    res.raise_for_status()
+    data = res.json()
+    error = data.get('error', {})
+    if error:
+        raise APIError(error.get('code'), error.get('info'))
+    return data
+
+
+def query(s: requests.Session, params: dict, api_url: str = None) -> Iterator[dict]:
+    """Yield each response of an action=query request, following continuation."""
+    params = {'action': 'query', **params}
+    continuation = {}
+    while True:
+        data = api_request(s, {**params, **continuation}, api_url=api_url)
+        yield data
+        if 'continue' not in data:
+            return
+        continuation = data.get('continue')
+
+
+def merge_page(page: dict, update: dict) -> None:
+    """Merge the data of a page from a continued response into the earlier data."""
+    for key, value in update.items():
+        if isinstance(value, list) and isinstance(page.get(key), list):
+            page[key].extend(value)
+        else:
+            page[key] = value
+
+
+def query_pages(
+        s: requests.Session, params: dict, api_url: str = None) -> Iterator[dict]:
+    """Yield each page of a generator/prop query once all of its prop data has been retrieved.
+
+    When a prop module (e.g. globalusage) continues, the same batch of generated pages is returned
+    again with the remaining data. The pages are therefore only yielded once the batch is complete.
+    """
+    batch = {}
+    for data in query(s, params, api_url=api_url):
+        for page in data.get('query', {}).get('pages', []):
+            key = page.get('pageid') or page.get('title')
+            if key in batch:
+                merge_page(batch[key], page)
+            else:
+                batch[key] = page
+        if data.get('batchcomplete') or 'continue' not in data:
+            yield from batch.values()
+            batch = {}
+    yield from batch.values()
+
+
+def category_tree(
+        s: requests.Session, category: str, depth: int = 0, api_url: str = None,
+        workers: int = WALK_WORKERS) -> Iterator[tuple[str, int]]:
+    """Yield the title of a category and of its subcategories down to the given depth.
+
+    Each title is yielded together with the number of files directly in that category, as given by
+    categoryinfo, which is retrieved together with the subcategories. Their sum is thus the number
+    of files in the tree, counting a file in several of the categories once per category.
+
+    Categories are visited breadth first and each is only yielded once, even if the category tree
+    contains cycles. The subcategories of the categories of a level are listed concurrently.
+
+    @param workers: number of categories to list the subcategories of concurrently.
+    """
+    category = category_title(category)
+    seen = {category}
+    level = [(category, category_file_count(s, category, api_url=api_url))]
+    list_subcategories = partial(subcategories, s, api_url=api_url)
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        for level_depth in range((depth or 0) + 1):
+            yield from level
+            if level_depth >= (depth or 0):
+                return
+            found = executor.map(list_subcategories, [cat for cat, _ in level])
+            level = []
+            for subcats in found:
+                for subcat, files in subcats:
+                    if subcat not in seen:
+                        seen.add(subcat)
+                        level.append((subcat, files))
+            if not level:
+                return
+
+
+def subcategories(
+        s: requests.Session, category: str, api_url: str = None) -> list[tuple[str, int]]:
+    """Return the title of each subcategory of a category, with the number of files in it."""
+    params = {
+        'generator': 'categorymembers', 'gcmtitle': category_title(category),
+        'gcmtype': 'subcat', 'gcmlimit': 'max', 'prop': 'categoryinfo'}
+    return [
+        (page.get('title'), page.get('categoryinfo', {}).get('files', 0))
+        for page in query_pages(s, params, api_url=api_url)]
+
+
+def category_files(
+        s: requests.Session, category: str, prop_params: dict = None, recurse: int = 0,
+        limit: int = None, api_url: str = None,
+        on_member: Callable[[str, dict], None] = None,
+        on_duplicate: Callable[[str, dict], None] = None, categories: Iterable[str] = None,
+        workers: int = WALK_WORKERS) -> Iterator[dict]:
+    """Yield the page data of each file in a category, together with any requested props.
+
+    When recursing, the files of several (sub) categories are retrieved concurrently, while the
+    files are still yielded in the order of the categories, as found by category_tree(). The
+    category tree is walked as the files are retrieved, unless the categories are given.
+
+    @param prop_params: the prop module(s) and their parameters to combine with the
+        categorymembers generator, e.g. {'prop': 'imageinfo', 'iiprop': 'url'}.
+    @param recurse: sub category depth to include. A file in multiple categories is only
+        yielded once.
+    @param limit: the maximum number of files to yield.
+    @param on_member: called with the category and the page data of each file found in it,
+        also for files already yielded from another (sub) category.
+    @param on_duplicate: called with the category and the page data of each file already yielded
+        from another (sub) category, e.g. to correct a total summed from category_tree().
+    @param categories: the categories of the tree, e.g. as already walked by category_tree().
+    @param workers: number of categories to retrieve the files of, or walk, concurrently.
+    """
+    if categories is None and recurse:
+        categories = (
+            cat for cat, _ in category_tree(
+                s, category, depth=recurse, api_url=api_url, workers=workers))
+    elif categories is None:
+        categories = [category_title(category)]
+    if not recurse:
+        workers = 1  # a single category is streamed as it is retrieved
+    seen = set()
+    for cat, page in tree_members(
+            s, categories, prop_params=prop_params, api_url=api_url, workers=workers):
+        if on_member:
+            on_member(cat, page)
+        if page.get('pageid') in seen:
+            if on_duplicate:
+                on_duplicate(cat, page)
+            continue  # since same file can occur in recursive categories
+        seen.add(page.get('pageid'))
+        yield page
+        if limit and len(seen) >= limit:
+            return
+
+
+def tree_members(
+        s: requests.Session, categories: Iterable[str], prop_params: dict = None,
+        api_url: str = None, workers: int = WALK_WORKERS) -> Iterator[tuple[str, dict]]:
+    """Yield each category together with the page data of each file directly in it.
+
+    The files of the following categories are retrieved in the background, by up to `workers`
+    threads, while those of the current category are yielded as soon as they arrive. The order
+    is therefore the same as when retrieving the categories one at a time.
+
+    @param workers: number of categories to retrieve the files of concurrently. With a single
+        worker no threads are used.
+    """
+    if workers <= 1:
+        for cat in categories:
+            for page in category_members(s, cat, prop_params=prop_params, api_url=api_url):
+                yield cat, page
+        return
+
+    stopped = threading.Event()
+
+    def retrieve(cat: str, pages: queue.SimpleQueue) -> None:
+        try:
+            for page in category_members(s, cat, prop_params=prop_params, api_url=api_url):
+                if stopped.is_set():
+                    return
+                pages.put(page)
+        finally:
+            pages.put(None)
+
+    # only retrieve a limited number of categories ahead of the one being yielded
+    pending = deque()
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        for cat in chain(categories, [None]):
+            if cat is not None:
+                pages = queue.SimpleQueue()
+                pending.append((cat, pages, executor.submit(retrieve, cat, pages)))
+            while pending and (cat is None or len(pending) >= workers * 2):
+                current, pages, future = pending.popleft()
+                for page in iter(pages.get, None):
+                    yield current, page
+                future.result()  # raises any error retrieving the category
+    finally:
+        # stop retrieving categories if the consumer stops early
+        stopped.set()
+        executor.shutdown(cancel_futures=True)
+
+
+def category_members(
+        s: requests.Session, category: str, prop_params: dict = None,
+        api_url: str = None) -> Iterator[dict]:
+    """Yield the page data of each file directly in a category, with any requested props."""
+    params = {
+        'generator': 'categorymembers', 'gcmtitle': category_title(category), 'gcmtype': 'file',
+        'gcmlimit': 'max', **(prop_params or {})}
+    yield from query_pages(s, params, api_url=api_url)
+
+
+def titles_pages(
+        s: requests.Session, titles: list, prop_params: dict = None,
+        api_url: str = None) -> Iterator[dict]:
+    """Yield the page data of each of the given titles, together with any requested props.
+
+    The titles are queried in batches of MAX_TITLES.
+    """
+    yield from _batched_pages(s, 'titles', titles, prop_params, api_url=api_url)
+
+
+def pageids_pages(
+        s: requests.Session, pageids: list, prop_params: dict = None,
+        api_url: str = None) -> Iterator[dict]:
+    """Yield the page data of each of the given page ids, together with any requested props.
+
+    The page ids are queried in batches of MAX_TITLES.
+    """
+    yield from _batched_pages(s, 'pageids', pageids, prop_params, api_url=api_url)
+
+
+def _batched_pages(
+        s: requests.Session, key: str, values: list, prop_params: dict = None,
+        api_url: str = None) -> Iterator[dict]:
+    """Yield the page data of the pages given through the titles or pageids parameter."""
+    for i in range(0, len(values), MAX_TITLES):
+        params = {key: '|'.join(str(value) for value in values[i:i + MAX_TITLES]),
+                  **(prop_params or {})}
+        yield from query_pages(s, params, api_url=api_url)
+
+
+def site_matrix(s: requests.Session, api_url: str = None) -> dict:
+    """Return the database name of each Wikimedia wiki, keyed by its host name."""
+    hosts = {}
+    params = {'action': 'sitematrix', 'smsiteprop': 'url|dbname', 'smlimit': 'max'}
+    continuation = {}
+    while True:
+        data = api_request(s, {**params, **continuation}, api_url=api_url)
+        for key, value in data.get('sitematrix').items():
+            if key == 'count':
+                continue
+            sites = value if key == 'specials' else value.get('site', [])
+            for site in sites:
+                hosts[site.get('url').partition('://')[2]] = site.get('dbname')
+        if 'continue' not in data:
+            return hosts
+        continuation = data.get('continue')
+
+
+def category_file_count(
+        s: requests.Session, category: str, api_url: str = None) -> int:
+    """Return the number of files directly in a category."""
+    data = api_request(
+        s, {'action': 'query', 'prop': 'categoryinfo', 'titles': category_title(category)},
+        api_url=api_url)
+    return data.get('query').get('pages')[0].get('categoryinfo', {}).get('files', 0)
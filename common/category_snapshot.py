@@ -0,0 +1,250 @@
+"""Snapshots of the files in a category tree, shared between the scripts.
+
+Each script starts by walking a category, and possibly its subcategories, for its files. A
+snapshot does this once and stores the page id, title, first upload and url of each file in a
+sqlite file, together with the (sub)categories each file was found in and when the snapshot was
+taken. Runs of any of the scripts with the same --snapshot then read the files from it, instead
+of walking the category again, for as long as the snapshot is fresh.
+
+The url and first upload of each file are provided in the imageinfo format of the Action API, as
+a single entry with the url of the current version and the timestamp of the first upload. Other
+prop data (e.g. globalusage) is still retrieved from the API by listing the categories of the
+snapshot again, up to 500 files per request rather than the 50 per request of page ids, so such
+runs only save the walk of the subcategories. Only files which have since left their categories
+are retrieved by page id.
+"""
+import argparse
+import sqlite3
+from collections.abc import Callable, Iterator
+from datetime import datetime, timedelta, timezone
+
+import pywikibot
+import requests
+
+from common import action_api
+from common.metrics import METRICS
+
+DEFAULT_MAX_AGE = 24  # hours
+SNAPSHOT_PARAMS = {'prop': 'imageinfo', 'iiprop': 'timestamp|url', 'iilimit': 'max'}
+SNAPSHOT_PROPS = {'timestamp', 'url'}  # the imageinfo props provided by the snapshot
+TIMESTAMP = '%Y-%m-%dT%H:%M:%SZ'
+WRITE_BATCH = 5000  # files written to the snapshot at a time while it is taken
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the snapshot options shared by the scripts to a parser."""
+    parser.add_argument('--snapshot', action='store', metavar='PATH',
+                        help=('sqlite file with snapshots of the category members, shared '
+                              'between the scripts. The category is only walked if there is no '
+                              'fresh snapshot of it'))
+    parser.add_argument('--snapshot_max_age', type=float, default=DEFAULT_MAX_AGE,
+                        action='store', metavar='HOURS',
+                        help=('age after which a snapshot is taken anew. '
+                              f'Defaults to {DEFAULT_MAX_AGE}'))
+
+
+def open_snapshot(
+        args: argparse.Namespace, workers: int = action_api.WALK_WORKERS) -> 'CategorySnapshot':
+    """Return the snapshot given on the command line, if any.
+
+    @param workers: number of categories to walk concurrently when taking a snapshot.
+    """
+    if not args.snapshot:
+        return None
+    return CategorySnapshot(args.snapshot, max_age=args.snapshot_max_age, workers=workers)
+
+
+class CategorySnapshot:
+    """sqlite backed snapshots of the files in category trees.
+
+    A snapshot is kept per category and depth, a file in several of them is stored once.
+    """
+
+    def __init__(
+            self, path: str, max_age: float = DEFAULT_MAX_AGE,
+            workers: int = action_api.WALK_WORKERS):
+        """
+        @param max_age: hours after which a snapshot is taken anew.
+        @param workers: number of categories to walk concurrently when taking a snapshot.
+        """
+        self.max_age = timedelta(hours=max_age)
+        self.workers = workers
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS snapshots ('
+                'id INTEGER PRIMARY KEY, category TEXT, depth INTEGER, taken TEXT, '
+                'UNIQUE (category, depth))')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS files ('
+                'pageid INTEGER PRIMARY KEY, title TEXT, uploaded TEXT, url TEXT)')
+            # in the order the files were found, by rowid
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS members (snapshot INTEGER, category TEXT, '
+                'pageid INTEGER)')
+            self.conn.execute(
+                'CREATE INDEX IF NOT EXISTS members_snapshot ON members (snapshot)')
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def ensure(
+            self, s: requests.Session, category: str, depth: int = 0,
+            since: str = None) -> int:
+        """Return the id of a fresh snapshot of the category, taking it if needed.
+
+        @param since: also take the snapshot anew if it is older than this timestamp, e.g. the
+            time the latest file was added to the category.
+        """
+        category = action_api.category_title(category)
+        depth = depth or 0
+        row = self.conn.execute(
+            'SELECT id, taken FROM snapshots WHERE category = ? AND depth = ?',
+            (category, depth)).fetchone()
+        oldest = (datetime.now(timezone.utc) - self.max_age).strftime(TIMESTAMP)
+        if row and row[1] >= oldest and (not since or row[1] >= since):
+            METRICS.count('snapshot', result='fresh')
+            return row[0]
+        with METRICS.stage('snapshot'):
+            snapshot_id = self.take(s, category, depth)
+        METRICS.count('snapshot', result='taken')
+        return snapshot_id
+
+    def take(self, s: requests.Session, category: str, depth: int = 0) -> int:
+        """Walk the category tree and store a snapshot of its files, replacing any earlier one.
+
+        The files are written as they are found, in batches, rather than kept in memory until the
+        walk is done. Should the walk fail, any earlier snapshot is left as it was.
+        """
+        taken = datetime.now(timezone.utc).strftime(TIMESTAMP)
+        with self.conn:
+            self.conn.execute(
+                'INSERT INTO snapshots (category, depth, taken) VALUES (?, ?, ?) '
+                'ON CONFLICT (category, depth) DO UPDATE SET taken = excluded.taken',
+                (category, depth, taken))
+            snapshot_id = self.conn.execute(
+                'SELECT id FROM snapshots WHERE category = ? AND depth = ?',
+                (category, depth)).fetchone()[0]
+            self.conn.execute('DELETE FROM members WHERE snapshot = ?', (snapshot_id,))
+
+            members = []
+            files = []
+            total = 0
+
+            def on_member(cat: str, page: dict) -> None:
+                members.append((snapshot_id, cat, page.get('pageid')))
+
+            def write() -> None:
+                self.conn.executemany('INSERT INTO members VALUES (?, ?, ?)', members)
+                self.conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)', files)
+                members.clear()
+                files.clear()
+
+            for page in action_api.category_files(
+                    s, category, prop_params=SNAPSHOT_PARAMS, recurse=depth,
+                    on_member=on_member, workers=self.workers):
+                uploads = page.get('imageinfo') or [{}]
+                files.append((
+                    page.get('pageid'), page.get('title'),
+                    min((upload.get('timestamp') for upload in uploads
+                         if upload.get('timestamp')), default=None),
+                    uploads[0].get('url')))
+                total += 1
+                if len(files) >= WRITE_BATCH:
+                    write()
+            write()
+            self.conn.execute(
+                'DELETE FROM files WHERE pageid NOT IN (SELECT pageid FROM members)')
+        pywikibot.output(f'Took a snapshot of the {total} files in {category}.')
+        return snapshot_id
+
+    def file_count(
+            self, s: requests.Session, category: str, depth: int = 0, since: str = None) -> int:
+        """Return the number of distinct files in the snapshot of a category."""
+        snapshot_id = self.ensure(s, category, depth, since=since)
+        return self.conn.execute(
+            'SELECT COUNT(DISTINCT pageid) FROM members WHERE snapshot = ?',
+            (snapshot_id,)).fetchone()[0]
+
+    def category_files(
+            self, s: requests.Session, category: str, prop_params: dict = None,
+            recurse: int = 0, limit: int = None,
+            on_member: Callable[[str, dict], None] = None) -> Iterator[dict]:
+        """Yield the page data of each file in a category, as action_api.category_files().
+
+        The files are yielded in the order they were found when the snapshot was taken. Prop data
+        other than the url and timestamps of imageinfo is retrieved from the API.
+
+        @param on_member: called with the category and the page data, as stored in the snapshot,
+            of each file found in it, also for files already yielded from another category.
+        """
+        snapshot_id = self.ensure(s, category, recurse)
+        if not prop_params or self._provides(prop_params):
+            yield from self._pages(snapshot_id, limit=limit, on_member=on_member)
+        else:
+            yield from self._fetched_pages(
+                s, snapshot_id, prop_params, limit=limit, on_member=on_member)
+
+    def _pages(
+            self, snapshot_id: int, limit: int = None,
+            on_member: Callable[[str, dict], None] = None) -> Iterator[dict]:
+        """Yield the stored page data of each distinct file in a snapshot."""
+        seen = set()
+        rows = self.conn.execute(
+            'SELECT members.category, files.pageid, files.title, files.uploaded, files.url '
+            'FROM members JOIN files USING (pageid) WHERE members.snapshot = ? '
+            'ORDER BY members.rowid', (snapshot_id,))
+        for cat, pageid, title, uploaded, url in rows:
+            info = {key: value for key, value in (('timestamp', uploaded), ('url', url)) if value}
+            page = {'pageid': pageid, 'ns': 6, 'title': title, 'imageinfo': [info] if info else []}
+            if on_member:
+                on_member(cat, page)
+            if pageid in seen:
+                continue
+            seen.add(pageid)
+            yield page
+            if limit and len(seen) >= limit:
+                return
+
+    @staticmethod
+    def _provides(prop_params: dict) -> bool:
+        """Whether the snapshot holds all of the requested prop data."""
+        return (prop_params.get('prop') == 'imageinfo'
+                and set(prop_params.get('iiprop', 'timestamp').split('|')) <= SNAPSHOT_PROPS)
+
+    def _fetched_pages(
+            self, s: requests.Session, snapshot_id: int, prop_params: dict, limit: int = None,
+            on_member: Callable[[str, dict], None] = None) -> Iterator[dict]:
+        """Yield the page data, with the requested props, of each distinct file in a snapshot.
+
+        The props are retrieved together with the members of each category in the snapshot, i.e.
+        without walking the category tree again, keeping only the files in the snapshot. Files
+        which have since been removed from their categories are then retrieved by page id.
+        """
+        wanted = {pageid for (pageid,) in self.conn.execute(
+            'SELECT pageid FROM members WHERE snapshot = ?', (snapshot_id,))}
+        categories = [category for (category,) in self.conn.execute(
+            'SELECT category FROM members WHERE snapshot = ? GROUP BY category '
+            'ORDER BY MIN(rowid)', (snapshot_id,))]
+        seen = set()
+        for cat in categories:
+            for page in action_api.category_members(s, cat, prop_params=prop_params):
+                if page.get('pageid') not in wanted:
+                    continue  # added since the snapshot was taken
+                if on_member:
+                    on_member(cat, page)
+                if page.get('pageid') in seen:
+                    continue
+                seen.add(page.get('pageid'))
+                yield page
+                if limit and len(seen) >= limit:
+                    return
+
+        removed = [
+            page.get('pageid') for page in self._pages(snapshot_id)
+            if page.get('pageid') not in seen]
+        for page in action_api.pageids_pages(s, removed, prop_params=prop_params):
+            seen.add(page.get('pageid'))
+            yield page
+            if limit and len(seen) >= limit:
+                return
@@ -0,0 +1,196 @@
+"""Pooled and throttled HTTP sessions shared by the scripts.
+
+Each session keeps a pool of kept-alive connections per host, sized for the number of concurrent
+workers, and paces its requests through one token bucket per host.
+
+When a server signals that it is overloaded, through a 429 or 503 response or a maxlag error
+from the Action API, the rate for that host is halved and all requests to it are held back for
+the time given by any Retry-After header before the request is retried. The rate then recovers
+gradually with each successful request.
+
+The latency, response status and retries of each request are recorded in metrics.METRICS, per
+endpoint, as is the time spent held back by the throttling.
+"""
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter, Retry
+
+from common.metrics import METRICS
+
+# connection errors, before any response. Responses asking us to back off, such as a 429 with a
+# Retry-After header, are not retried by the adapter but returned to ThrottledSession, which
+# holds back every worker
+RETRIES = Retry(total=5, backoff_factor=0.1, status=0, respect_retry_after_header=False)
+BACKOFF_STATUSES = (429, 503)
+MAX_BACKOFFS = 5
+MIN_RATE = 0.5  # requests per second
+RECOVERY_STEPS = 20  # successful requests to recover from the minimum to the maximum rate
+POOL_CONNECTIONS = 100  # number of hosts to keep a connection pool for
+DEFAULT_POOL_SIZE = 10  # connections per host
+
+
+class TokenBucket:
+    """Thread safe token bucket limiting requests to `rate` per second, adapting to the server.
+
+    After being idle up to `burst` requests can be made at once. All workers share the bucket of
+    a host, so that a server asking us to back off holds back every worker, not just the one
+    which got the response.
+    """
+
+    def __init__(self, rate: float = None, burst: int = 1):
+        """
+        @param rate: maximum number of requests per second. Unlimited if not provided, in which
+            case requests are only held back when the server asks for it.
+        """
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self) -> None:
+        """Block until a request may be made."""
+        with self.lock:
+            now = time.monotonic()
+            delay = max(self.paused_until - now, 0.0)
+            if self.rate:
+                elapsed = max(now - self.updated, 0.0)
+                self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+                self.updated = max(self.updated, now)
+                self.tokens -= 1
+                if self.tokens < 0:
+                    delay = max(delay, -self.tokens / self.rate)
+        if delay:
+            time.sleep(delay)
+
+    def slow_down(self, seconds: float) -> None:
+        """Halve the rate and hold back all requests for the given number of seconds."""
+        with self.lock:
+            if self.rate:
+                self.rate = max(min(MIN_RATE, self.max_rate), self.rate / 2)
+                self.tokens = min(self.tokens, 0)
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.updated = max(self.updated, self.paused_until)
+
+    def speed_up(self) -> None:
+        """Raise the rate a step towards the maximum after a successful request."""
+        if self.rate == self.max_rate:
+            return
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / RECOVERY_STEPS)
+
+
+class ThrottledSession(requests.Session):
+    """Session pacing its requests per host and backing off when a server is overloaded."""
+
+    def __init__(self, rate: float = None, burst: int = 1):
+        """
+        @param rate: maximum number of requests per second to each host.
+        @param burst: number of requests which can be made at once to an idle host.
+        """
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.limiters = {}
+        self.limiter_lock = threading.Lock()
+        self.environment_settings = {}
+
+    def limiter(self, url: str) -> TokenBucket:
+        """Return the token bucket of the host of a url."""
+        host = urlsplit(url).netloc
+        with self.limiter_lock:
+            if host not in self.limiters:
+                self.limiters[host] = TokenBucket(self.rate, self.burst)
+            return self.limiters[host]
+
+    def merge_environment_settings(self, url, proxies, stream, verify, cert) -> dict:
+        """Return the settings of a request, looking up those of the environment once per host.
+
+        requests otherwise scans all environment variables for proxy settings on every request,
+        which, holding the GIL, becomes the bottleneck with many workers.
+        """
+        if proxies or stream is not None or verify is not None or cert is not None:
+            return super().merge_environment_settings(url, proxies, stream, verify, cert)
+        key = urlsplit(url)[:2]
+        if key not in self.environment_settings:
+            self.environment_settings[key] = super().merge_environment_settings(
+                url, {}, None, None, None)
+        settings = self.environment_settings[key]
+        return {**settings, 'proxies': dict(settings['proxies'])}
+
+    def request(self, method: str, url: str, *args, **kwargs) -> requests.Response:
+        """Make a request, retrying with backoff as long as the server asks for it."""
+        limiter = self.limiter(url)
+        endpoint = endpoint_name(url)
+        for backoff in range(MAX_BACKOFFS + 1):
+            with METRICS.stage('throttled'):
+                limiter.wait()
+            start = time.perf_counter()
+            res = super().request(method, url, *args, **kwargs)
+            METRICS.observe('request_seconds', time.perf_counter() - start, endpoint=endpoint)
+            METRICS.count('responses', endpoint=endpoint, status=res.status_code)
+            delay = backoff_delay(res, backoff)
+            if delay is None:
+                limiter.speed_up()
+                return res
+            if backoff == MAX_BACKOFFS:
+                return res
+            res.close()
+            METRICS.count('retries', endpoint=endpoint)
+            limiter.slow_down(delay)
+        return res
+
+
+def endpoint_name(url: str) -> str:
+    """Return the endpoint of a url without the host or the page, e.g. page/html."""
+    path = urlsplit(url).path
+    if path.endswith('/api.php'):
+        return 'action_api'
+    _, rest_api, endpoint = path.partition('/api/rest_v1/')
+    if rest_api:
+        return '/'.join(endpoint.split('/')[:2])
+    return path
+
+
+def get_retry_after(res: requests.Response) -> float:
+    """Return the number of seconds requested by a Retry-After header, if any."""
+    try:
+        return float(res.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None  # missing, or given as a HTTP-date
+
+
+def backoff_delay(res: requests.Response, backoff: int = 0) -> float:
+    """Return how long to back off before retrying a request, or None if it succeeded.
+
+    @param backoff: the number of times the request has already been retried.
+    """
+    if (res.status_code not in BACKOFF_STATUSES
+            and res.headers.get('MediaWiki-API-Error') != 'maxlag'):
+        return None
+    return get_retry_after(res) or RETRIES.backoff_factor * 2 ** (backoff + 1)
+
+
+def make_session(
+        headers: dict = None, pool_maxsize: int = DEFAULT_POOL_SIZE, rate: float = None,
+        burst: int = 1) -> ThrottledSession:
+    """Return a session with pooled connections and throttling per host.
+
+    @param headers: headers to send with all requests, e.g. the User-Agent.
+    @param pool_maxsize: number of connections to keep open per host. Should be at least the
+        number of concurrent workers.
+    @param rate: maximum number of requests per second to each host.
+    @param burst: number of requests which can be made at once to an idle host.
+    """
+    s = ThrottledSession(rate=rate, burst=burst)
+    adapter = HTTPAdapter(
+        max_retries=RETRIES, pool_connections=POOL_CONNECTIONS, pool_maxsize=pool_maxsize)
+    s.mount('https://', adapter)
+    s.mount('http://', adapter)
+    s.headers.update(headers or {})
+    return s
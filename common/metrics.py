@@ -0,0 +1,267 @@
+"""Instrumentation of the scripts: stage timers, request latencies and counters.
+
+All metrics of a run are collected in METRICS, which is safe to update from several threads:
+
+* stages: the number of times each stage (e.g. enumerating the category members, parsing or
+  writing the output) was entered and the total time spent in it. Stages run by concurrent
+  workers add up, so their total may exceed the wall time of the run.
+* histograms: the distribution of e.g. the latency of each endpoint, over fixed buckets.
+* counters: e.g. requests and their responses, retries, skipped files and cache hits.
+
+At the end of a run the metrics are written to a JSON sidecar next to the output, and optionally
+to a Prometheus textfile (for the node exporter textfile collector). With --profile the run is
+also profiled through cProfile and the functions taking the most time are added to the sidecar.
+"""
+import argparse
+import cProfile
+import json
+import os
+import pstats
+import re
+import threading
+import time
+from collections import Counter
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
+
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)  # seconds
+PROFILE_TOP = 30  # functions to include in the sidecar
+PROMETHEUS_PREFIX = 'nordiska'
+
+
+def metric_key(name: str, labels: dict) -> str:
+    """Return the name of a metric with its labels, in the Prometheus notation."""
+    if not labels:
+        return name
+    label_text = ','.join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+    return f'{name}{{{label_text}}}'
+
+
+class Histogram:
+    """Distribution of observed values over the fixed BUCKETS."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # the last one for values above all buckets
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                break
+        else:
+            i = len(BUCKETS)
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Return the upper bound of the bucket holding the given quantile."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+    def as_dict(self) -> dict:
+        cumulative = []
+        seen = 0
+        for count in self.counts:
+            seen += count
+            cumulative.append(seen)
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'mean': round(self.sum / self.count, 6) if self.count else None,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'buckets': {
+                **{str(bound): total for bound, total in zip(BUCKETS, cumulative)},
+                '+Inf': cumulative[-1]}
+        }
+
+
+class Metrics:
+    """Thread safe collection of the stages, histograms and counters of a run."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.stages = {}  # key: [calls, seconds]
+        self.histograms = {}
+        self.counters = Counter()
+        self.profile = None
+        self.lock = threading.Lock()
+
+    def count(self, name: str, value: int = 1, **labels) -> None:
+        """Add to a counter, e.g. count('skipped', reason='999')."""
+        with self.lock:
+            self.counters[metric_key(name, labels)] += value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        """Add a value, e.g. a latency in seconds, to a histogram."""
+        key = metric_key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    def add_time(self, stage: str, seconds: float) -> None:
+        """Add time spent in a stage."""
+        with self.lock:
+            totals = self.stages.setdefault(stage, [0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+
+    @contextmanager
+    def stage(self, stage: str):
+        """Time the enclosed block as (part of) a stage."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def timed(self, iterable: Iterable, stage: str) -> Iterator:
+        """Yield from an iterable, timing the production of each item as a stage.
+
+        The time the consumer spends on each item is not included.
+        """
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(stage, time.perf_counter() - start)
+                return
+            self.add_time(stage, time.perf_counter() - start)
+            yield item
+
+    def as_dict(self) -> dict:
+        with self.lock:
+            data = {
+                'wall_seconds': round(time.time() - self.started, 3),
+                'stages': {
+                    stage: {'calls': calls, 'seconds': round(seconds, 3)}
+                    for stage, (calls, seconds) in sorted(self.stages.items())},
+                'histograms': {
+                    key: histogram.as_dict()
+                    for key, histogram in sorted(self.histograms.items())},
+                'counters': dict(sorted(self.counters.items()))
+            }
+        if self.profile:
+            data['profile'] = self.profile
+        return data
+
+    def prometheus_lines(self, script: str) -> Iterator[str]:
+        """Yield the lines of the metrics in the Prometheus text format."""
+        data = self.as_dict()
+        job = {'script': script}
+        prefix = PROMETHEUS_PREFIX
+
+        yield f'# TYPE {prefix}_wall_seconds gauge'
+        yield f'{metric_key(f"{prefix}_wall_seconds", job)} {data["wall_seconds"]}'
+        yield f'# TYPE {prefix}_stage_seconds_total counter'
+        for stage, totals in data['stages'].items():
+            key = metric_key(f'{prefix}_stage_seconds_total', {**job, 'stage': stage})
+            yield f'{key} {totals["seconds"]}'
+        yield f'# TYPE {prefix}_stage_calls_total counter'
+        for stage, totals in data['stages'].items():
+            key = metric_key(f'{prefix}_stage_calls_total', {**job, 'stage': stage})
+            yield f'{key} {totals["calls"]}'
+
+        typed = set()
+        for key, value in data['counters'].items():
+            name, labels = parse_key(key)
+            name = f'{prefix}_{name}_total'
+            if name not in typed:
+                typed.add(name)
+                yield f'# TYPE {name} counter'
+            yield f'{metric_key(name, {**job, **labels})} {value}'
+
+        for key, histogram in data['histograms'].items():
+            name, labels = parse_key(key)
+            name = f'{prefix}_{name}'
+            if name not in typed:
+                typed.add(name)
+                yield f'# TYPE {name} histogram'
+            for bound, total in histogram['buckets'].items():
+                yield f'{metric_key(f"{name}_bucket", {**job, **labels, "le": bound})} {total}'
+            yield f'{metric_key(f"{name}_sum", {**job, **labels})} {histogram["sum"]}'
+            yield f'{metric_key(f"{name}_count", {**job, **labels})} {histogram["count"]}'
+
+
+METRICS = Metrics()
+
+LABEL = re.compile(r'(\w+)="([^"]*)"')
+
+
+def parse_key(key: str) -> tuple[str, dict]:
+    """Split the key of a metric into its name and labels."""
+    name, _, labels = key.partition('{')
+    return name, dict(LABEL.findall(labels))
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """Add the instrumentation options shared by the scripts to a parser."""
+    parser.add_argument('--profile', action='store_true',
+                        help=('profile the run with cProfile and add the slowest functions to '
+                              'the metrics sidecar'))
+    parser.add_argument('--prometheus', action='store', metavar='PATH',
+                        help='also write the metrics of the run to this Prometheus textfile')
+
+
+@contextmanager
+def profiled(enabled: bool = True):
+    """Profile the enclosed block with cProfile, if enabled.
+
+    Only the thread entering the block is profiled, time spent waiting for worker threads shows
+    up as such.
+    """
+    if not enabled:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        METRICS.profile = profile_summary(pstats.Stats(profiler))
+
+
+def profile_summary(stats: pstats.Stats, top: int = PROFILE_TOP) -> list:
+    """Return the functions with the highest cumulative time."""
+    rows = []
+    for (filename, line, function), (_, calls, total, cumulative, _) in stats.stats.items():
+        rows.append({
+            'function': f'{os.path.basename(filename)}:{line}({function})',
+            'calls': calls,
+            'tottime': round(total, 4),
+            'cumtime': round(cumulative, 4)})
+    rows.sort(key=lambda row: row['cumtime'], reverse=True)
+    return rows[:top]
+
+
+def sidecar_path(out_file: str) -> str:
+    """Return the path of the metrics sidecar of an output file."""
+    return f'{os.path.splitext(out_file)[0]}_metrics.json'
+
+
+def export(out_file: str, script: str, prometheus_file: str = None) -> None:
+    """Write the metrics of the run next to the output file, and optionally as a textfile.
+
+    The textfile is written to a temporary file first, so that a collector never reads a partial
+    file.
+    """
+    with open(sidecar_path(out_file), 'w', encoding='utf8') as fp:
+        json.dump({'script': script, **METRICS.as_dict()}, fp, indent=2, ensure_ascii=False)
+    if prometheus_file:
+        tmp_file = f'{prometheus_file}.tmp'
+        with open(tmp_file, 'w', encoding='utf8') as fp:
+            for line in METRICS.prometheus_lines(script):
+                fp.write(f'{line}\n')
+        os.replace(tmp_file, prometheus_file)
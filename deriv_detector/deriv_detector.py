@@ -1,12 +1,66 @@
 # https://commons.wikimedia.org/w/api.php?action=query&format=json&prop=linkshere&continue=gcmcontinue%7C%7C&generator=categorymembers&formatversion=2&lhprop=pageid%7Ctitle%7Credirect&lhnamespace=6&lhshow=!redirect&lhlimit=max&gcmtitle=Category%3A100%20000%20Bildminnen&gcmtype=file&gcmlimit=max
+import argparse
 import json
+import os
+import sys
+from itertools import chain
+
 import pywikibot
 from tqdm import tqdm
 
+from derivative_graph import DerivativeGraph
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common import action_api, category_snapshot, http_client, metrics  # noqa: E402
+from common.metrics import METRICS  # noqa: E402
+
+HEADERS = {
+    'User-Agent': 'deriv_detector.py/1.0 (https://github.com/Wikimedia-Sverige/nordiska-2022)'
+}
+# non-redirect file pages linking to each page, as well as the redirects to each page
+BACKLINK_PARAMS = {
+    'prop': 'linkshere|redirects', 'lhprop': 'pageid|title', 'lhnamespace': 6,
+    'lhshow': '!redirect', 'lhlimit': 'max', 'rdprop': 'pageid|title', 'rdlimit': 'max'}
+DEFAULT_DEPTH = 5
+
+
+def get_infiles(s, category_name, redirects, snapshot=None):
+    """Yield the title of each file in the category together with the titles of its in-files.
+
+    @param redirects: populated with the target file title of each redirect to the files.
+    @param snapshot: snapshot to read the files of the category from, see category_snapshot.
+    """
+    list_files = snapshot.category_files if snapshot else action_api.category_files
+    pages = list_files(s, category_name, prop_params=BACKLINK_PARAMS)
+    yield from page_infiles(pages, redirects)
 
-def get_infiles(fp):
-    links = fp.backlinks(filter_redirects=False, namespaces=['file'])
-    return [link for link in links]
+def get_titles_infiles(s, titles, redirects):
+    """Yield each of the titles together with the titles of its in-files.
+
+    @param redirects: populated with the target file title of each redirect to the files.
+    """
+    pages = action_api.titles_pages(s, titles, prop_params=BACKLINK_PARAMS)
+    yield from page_infiles(pages, redirects)
+
+def page_infiles(pages, redirects):
+    """Yield the title and in-files of each page from a linkshere|redirects query."""
+    for file_page in pages:
+        in_files = [link.get('title') for link in file_page.get('linkshere', [])]
+        for redirect in file_page.get('redirects', []):
+            redirects[redirect.get('title')] = file_page.get('title')
+        yield file_page.get('title'), in_files
+
+def get_redirect_infiles(s, redirects):
+    """Yield the target file title of each redirect together with the in-files of the redirect.
+
+    This matches pywikibot's backlinks(), which follows redirects.
+    """
+    params = {
+        key: value for key, value in BACKLINK_PARAMS.items() if not key.startswith('rd')}
+    params['prop'] = 'linkshere'
+    for redirect in action_api.titles_pages(s, list(redirects), prop_params=params):
+        in_files = [link.get('title') for link in redirect.get('linkshere', [])]
+        yield redirects.get(redirect.get('title')), in_files
 
 def output_results(cat, data):
     clean_cat = cat.replace(' ','_').split(':')[-1]
@@ -14,28 +68,146 @@ def output_results(cat, data):
     with open(out_file, 'w', encoding ='utf8') as fp:
         json.dump(data, fp, sort_keys=True, indent=2, ensure_ascii=False)
         pywikibot.output(f'Data saved to {out_file}')
+    return out_file
 
 def count_relations(data):
+    """Print the number of unique (undirected) relations between two files.
+
+    Each relation is kept as a pair of file ids packed into a single integer, as in
+    DerivativeGraph, rather than as a set of titles.
+    """
+    ids = {}
     relations = set()
     for k, v in data.items():
+        a = ids.setdefault(k, len(ids))
         for vv in v:
-            relations.add(frozenset([k, vv]))
+            b = ids.setdefault(vv, len(ids))
+            relations.add(min(a, b) << 32 | max(a, b))
     print(f'There were {len(relations)} unique relations detected')
 
-def detect_derivatives(category_name):
-    site = pywikibot.Site('commons', 'commons')
-    cat = pywikibot.Category(site, category_name)
+def file_count(s, category_name, snapshot=None):
+    """Return the number of files in the category, or in its snapshot."""
+    if snapshot:
+        return snapshot.file_count(s, category_name)
+    return action_api.category_file_count(s, category_name)
+
+def detect_derivatives(category_name, snapshot=None):
+    s = http_client.make_session(HEADERS)
     data = {}
+    redirects = {}
 
-    for file_page in tqdm(cat.members(member_type=['file']), desc="Processing category members", total=cat.categoryinfo.get('files')):
-        in_files = get_infiles(file_page)
+    total = file_count(s, category_name, snapshot)
+    for file_title, in_files in METRICS.timed(tqdm(get_infiles(s, category_name, redirects, snapshot), desc="Processing category members", total=total), 'enumerate'):
+        if in_files:
+            data[file_title] = in_files
+    for file_title, in_files in METRICS.timed(get_redirect_infiles(s, redirects), 'enumerate'):
         if in_files:
-            data[file_page.title()] = [in_file.title() for in_file in in_files]
+            data.setdefault(file_title, []).extend(in_files)
 
     count_relations(data)
+    pywikibot.output(f'Made {action_api.REQUEST_COUNTS["action"]} Action API requests.')
     return data
 
 
-category = input('category name: ')
-out_data = detect_derivatives(category)
-output_results(category, out_data)
+def build_derivative_graph(category_name, depth=DEFAULT_DEPTH, snapshot=None):
+    """Follow the derivatives of the files in the category, and of those derivatives, and so on.
+
+    Each hop queries the in-files of the whole frontier, i.e. the files first found in the
+    previous hop, in batches. A file is only expanded once, and no further than depth hops from
+    the category.
+    """
+    s = http_client.make_session(HEADERS)
+    graph = DerivativeGraph()
+    frontier = None
+    for hop in range(1, depth + 1):
+        redirects = {}
+        if frontier is None:
+            pages = get_infiles(s, category_name, redirects, snapshot)
+            total = file_count(s, category_name, snapshot)
+        else:
+            pages = get_titles_infiles(s, [graph.titles[node] for node in frontier], redirects)
+            total = len(frontier)
+        expanded = set()
+        new = []
+        # the redirects are only looked up once all pages of the hop have been processed
+        for file_title, in_files in METRICS.timed(chain(
+                tqdm(pages, desc=f"Processing hop {hop}", total=total),
+                get_redirect_infiles(s, redirects)), 'enumerate'):
+            expanded.add(file_title)
+            if in_files:
+                new.extend(graph.add_derivatives(file_title, in_files, hop))
+        frontier = [node for node in new if graph.titles[node] not in expanded]
+        if not frontier:
+            break
+
+    pywikibot.output(
+        f'Found {graph.edge_count()} links between {len(graph)} files in {hop} hops, '
+        f'{len(frontier)} files were left unexpanded.')
+    pywikibot.output(f'Made {action_api.REQUEST_COUNTS["action"]} Action API requests.')
+    return graph
+
+def output_graph(cat, graph):
+    """Output the edge list and a summary of each connected component of the graph."""
+    clean_cat = cat.replace(' ','_').split(':')[-1].replace("/", "-")
+    with METRICS.stage('components'):
+        components = graph.components()
+        summaries = graph.component_summaries(components)
+    edge_file = f'{clean_cat}_derivative_edges.tsv'
+    with open(edge_file, 'w', encoding ='utf8') as fp:
+        fp.write('component\tfile\tderivative\thop\n')
+        for source, derivative in graph.edges():
+            fp.write(f'{components[source]}\t{graph.titles[source]}\t'
+                     f'{graph.titles[derivative]}\t{graph.hops[derivative]}\n')
+    pywikibot.output(f'Data saved to {edge_file}')
+
+    component_file = f'{clean_cat}_derivative_components.json'
+    with open(component_file, 'w', encoding ='utf8') as fp:
+        json.dump(summaries, fp, indent=2, ensure_ascii=False)
+    pywikibot.output(f'Data saved to {component_file}')
+    print(f'There were {len(summaries)} connected components detected, the largest with '
+          f'{summaries[0]["files"] if summaries else 0} files')
+    return component_file
+
+def handle_args(argv=None):
+    """
+    Parse and handle command line arguments.
+
+    @param argv: arguments to parse. Defaults to sys.argv[1:].
+    """
+    parser = argparse.ArgumentParser(
+        description=('Attempt to identify derivative files by analysing which other files link '
+                     'to files in a Commons category.'))
+    parser.add_argument('-c', '--category', action='store', metavar='CAT', dest='cat_name',
+                        help=('Commons category to process (with or without Category:-prefix). '
+                              'Prompted for if not provided.'))
+    parser.add_argument('--graph', action='store_true',
+                        help=('also follow derivatives of derivatives, outputting an edge list '
+                              'and the connected components of the resulting graph'))
+    parser.add_argument('--depth', type=int, default=DEFAULT_DEPTH, action='store', metavar='N',
+                        help=f'maximum number of hops to follow in graph mode. Defaults to {DEFAULT_DEPTH}')
+    category_snapshot.add_arguments(parser)
+    metrics.add_arguments(parser)
+    args = parser.parse_args(argv)
+    if args.depth < 1:
+        parser.error('--depth must be at least 1')
+    return args
+
+def main():
+    """Command line entrypoint."""
+    args = handle_args()
+    category = args.cat_name or input('category name: ')
+    snapshot = category_snapshot.open_snapshot(args)
+    with metrics.profiled(args.profile):
+        if args.graph:
+            graph = build_derivative_graph(category, depth=args.depth, snapshot=snapshot)
+            with METRICS.stage('output'):
+                out_file = output_graph(category, graph)
+        else:
+            out_data = detect_derivatives(category, snapshot=snapshot)
+            with METRICS.stage('output'):
+                out_file = output_results(category, out_data)
+    metrics.export(out_file, 'deriv_detector', prometheus_file=args.prometheus)
+
+
+if __name__ == "__main__":
+    main()
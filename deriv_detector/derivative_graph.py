@@ -0,0 +1,170 @@
+"""Compact graph of files and the derivative files linking to them.
+
+Files are interned as integer ids, in the order they are discovered, and each edge is stored as a
+pair of ids in two integer arrays. Duplicate edges are only dropped once the graph is complete, by
+sorting the packed pairs, after which the derivatives of each file are indexed as a compressed
+sparse row (CSR) adjacency. This keeps the graph at a few bytes per edge, small enough for
+categories with hundreds of thousands of files, and makes it possible to find the connected
+components through a union-find over plain integer arrays.
+"""
+import sys
+from array import array
+from collections.abc import Iterable, Iterator
+
+import numpy as np
+
+
+class DerivativeGraph:
+    """Directed graph with an edge from each file to each file linking to it (its derivatives)."""
+
+    def __init__(self):
+        self.titles = []
+        self.ids = {}
+        self.hops = array('i')  # the lowest number of hops from the category to each file
+        self.sources = array('i')
+        self.derivatives = array('i')  # derivatives[i] links to sources[i]
+        # CSR index of the deduplicated edges, built by finalise()
+        self._offsets = None  # the derivatives of file n are _adjacent[_offsets[n]:_offsets[n + 1]]
+        self._adjacent = None
+
+    def __len__(self) -> int:
+        return len(self.titles)
+
+    def node(self, title: str, hop: int) -> int:
+        """Return the id of a file, adding it if it has not been seen before."""
+        node = self.ids.get(title)
+        if node is None:
+            node = len(self.titles)
+            self.ids[title] = node
+            self.titles.append(sys.intern(title))
+            self.hops.append(hop)
+        elif hop < self.hops[node]:
+            self.hops[node] = hop
+        return node
+
+    def add_derivatives(self, title: str, in_files: Iterable[str], hop: int) -> list[int]:
+        """Add the files linking to a file and return the ids of those not seen before.
+
+        @param hop: the number of hops from the category to the linking files.
+        """
+        self._offsets = self._adjacent = None
+        source = self.node(title, hop - 1)
+        new = []
+        for in_file in in_files:
+            size = len(self)
+            derivative = self.node(in_file, hop)
+            if derivative == source:
+                continue
+            if derivative == size:
+                new.append(derivative)
+            self.sources.append(source)
+            self.derivatives.append(derivative)
+        return new
+
+    def finalise(self) -> None:
+        """Drop any duplicate edges, keeping the first of each, and index the derivatives.
+
+        Called by the methods reading the edges, there is no need to call it directly.
+        """
+        if self._offsets is not None:
+            return
+        packed = np.frombuffer(self.sources, dtype=np.int32).astype(np.int64)
+        packed <<= 32
+        packed |= np.frombuffer(self.derivatives, dtype=np.int32)
+        # a stable sort puts the first of any duplicates first
+        order = np.argsort(packed, kind='stable')
+        ordered = packed[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = ordered[1:] != ordered[:-1]
+        del ordered
+        order = order[first]
+        order.sort()  # back in the order the edges were found
+        packed = packed[order]
+        del order
+        sources = (packed >> 32).astype(np.int32)
+        derivatives = (packed & 0xFFFFFFFF).astype(np.int32)
+        del packed
+        self.sources = array('i', sources.tobytes())
+        self.derivatives = array('i', derivatives.tobytes())
+
+        self._offsets = np.zeros(len(self) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=len(self)), out=self._offsets[1:])
+        self._adjacent = derivatives[np.argsort(sources, kind='stable')]
+
+    def edge_count(self) -> int:
+        """Return the number of distinct edges."""
+        self.finalise()
+        return len(self.sources)
+
+    def edges(self) -> Iterator[tuple[int, int]]:
+        """Yield the (file, derivative) id pair of each edge, in the order they were found."""
+        self.finalise()
+        return zip(self.sources, self.derivatives)
+
+    def derivatives_of(self, node: int) -> np.ndarray:
+        """Return the ids of the derivatives of a file, in the order they were found."""
+        self.finalise()
+        return self._adjacent[self._offsets[node]:self._offsets[node + 1]]
+
+    def out_degrees(self) -> np.ndarray:
+        """Return the number of direct derivatives of each file."""
+        self.finalise()
+        return np.diff(self._offsets)
+
+    def components(self) -> array:
+        """Return the id of the connected component of each file.
+
+        Components are numbered by decreasing size, ties broken by discovery order.
+        """
+        parent = array('i', range(len(self)))
+        size = array('i', [1]) * len(self)
+
+        def find(node: int) -> int:
+            while parent[node] != node:
+                parent[node] = parent[parent[node]]  # path halving
+                node = parent[node]
+            return node
+
+        for source, derivative in self.edges():
+            a, b = find(source), find(derivative)
+            if a == b:
+                continue
+            if size[a] < size[b]:
+                a, b = b, a
+            parent[b] = a
+            size[a] += size[b]
+
+        roots = [find(node) for node in range(len(self))]
+        order = sorted(set(roots), key=lambda root: (-size[root], root))
+        number = {root: i for i, root in enumerate(order)}
+        return array('i', (number[root] for root in roots))
+
+    def component_summaries(self, components: array = None) -> list[dict]:
+        """Summarise each connected component, in the order of the component ids.
+
+        The summaries hold the number of files and edges, how many of the files are in the
+        category itself, the largest number of hops from the category and the file with the most
+        direct derivatives.
+        """
+        components = components if components is not None else self.components()
+        summaries = [
+            {'component': i, 'files': 0, 'edges': 0, 'category_files': 0, 'max_hop': 0}
+            for i in range(max(components, default=-1) + 1)]
+        for node, component in enumerate(components):
+            summary = summaries[component]
+            summary['files'] += 1
+            summary['category_files'] += self.hops[node] == 0
+            summary['max_hop'] = max(summary['max_hop'], self.hops[node])
+
+        out_degree = self.out_degrees().tolist()
+        most_derived = {}
+        for source, derivative in self.edges():
+            component = components[source]
+            summaries[component]['edges'] += 1
+            best = most_derived.get(component)
+            if best is None or (out_degree[source], -source) > (out_degree[best], -best):
+                most_derived[component] = source
+        for component, node in most_derived.items():
+            summaries[component]['most_derived'] = self.titles[node]
+            summaries[component]['derivatives'] = out_degree[node]
+        return summaries
@@ -0,0 +1,121 @@
+"""Benchmark streaming against loading the whole of large synthetic commons-diff outputs.
+
+For each size a commons-diff style file with that many results is generated, and the statistics
+are then computed in a separate process using either json.load (as get_diff_stats.py used to) or
+the streaming reader, reporting the time taken and the peak memory of each.
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from get_diff_stats import analyse_data
+from json_stream import JSONStreamReader
+
+LANGUAGES = ('sv', 'en', 'de', 'fi', 'nb', 'da')
+
+
+def synthetic_result(i: int, rng: random.Random) -> dict:
+    """Generate a single commons-diff result, changed in varying ways."""
+    description = f'{{{{sv|Fotografi {i} ur Nordiska museets samlingar}}}}'
+    changed_description = rng.random() < 0.01
+    return {
+        'baseline_revision': str(760000000 + i),
+        'captions': {
+            'added': [{rng.choice(LANGUAGES): f'Bildtext {i}'}] if rng.random() < 0.05 else [],
+            'removed': []
+        },
+        'categories': {
+            'added': [f'Category:Kategori {rng.randrange(1000)}']
+            if rng.random() < 0.25 else [],
+            'removed': []
+        },
+        'description': {
+            'changed': changed_description,
+            'new': description + (' (ändrad)' if changed_description else ''),
+            'old': description
+        },
+        'filename': f'File:Fotografi {i} - Nordiska museet - NMA.{i:07d}.tif',
+        'statements': {
+            'added': [['P180', f'Q{rng.randrange(10 ** 6)}']] if rng.random() < 0.01 else [],
+            'removed': []
+        },
+        'uploaded': '2023-05-10T16:43:52Z'
+    }
+
+
+def write_synthetic(path: str, results: int, seed: int = 0) -> None:
+    """Write a commons-diff style file with the given number of results, one at a time."""
+    rng = random.Random(seed)
+    with open(path, 'w', encoding='utf8') as fp:
+        fp.write('{\n    "config": {"relevant_sdc": ["P180"]},\n')
+        fp.write(f'    "meta": {json.dumps({"files": results, "source": "synthetic"})},\n')
+        fp.write('    "results": [\n')
+        for i in range(results):
+            if i:
+                fp.write(',\n')
+            fp.write(json.dumps(synthetic_result(i, rng), indent=4, ensure_ascii=False))
+        fp.write('\n    ]\n}\n')
+
+
+def run(mode: str, path: str) -> None:
+    """Compute the statistics of a file and print them, with the time taken and peak memory."""
+    start = time.perf_counter()
+    with open(path, encoding='utf8') as fp:
+        if mode == 'load':
+            data = json.load(fp)
+            meta, stats = data.get('meta'), analyse_data(data.get('results'))
+        else:
+            for key, value in JSONStreamReader(fp).items(stream=['results']):
+                if key == 'meta':
+                    meta = value
+                elif key == 'results':
+                    stats = analyse_data(value)
+    print(json.dumps({
+        'seconds': time.perf_counter() - start,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'meta': meta,
+        'stats': stats}))
+
+
+def measure(mode: str, path: str) -> dict:
+    """Run a single mode in a fresh process, so that its peak memory is measured on its own."""
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--run', mode, path],
+        check=True, capture_output=True, text=True).stdout
+    return json.loads(output)
+
+
+def main() -> None:
+    """Command line entrypoint."""
+    parser = argparse.ArgumentParser(description=__doc__.partition('\n')[0])
+    parser.add_argument('sizes', nargs='*', type=int, default=[10000, 100000, 500000],
+                        metavar='N', help='numbers of results to benchmark')
+    parser.add_argument('--run', nargs=2, metavar=('MODE', 'PATH'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run:
+        run(*args.run)
+        return
+
+    print('results\tsize_mb\tload_s\tload_mb\tstream_s\tstream_mb')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in args.sizes:
+            path = os.path.join(tmp_dir, f'diff_{size}.json')
+            write_synthetic(path, size)
+            load = measure('load', path)
+            stream = measure('stream', path)
+            if (load['stats'], load['meta']) != (stream['stats'], stream['meta']):
+                print(f'{size}: outputs differ!')
+            print(f'{size}\t{os.path.getsize(path) / 2 ** 20:.0f}\t'
+                  f'{load["seconds"]:.1f}\t{load["peak_rss_kb"] / 1024:.0f}\t'
+                  f'{stream["seconds"]:.1f}\t{stream["peak_rss_kb"] / 1024:.0f}')
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
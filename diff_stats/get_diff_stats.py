@@ -1,5 +1,26 @@
-"""Takes a commons-diff output file and outputs some statistics."""
+"""Takes one or more commons-diff output files and outputs some statistics.
+
+The results are streamed from the file one at a time, so memory use does not grow with the size
+of the commons-diff output.
+
+Multiple files are analysed in parallel, each worker returning partial statistics which are then
+merged into combined statistics for all of the files.
+"""
+import argparse
+import glob
 import json
+import os
+import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from json_stream import JSONStreamReader
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common import metrics  # noqa: E402
+from common.metrics import METRICS  # noqa: E402
+
+DEFAULT_COMBINED = 'combined_stats.json'
 
 def check_changes(d, key, stats_data):
     key_data = d.get(key)
@@ -9,21 +30,29 @@ def check_changes(d, key, stats_data):
     return False
 
 def analyse_data(data):
-    stats = {
+    return finalise_stats(analyse_partial(data))
+
+def analyse_partial(data):
+    """Analyse the results of a commons-diff output, returning mergeable partial stats."""
+    stats = Counter({
         'changed': 0,
         'captions': 0,
         'categories': 0,
         'descriptions': 0,  # counts if changed, not number of additions
         'statements': 0,
         'all': 0
-    }
+    })
 
     languages = set()
+    captions_by_language = Counter()
+    statements_by_property = Counter()
     for d in data:
         stats['all'] += 1
         change = False
         change = change or check_changes(d, 'captions', stats)
         change = change or check_changes(d, 'categories', stats)
+        # statements are only counted, also by property, for files without any other changes
+        count_statements = not change
         change = change or check_changes(d, 'statements', stats)
 
         if d.get('description').get('changed'):
@@ -36,8 +65,33 @@ def analyse_data(data):
         # check added caption languages
         added_captions = d.get('captions').get('added')
         languages.update([list(val.keys())[0] for val in added_captions])
+        captions_by_language.update([list(val.keys())[0] for val in added_captions])
+        if count_statements:
+            statements_by_property.update([val[0] for val in d.get('statements').get('added')])
+
+    return {
+        'stats': stats,
+        'languages': languages,
+        'captions_by_language': captions_by_language,
+        'statements_by_property': statements_by_property
+    }
 
-    stats['caption_languages'] = len(languages)
+def merge_partials(partials):
+    """Merge the partial stats of several commons-diff outputs."""
+    merged = analyse_partial([])
+    for partial in partials:
+        merged['stats'].update(partial['stats'])
+        merged['languages'].update(partial['languages'])
+        merged['captions_by_language'].update(partial['captions_by_language'])
+        merged['statements_by_property'].update(partial['statements_by_property'])
+    return merged
+
+def finalise_stats(partial):
+    """Turn partial stats into the outputted stats."""
+    stats = dict(partial['stats'])
+    stats['caption_languages'] = len(partial['languages'])
+    stats['added_captions_by_language'] = dict(partial['captions_by_language'])
+    stats['added_statements_by_property'] = dict(partial['statements_by_property'])
     return stats
 
 def output_stats(stats, filename, meta):
@@ -46,17 +100,113 @@ def output_stats(stats, filename, meta):
     with open(outfile, 'w', encoding ='utf8') as fp:
         json.dump(data, fp, sort_keys=True, indent=2, ensure_ascii=False)
     print(f'Outputted stats to {outfile}')
+    return outfile
 
-def process_output(filename):
-    results = None
+def analyse_file(filename):
+    """Return the meta data and the partial stats of a commons-diff output file."""
+    meta = None
+    partial = None
 
     with open(filename, encoding='utf8') as f:
-        results = json.load(f)
+        for key, value in JSONStreamReader(f).items(stream=['results']):
+            if key == 'meta':
+                meta = value
+            elif key == 'results':
+                partial = analyse_partial(value)
+
+    return meta, partial
+
+def skip_input(filename):
+    print(f'Skipping {filename}, which has no commons-diff results.')
+
+def process_output(filename):
+    with METRICS.stage('analyse'):
+        meta, partial = analyse_file(filename)
+    if partial is None:
+        skip_input(filename)
+        return None
+    with METRICS.stage('output'):
+        return output_stats(finalise_stats(partial), filename, meta)
+
+def process_outputs(filenames, combined_file=DEFAULT_COMBINED, workers=None):
+    """Analyse several commons-diff output files in parallel.
+
+    Stats are outputted for each file as well as combined for all of them. Files without any
+    results, e.g. other outputs matched by a glob pattern, are skipped.
+    """
+    with METRICS.stage('analyse'), ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(analyse_file, filenames))
+    analysed = []
+    for filename, (meta, partial) in zip(filenames, results):
+        if partial is None:
+            skip_input(filename)
+        else:
+            analysed.append((filename, meta, partial))
+    if not analysed:
+        return None
+
+    with METRICS.stage('output'):
+        for filename, meta, partial in analysed:
+            output_stats(finalise_stats(partial), filename, meta)
+
+        combined = merge_partials(partial for _, _, partial in analysed)
+        data = {
+            'meta': {filename: meta for filename, meta, _ in analysed},
+            'stats': finalise_stats(combined)
+        }
+        with open(combined_file, 'w', encoding ='utf8') as fp:
+            json.dump(data, fp, sort_keys=True, indent=2, ensure_ascii=False)
+    print(f'Outputted combined stats to {combined_file}')
+    return combined_file
+
+def expand_inputs(inputs):
+    """Expand any glob patterns among the inputs, skipping earlier stats and metrics outputs."""
+    filenames = []
+    for pattern in inputs:
+        matches = sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern]
+        filenames.extend(
+            match for match in matches
+            if not match.endswith(('_stats.json', '_metrics.json')) and match not in filenames)
+    return filenames
+
+def handle_args(argv=None):
+    """
+    Parse and handle command line arguments.
+
+    @param argv: arguments to parse. Defaults to sys.argv[1:].
+    """
+    parser = argparse.ArgumentParser(
+        description='Extract some statistics from commons-diff output files.')
+    parser.add_argument('inputs', nargs='*', metavar='PATH',
+                        help=('commons-diff output files or glob patterns. Prompted for a single '
+                              'file if not provided.'))
+    parser.add_argument('-w', '--workers', type=int, action='store', metavar='N',
+                        help=('number of processes to use for multiple files. '
+                              'Defaults to one per CPU'))
+    parser.add_argument('--combined', action='store', metavar='PATH', default=DEFAULT_COMBINED,
+                        help=('output file for the combined stats of multiple files. '
+                              f'Defaults to {{cwd}}/{DEFAULT_COMBINED}'))
+    metrics.add_arguments(parser)
+    return parser.parse_args(argv)
 
-    meta = results.get('meta')
-    stats = analyse_data(results.get('results'))
-    output_stats(stats, filename, meta)
+def main():
+    """Command line entrypoint."""
+    args = handle_args()
+    filenames = expand_inputs(args.inputs)
+    if not args.inputs:
+        filenames = [input('path to output file: ')]
+    elif not filenames:
+        print(f'No files matched {" ".join(args.inputs)}')
+        return
+    with metrics.profiled(args.profile):
+        if len(filenames) == 1:
+            out_file = process_output(filenames[0])
+        else:
+            out_file = process_outputs(
+                filenames, combined_file=args.combined, workers=args.workers)
+    if out_file:
+        metrics.export(out_file, 'get_diff_stats', prometheus_file=args.prometheus)
 
 
-input_file = input('path to output file: ')
-process_output(input_file)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Incremental reading of large JSON documents.
+
+Only the top-level object is parsed by hand. Each of its values is decoded as a whole through the
+standard library decoder, except for the selected arrays which are instead yielded one element at
+a time. Only a chunk of the file, plus the element being decoded, is kept in memory at any time,
+however large the array is.
+"""
+import json
+from collections.abc import Iterable, Iterator
+from typing import Any, TextIO
+
+CHUNK_SIZE = 1 << 16  # characters
+WHITESPACE = ' \t\n\r'
+NUMBER_CHARS = '0123456789+-.eE'
+
+
+class JSONStreamReader:
+    """Read a JSON object from a file, streaming the elements of selected arrays."""
+
+    def __init__(self, fp: TextIO, chunk_size: int = CHUNK_SIZE):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _read(self, size: int) -> bool:
+        """Append up to size characters from the file to the buffer, return whether any were."""
+        if self.eof:
+            return False
+        if self.pos > self.chunk_size:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        chunk = self.fp.read(size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf += chunk
+        return True
+
+    def _peek(self) -> str:
+        """Skip any whitespace and return the next character, or '' at the end of the file."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf) or not self._read(self.chunk_size):
+                return self.buf[self.pos:self.pos + 1]
+
+    def _expect(self, chars: str) -> str:
+        """Consume and return the next character, which must be one of the given ones."""
+        char = self._peek()
+        if not char or char not in chars:
+            raise json.JSONDecodeError(
+                f'Expecting one of {chars!r}', self.buf, self.pos)
+        self.pos += 1
+        return char
+
+    def _decode(self) -> Any:
+        """Decode the next value, reading more of the file until it is complete."""
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                # grow the read geometrically so that large values are decoded in linear time
+                if self._read(max(self.chunk_size, len(self.buf) - self.pos)):
+                    continue
+                raise
+            # a number at the end of the buffer may continue in the next chunk
+            if (isinstance(value, (int, float))
+                    and not self.buf[end:end + 64].lstrip(NUMBER_CHARS)
+                    and self._read(self.chunk_size)):
+                continue
+            self.pos = end
+            return value
+
+    def _iter_array(self) -> Iterator[Any]:
+        """Yield each element of the array starting at the current position."""
+        self._expect('[')
+        if self._peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self._decode()
+            if self._expect(',]') == ']':
+                return
+
+    def items(self, stream: Iterable[str] = ()) -> Iterator[tuple[str, Any]]:
+        """Yield the key and value of each member of the top-level object.
+
+        @param stream: keys whose (array) values are yielded as an iterator over the elements,
+            rather than as a list. The iterator is valid until the next member is requested,
+            any elements not consumed by then are skipped.
+        """
+        stream = set(stream)
+        self._expect('{')
+        if self._peek() == '}':
+            self.pos += 1
+            return
+        while True:
+            key = self._decode()
+            self._expect(':')
+            if key in stream and self._peek() == '[':
+                elements = self._iter_array()
+                yield key, elements
+                for _ in elements:
+                    pass
+            else:
+                yield key, self._decode()
+            if self._expect(',}') == '}':
+                return
@@ -1,35 +1,206 @@
 # List creation times for all files in a category
+import argparse
+import os
+import sys
 from collections import Counter
+from datetime import date
+
 import pywikibot
 from tqdm import tqdm
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common import action_api, category_snapshot, http_client, metrics  # noqa: E402
+from common.metrics import METRICS  # noqa: E402
+
+HEADERS = {
+    'User-Agent': 'files_by_month.py/1.0 (https://github.com/Wikimedia-Sverige/nordiska-2022)'
+}
+# all upload timestamps of each file, these are returned newest first
+UPLOAD_PARAMS = {'prop': 'imageinfo', 'iiprop': 'timestamp', 'iilimit': 'max'}
+GRANULARITIES = ('day', 'week', 'month')
+# the time the latest file was added to the category, and the page ids of files added at that time
+MARK_PREFIX = '# High-water mark: '
+
+
+def get_creation_times(s, category_name=None, pageids=None, snapshot=None):
+    """Yield the timestamp of the first upload of each file in the category, or of each page id.
+
+    @param snapshot: snapshot to read the files of the category from, see category_snapshot.
+    """
+    if pageids is not None:
+        file_pages = action_api.pageids_pages(s, pageids, prop_params=UPLOAD_PARAMS)
+    elif snapshot:
+        file_pages = snapshot.category_files(s, category_name, prop_params=UPLOAD_PARAMS)
+    else:
+        file_pages = action_api.category_files(s, category_name, prop_params=UPLOAD_PARAMS)
+    for file_page in file_pages:
+        uploads = file_page.get('imageinfo')
+        if not uploads:
+            pywikibot.warning(f'No upload found for {file_page.get("title")}')
+            continue
+        yield min(upload.get('timestamp') for upload in uploads)
 
-def get_creation_month(fp):
-    creation_time = fp.oldest_revision.timestamp
-    return creation_time.isoformat().rpartition('-')[0]
+def get_high_water_mark(s, category_name):
+    """Return the time the latest file was added to the category, with the files added then."""
+    params = {
+        'list': 'categorymembers', 'cmtitle': action_api.category_title(category_name),
+        'cmtype': 'file', 'cmprop': 'ids|timestamp', 'cmsort': 'timestamp', 'cmdir': 'older',
+        'cmlimit': 'max'}
+    data = action_api.api_request(s, {'action': 'query', **params})
+    members = data.get('query', {}).get('categorymembers', [])
+    if not members:
+        return None
+    return update_mark(None, members)
 
-def output_results(cat, months):
+def get_new_members(s, category_name, mark):
+    """Yield each file added to the category since the high-water mark, in the order added.
+
+    The files added at the very time of the mark were already counted and are skipped.
+    """
+    timestamp, pageids = mark
+    params = {
+        'list': 'categorymembers', 'cmtitle': action_api.category_title(category_name),
+        'cmtype': 'file', 'cmprop': 'ids|timestamp', 'cmsort': 'timestamp', 'cmdir': 'newer',
+        'cmstart': timestamp, 'cmlimit': 'max'}
+    for data in action_api.query(s, params):
+        for member in data.get('query', {}).get('categorymembers', []):
+            if member.get('timestamp') == timestamp and member.get('pageid') in pageids:
+                continue
+            yield member
+
+def update_mark(mark, members):
+    """Return the high-water mark after the given category members, ordered by time added."""
+    for member in members:
+        if mark and member.get('timestamp') == mark[0]:
+            mark = (mark[0], mark[1] | {member.get('pageid')})
+        elif not mark or member.get('timestamp') > mark[0]:
+            mark = (member.get('timestamp'), {member.get('pageid')})
+    return mark
+
+def get_period(timestamp, granularity='month'):
+    """Return the day (YYYY-MM-DD), ISO week (YYYY-Www) or month (YYYY-MM) of a timestamp."""
+    if granularity == 'day':
+        return timestamp[:10]
+    if granularity == 'week':
+        year, week, _ = date.fromisoformat(timestamp[:10]).isocalendar()
+        return f'{year}-W{week:02d}'
+    return timestamp[:7]
+
+def get_out_file(cat, granularity='month'):
     clean_cat = cat.replace(' ','_').split(':')[-1]
-    out_file = f'{clean_cat.replace("/", "-")}_file_count.tsv'
+    suffix = '' if granularity == 'month' else f'_by_{granularity}'
+    return f'{clean_cat.replace("/", "-")}_file_count{suffix}.tsv'
+
+def read_results(out_file):
+    """Return the granularity, the new files per period and the high-water mark of an output."""
+    periods = Counter()
+    mark = None
+    granularity = None
+    with open(out_file, encoding='utf8') as fp:
+        for line in fp:
+            line = line.rstrip('\n')
+            if line.startswith(MARK_PREFIX):
+                timestamp, _, pageids = line[len(MARK_PREFIX):].partition(' ')
+                mark = (timestamp, {int(pageid) for pageid in pageids.split(',') if pageid})
+            elif line.startswith('#'):
+                continue
+            elif granularity is None:
+                granularity = line.partition('\t')[0]
+            elif line:
+                period, _, count = line.partition('\t')
+                periods[period] = int(count)
+    return granularity, periods, mark
+
+def output_results(cat, periods, granularity='month', mark=None):
+    clean_cat = cat.replace(' ','_').split(':')[-1]
+    out_file = get_out_file(cat, granularity)
     with open(out_file, 'w', encoding ='utf8') as fp:
         fp.write(f'# File count for {clean_cat}\n')
-        fp.write('month\tnew_files\n')
-        for month, count in sorted(months.items()):
-            fp.write(f'{month}\t{count}\n')
+        if mark:
+            pageids = ','.join(str(pageid) for pageid in sorted(mark[1]))
+            fp.write(f'{MARK_PREFIX}{mark[0]} {pageids}\n')
+        fp.write(f'{granularity}\tnew_files\n')
+        for period, count in sorted(periods.items()):
+            fp.write(f'{period}\t{count}\n')
 
     pywikibot.output(f'Data saved to {out_file}')
 
-def count_new_files_by_month(category_name):
-    site = pywikibot.Site('commons', 'commons')
-    cat = pywikibot.Category(site, category_name)
-    months = Counter()
+def count_new_files(category_name, granularity='month', snapshot=None):
+    s = http_client.make_session(HEADERS)
+    periods = Counter()
+
+    # taken before the scan, files added during it may then be counted twice but are never missed
+    mark = get_high_water_mark(s, category_name)
+    if snapshot:
+        # a snapshot older than the latest addition to the category is taken anew
+        total = snapshot.file_count(s, category_name, since=mark[0] if mark else None)
+    else:
+        total = action_api.category_file_count(s, category_name)
+    for timestamp in METRICS.timed(tqdm(get_creation_times(s, category_name, snapshot=snapshot), desc="Processing category members", total=total), 'enumerate'):
+        periods[get_period(timestamp, granularity)] += 1
+
+    pywikibot.output(f'Made {action_api.REQUEST_COUNTS["action"]} Action API requests.')
+    return periods, mark
+
+def update_new_files(category_name, periods, mark, granularity='month'):
+    """Add the files added to the category since the high-water mark of a previous run.
+
+    Files removed from the category since then are not subtracted.
+    """
+    s = http_client.make_session(HEADERS)
+
+    members = list(METRICS.timed(get_new_members(s, category_name, mark), 'enumerate'))
+    pageids = [member.get('pageid') for member in members]
+    for timestamp in METRICS.timed(tqdm(get_creation_times(s, pageids=pageids), desc="Processing new category members", total=len(pageids)), 'enumerate'):
+        periods[get_period(timestamp, granularity)] += 1
+
+    pywikibot.output(f'Added {len(pageids)} files since {mark[0]}.')
+    pywikibot.output(f'Made {action_api.REQUEST_COUNTS["action"]} Action API requests.')
+    return periods, update_mark(mark, members)
+
+def handle_args(argv=None):
+    """
+    Parse and handle command line arguments.
 
-    for file_page in tqdm(cat.members(member_type=['file']), desc="Processing category members", total=cat.categoryinfo.get('files')):
-        months[get_creation_month(file_page)] += 1
+    @param argv: arguments to parse. Defaults to sys.argv[1:].
+    """
+    parser = argparse.ArgumentParser(
+        description=('Show the growth of a Commons category of files by analysing the upload '
+                     'dates of its files.'))
+    parser.add_argument('-c', '--category', action='store', metavar='CAT', dest='cat_name',
+                        help=('Commons category to process (with or without Category:-prefix). '
+                              'Prompted for if not provided.'))
+    parser.add_argument('-g', '--granularity', choices=GRANULARITIES, default='month',
+                        help='period to count new files per. Defaults to month')
+    parser.add_argument('-u', '--update', action='store_true',
+                        help=('only count the files added since the previous run, merging them '
+                              'into its output'))
+    category_snapshot.add_arguments(parser)
+    metrics.add_arguments(parser)
+    return parser.parse_args(argv)
 
-    return months
+def main():
+    """Command line entrypoint."""
+    args = handle_args()
+    category = args.cat_name or input('category name: ')
+    out_file = get_out_file(category, args.granularity)
+    with metrics.profiled(args.profile):
+        if args.update and os.path.exists(out_file):
+            granularity, periods, mark = read_results(out_file)
+            if granularity != args.granularity or not mark:
+                pywikibot.error(
+                    f'{out_file} is not a {args.granularity} count with a high-water mark, '
+                    'run once without --update first.')
+                return
+            out_data, mark = update_new_files(category, periods, mark, granularity=granularity)
+        else:
+            out_data, mark = count_new_files(
+                category, granularity=args.granularity,
+                snapshot=category_snapshot.open_snapshot(args))
+        with METRICS.stage('output'):
+            output_results(category, out_data, granularity=args.granularity, mark=mark)
+    metrics.export(out_file, 'files_by_month', prometheus_file=args.prometheus)
 
 
-category = input('category name: ')
-out_data = count_new_files_by_month(category)
-output_results(category, out_data)
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Newline delimited JSON checkpoints of per-file media requests.
+
+Each processed file is appended to the checkpoint as soon as its result arrives, either with the
+items returned by the REST-API or with the code of the error which made it be skipped. The first
+line holds the parameters of the run, which must match for a run to be resumed.
+
+Outputs are built by streaming over the checkpoint so that nothing needs to be kept in memory
+while fetching.
+"""
+import json
+import os
+from collections import Counter
+from collections.abc import Iterator
+from typing import TextIO
+
+META_KEY = '_meta'
+
+
+class CheckpointMismatch(ValueError):
+    """Raised when resuming from a checkpoint made with different parameters."""
+
+
+def read_meta(path: str) -> dict:
+    """Return the run parameters stored in a checkpoint."""
+    with open(path, encoding='utf8') as fp:
+        return json.loads(fp.readline()).get(META_KEY)
+
+
+def iter_checkpoint(path: str) -> Iterator[dict]:
+    """Yield each file record in a checkpoint.
+
+    A truncated last line, e.g. due to the run being killed mid-write, is ignored.
+    """
+    with open(path, encoding='utf8') as fp:
+        fp.readline()  # meta
+        for line in fp:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                if line.endswith('\n'):
+                    raise
+
+
+def open_checkpoint(path: str, meta: dict, resume: bool = False) -> tuple[TextIO, set]:
+    """Open a checkpoint for appending and return it together with the already done titles.
+
+    Unless resuming, any existing checkpoint at the path is replaced.
+    """
+    done = set()
+    if resume and os.path.exists(path):
+        stored_meta = read_meta(path)
+        if stored_meta != meta:
+            raise CheckpointMismatch(
+                f'Checkpoint {path} was made for {stored_meta}, not {meta}.')
+        done = {record.get('title') for record in iter_checkpoint(path)}
+        _drop_partial_line(path)
+        return open(path, 'a', encoding='utf8'), done
+
+    if os.path.split(path)[0]:
+        os.makedirs(os.path.split(path)[0], exist_ok=True)
+    fp = open(path, 'w', encoding='utf8')
+    write_record(fp, {META_KEY: meta})
+    return fp, done
+
+
+def _drop_partial_line(path: str) -> None:
+    """Truncate the checkpoint after its last complete line."""
+    with open(path, 'rb+') as fp:
+        data = fp.read()
+        if data and not data.endswith(b'\n'):
+            fp.truncate(data.rfind(b'\n') + 1)
+
+
+def write_record(fp: TextIO, record: dict) -> None:
+    """Append a single record to the checkpoint and flush it to the operating system.
+
+    This is enough for the record to survive the run being interrupted or killed. It is not
+    synced to the disk, which would cost a write to the disk per file, so a crash of the machine
+    itself may lose the last records.
+    """
+    fp.write(json.dumps(record, ensure_ascii=False) + '\n')
+    fp.flush()
+
+
+def per_time_totals(path: str) -> dict:
+    """Return the total media views and number of viewed files per timestamp.
+
+    This only keeps one counter per timestamp in memory, whatever the size of the checkpoint.
+    """
+    totals = Counter()
+    viewed = Counter()
+    for record in iter_checkpoint(path):
+        for unit in record.get('items', []):
+            datestamp = unit.get('timestamp')[:-2]
+            totals[datestamp] += unit.get('requests')
+            viewed[datestamp] += 1
+    return {datestamp: (totals[datestamp], viewed[datestamp]) for datestamp in sorted(totals)}
+
+
+def csv_datestamp(timestamp: str, daily: bool = False) -> str:
+    """Return the date column of the csv of timeseries_to_csv.py for a timestamp.
+
+    Any timestamp starting with YYYYMMDD is accepted. Months are given as YYYYMM and days as
+    YYYYMMDD.
+    """
+    return timestamp[:8] if daily else timestamp[:6]
@@ -3,62 +3,151 @@
 Returns only human views.
 
 Limitations:
-* Does a Rest-API call per file (and one to the Action API).
+* Does a Rest-API call per file (file urls are fetched in batches from the Action API). Use
+  --workers to make several of these concurrently, or --dumps to avoid them altogether. The
+  requests are still capped at --rate per second, however many workers are used.
 * If the time span includes the current month the results will likely be partial.
+  When using --cache such months are always fetched again on the next run.
 * Assumes a file has always been a member of the category if it is a member of it today.
+* Each file is written to a checkpoint as soon as it has been processed. If a run is interrupted
+  it can be continued with --resume.
 * The statistics only go back to 2015.
+
+With --dumps the media requests are instead read from local copies of the daily mediacounts dumps,
+in a single pass over the dumps for the whole category, see mediacounts.py. These count the
+requests of all agents, not only human views.
+
+With --snapshot the files of the category are read from a snapshot shared with the other scripts,
+see common/category_snapshot.py.
+
+With --cache the fetched media requests are also kept, together with the categories each file was
+found in, so that other date ranges or subcategories can later be output by query_store.py without
+any new requests.
+
+Timings, request latencies and counts of the run are written next to the output, see
+common/metrics.py.
 """
 import argparse
 import json
 import urllib.parse
 import os
-from collections.abc import Iterator
+import sys
+from collections import defaultdict, deque
+from collections.abc import Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from datetime import date
+from functools import partial
 
 import pywikibot
 import requests
-from requests.adapters import HTTPAdapter, Retry
 from pywikibot.exceptions import APIError
 from tqdm import tqdm
 
+from checkpoint import iter_checkpoint, open_checkpoint, write_record
+from media_stats import MediaStats
+from mediacounts import dump_media_requests
+from request_cache import MediaRequestsCache, buckets_in_range
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common import action_api, category_snapshot, http_client, metrics  # noqa: E402
+from common.category_snapshot import CategorySnapshot  # noqa: E402
+from common.metrics import METRICS  # noqa: E402
+
 DEFAULT_OUTPUT = 'stats_output.json'
+DEFAULT_CHECKPOINT = 'stats_output.ndjson'
+REST_API = 'https://wikimedia.org/api/rest_v1'
 HEADERS = {
     'User-Agent': 'get_media_views.py/1.0 (https://gist.github.com/lokal-profil/4a807aaf56e6af8171df5d8cfb8950b2; {})'
 }
-RETRIES = Retry(total=5, backoff_factor=0.1)
+DEFAULT_RATE = 100  # the documented limit of the Wikimedia REST-API
 
 
 def get_cat_media_views(
         cat_name: str, start: str, end: str, limit: int = None, recursion: int = 0,
-        output_type: str = 'file', debug: bool = False) -> dict:
-    """Command line entrypoint."""
-    commons = pywikibot.Site('commons', 'commons')
-    #cat_name = "100 000 Bildminnen"
-    category = pywikibot.Category(commons, cat_name)
-    files = get_cat_members(category, recurse=recursion, limit=limit)
-    stats = {}
+        output_type: str = 'file', workers: int = 1, rate: float = DEFAULT_RATE,
+        cache_file: str = None, top: int = 10, checkpoint_file: str = DEFAULT_CHECKPOINT,
+        resume: bool = False, dump_dir: str = None, snapshot: CategorySnapshot = None,
+        debug: bool = False) -> dict:
+    """Command line entrypoint.
 
+    @param workers: number of concurrent requests to the REST-API, or of dumps read in parallel.
+        Also the number of categories walked concurrently when recursing.
+    @param rate: maximum number of requests per second to each API, across all workers. Lowered
+        automatically if the servers ask us to back off.
+    @param cache_file: path to a cache of previously fetched media requests.
+    @param top: number of most viewed files to include in the summary output.
+    @param checkpoint_file: path of the checkpoint to which each file is written as processed.
+    @param resume: continue from the checkpoint instead of starting over.
+    @param dump_dir: directory of mediacounts dumps to read instead of using the REST-API.
+    @param snapshot: snapshot to read the category members from instead of the Action API.
+    """
     # Run connection through a session to limit hammering
-    s = requests.Session()
-    s.mount(
-        'https://wikimedia.org',
-        HTTPAdapter(max_retries=RETRIES))
-    s.headers.update(HEADERS)
-
-    for file_page in files:
-        freq = 'daily' if output_type == 'day' else 'monthly'
-        try:
-            file_stats = get_media_requests(s, file_page, start, end, frequency=freq, debug=debug)
-        except APIError as error:
-            if error.code == "999":
-                if debug:
+    s = http_client.make_session(
+        HEADERS, pool_maxsize=max(workers, http_client.DEFAULT_POOL_SIZE), rate=rate)
+    cache = MediaRequestsCache(cache_file) if cache_file else None
+
+    #cat_name = "100 000 Bildminnen"
+    members = defaultdict(list) if cache else None
+    files = METRICS.timed(
+        get_cat_members(
+            s, cat_name, recurse=recursion, limit=limit, members=members, snapshot=snapshot,
+            workers=workers),
+        'enumerate')
+    freq = 'daily' if output_type == 'day' else 'monthly'
+    run_meta = {'cat_name': cat_name, 'recurse': recursion, 'start': start, 'end': end,
+                'frequency': freq}
+    if dump_dir:
+        run_meta['agent'] = 'all-agents'
+    checkpoint, done = open_checkpoint(checkpoint_file, run_meta, resume=resume)
+    if done:
+        pywikibot.output(f'Resuming after {len(done)} already processed files.')
+        files = (file for file in files if file.title not in done)
+
+    if dump_dir:
+        fetched = read_media_requests(
+            files, start, end, dump_dir, frequency=freq, workers=workers)
+    else:
+        fetched = fetch_media_requests(
+            s, files, start, end, frequency=freq, workers=workers, cache=cache, debug=debug)
+    with closing(fetched):
+        for file, get_result in fetched:
+            try:
+                with METRICS.stage('fetch'):
+                    file_stats = get_result()
+            except APIError as error:
+                if error.code == "999":
+                    if debug:
+                        pywikibot.output(f"{error.info}")
+                    METRICS.count('skipped', reason=error.code)
+                    write_record(
+                        checkpoint, {'title': file.title, 'skipped': error.code})
+                    continue
+                else:
                     pywikibot.output(f"{error.info}")
-                continue
-            else:
-                pywikibot.output(f"{error.info}")
-                exit()
-        stats[file_page.title()] = file_stats
-    if not stats:
+                    pywikibot.output(f'Rerun with --resume to continue from {checkpoint_file}.')
+                    raise
+            with METRICS.stage('checkpoint'):
+                write_record(
+                    checkpoint, {'title': file.title, 'items': file_stats.get('items')})
+    checkpoint.close()
+    if cache:
+        for category, category_files in members.items():
+            cache.add_members(category, category_files, replace=not limit)
+        cache.close()
+        for result in ('hit', 'partial', 'miss'):
+            METRICS.count('cache', cache.stats[result], result=result)
+        pywikibot.output(
+            f'Cache: {cache.stats["hit"]} hits, {cache.stats["partial"]} partial hits '
+            f'and {cache.stats["miss"]} misses.')
+    pywikibot.output(
+        f'Made {action_api.REQUEST_COUNTS["action"]} Action API and '
+        f'{action_api.REQUEST_COUNTS["rest"]} REST-API requests.')
+
+    with METRICS.stage('collate'):
+        stats = collate_checkpoint(
+            checkpoint_file, output_type, buckets_in_range(start, end, freq))
+    if not len(stats):
         # e.g. empty category or all entries resulting in 999 errors
         pywikibot.output('Found no stats for the category.')
         exit()
@@ -66,15 +155,31 @@ def get_cat_media_views(
         pywikibot.output(f'Found stats for {len(stats)} files.')
 
     if output_type == 'file':
-        return {  # filename: total_media_views
-            k: sum([vv.get('requests') for vv in v.get('items')]) for k, v in stats.items()
-        }
+        return stats.per_file()  # filename: total_media_views
     elif output_type in ('month', 'day'):
-        return per_time_stats(stats)
+        return stats.per_time()
+    elif output_type == 'summary':
+        return stats.summary(top=top)
     else:
         return stats
 
 
+def collate_checkpoint(path: str, output_type: str, buckets: tuple = ()) -> dict | MediaStats:
+    """Stream over a checkpoint and collect the results of all files with media requests.
+
+    Apart from the raw output everything is collated from the compact matrix.
+    """
+    stats = {} if output_type == 'raw' else MediaStats(buckets)
+    for record in iter_checkpoint(path):
+        if 'items' not in record:
+            continue  # skipped file
+        if output_type == 'raw':
+            stats[record.get('title')] = {'items': record.get('items')}
+        else:
+            stats.add(record.get('title'), record.get('items'))
+    return stats
+
+
 def per_time_stats(stats: dict) -> dict:
     """Collate the statistics per unit of time.
     
@@ -86,58 +191,213 @@ def per_time_stats(stats: dict) -> dict:
         }
     }
     """
-    time_stats = {}
-    for value in stats.values():
-        for unit in value.get('items'):
-            datestamp = unit.get('timestamp')[:-2]
-            if datestamp not in time_stats:
-                time_stats[datestamp] = {'total': 0, "items": []}
-            time_stats[datestamp]['total'] += unit.get('requests')
-            time_stats[datestamp]['items'].append(unit.get('requests'))
-    return time_stats
+    return MediaStats.from_stats(stats).per_time()
+
+
+class Member:
+    """A file in the category, reduced to what is needed once it has been enumerated.
+
+    Only these records are kept for the files in flight, or for all files when reading dumps,
+    rather than the full page data of each file.
+    """
+
+    __slots__ = ('pageid', 'title', 'file_path')
+
+    def __init__(self, pageid: int, title: str, file_path: str):
+        self.pageid = pageid
+        self.title = sys.intern(title)
+        self.file_path = sys.intern(file_path)
+
+    @classmethod
+    def from_page(cls, page: dict) -> 'Member':
+        """Return the record of a file from its page data, including its imageinfo url."""
+        return cls(page.get('pageid'), page.get('title'), get_file_path(page))
 
 
 def get_cat_members(
-        cat: pywikibot.Category, recurse: int = 0,
-        limit: int = None) -> Iterator[pywikibot.FilePage]:
-    """Yield category members but ensuring no duplication due to subcategory membership."""
-    files = set()
-    category_members = cat.members(recurse=recurse, member_type='file', total=limit)
-    total = (limit or cat.categoryinfo.get('files') if not recurse else None)
-    for file_page in tqdm(category_members, desc="Processing category members", total=total):
-        if file_page in files:
-            continue  # since same file can occur in recursive categories
-        files.add(file_page)
-        yield file_page
+        s: requests.Session, cat_name: str, recurse: int = 0,
+        limit: int = None, members: dict = None,
+        snapshot: CategorySnapshot = None, workers: int = 1) -> Iterator[Member]:
+    """Yield category members, including their file path, without any duplicates.
+
+    The urls are retrieved together with the category members, up to 500 files per request, or
+    read from the snapshot.
+
+    @param members: populated with the title and file path of the files found in each category.
+    @param workers: number of categories to walk, and retrieve the files of, concurrently.
+    """
+    def on_member(category: str, file: dict) -> None:
+        members[category].append(
+            (sys.intern(file.get('title')), sys.intern(get_file_path(file))))
+
+    params = {'prop': 'imageinfo', 'iiprop': 'url'}
+    on_member = on_member if members is not None else None
+
+    def discount(category: str, file: dict) -> None:
+        # the total counts a file in several of the categories once per category
+        progress.total -= 1
+
+    if snapshot:
+        category_members = snapshot.category_files(
+            s, cat_name, prop_params=params, recurse=recurse, limit=limit, on_member=on_member)
+        total = snapshot.file_count(s, cat_name, recurse)
+    elif limit:
+        # no need to walk the tree up front, the limit is the best guess of the total
+        category_members = action_api.category_files(
+            s, cat_name, prop_params=params, recurse=recurse, limit=limit, on_member=on_member,
+            workers=workers)
+        total = limit
+    else:
+        # the tree is walked up front, giving the number of files in it
+        tree = dict(action_api.category_tree(s, cat_name, depth=recurse, workers=workers))
+        category_members = action_api.category_files(
+            s, cat_name, prop_params=params, recurse=recurse, on_member=on_member,
+            on_duplicate=discount, categories=tree, workers=workers)
+        total = sum(tree.values())
+    total = min(total, limit) if limit else total
+    progress = tqdm(category_members, desc="Processing category members", total=total)
+    for file_page in progress:
+        yield Member.from_page(file_page)
+
+
+def fetch_media_requests(
+        s: requests.Session, files: Iterator[Member], start: str, end: str,
+        frequency: str = 'monthly', workers: int = 1, cache: MediaRequestsCache = None,
+        debug: bool = False) -> Iterator[tuple[Member, Callable[[], dict]]]:
+    """Yield each file together with a callable returning its media requests.
+
+    The callable raises any APIError encountered for that file. Files are yielded in the
+    order they were provided, also when several workers are used, so that the output does not
+    depend on the number of workers.
+
+    @param workers: number of concurrent requests. With a single worker no threads are used.
+    """
+    fetch = partial(
+        get_media_requests, s, start=start, end=end, frequency=frequency, cache=cache,
+        debug=debug)
+    if workers <= 1:
+        for file in files:
+            yield file, partial(fetch, file)
+        return
+
+    # only keep a limited number of files in flight to not read the whole category up front
+    pending = deque()
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        for file in files:
+            pending.append((file, executor.submit(fetch, file)))
+            if len(pending) >= workers * 4:
+                file, future = pending.popleft()
+                yield file, future.result
+        while pending:
+            file, future = pending.popleft()
+            yield file, future.result
+    finally:
+        # don't start on any queued files if the consumer stops early
+        executor.shutdown(cancel_futures=True)
+
+
+def read_media_requests(
+        files: Iterator[Member], start: str, end: str, dump_dir: str, frequency: str = 'monthly',
+        workers: int = 1) -> Iterator[tuple[Member, Callable[[], dict]]]:
+    """Yield each file together with a callable returning its media requests from the dumps.
+
+    The counterpart of fetch_media_requests() for mediacounts dumps. All files are enumerated
+    before the dumps are read, as each dump holds the requests of every file for one day.
+
+    @param workers: number of dumps to read in parallel.
+    """
+    files = list(files)
+    with METRICS.stage('dumps'):
+        media_requests, missing = dump_media_requests(
+            (file.file_path for file in files),
+            buckets_in_range(start, end, frequency), frequency, dump_dir, workers=workers)
+    METRICS.count('dumps', len(missing), result='missing')
+    if missing:
+        pywikibot.output(
+            f'Found no dump for {len(missing)} days, from {missing[0]} to {missing[-1]}. '
+            'The media requests of these days are not included.')
+
+    def get_result(file: Member) -> dict:
+        items = media_requests.get(file.file_path)
+        if not items:
+            raise APIError('999', f'No media requests in the dumps. [{file.title}]')
+        return {'items': items}
+
+    for file in files:
+        yield file, partial(get_result, file)
 
 
 def get_media_requests(
-        s: requests.Session, file: pywikibot.FilePage, start: str, end: str,
-        agent: str = 'user', frequency: str = 'monthly', debug: bool = True):
+        s: requests.Session, file: Member, start: str, end: str,
+        agent: str = 'user', frequency: str = 'monthly', cache: MediaRequestsCache = None,
+        debug: bool = True):
     """Return media requests per month for a single file.
     
+    @param file: the file, as yielded by get_cat_members().
     @param start: start date in the format YYYYMMDD
     @param end: end date in the format YYYYMMDD
     @param agent: user, spider or all-agents.
         See https://wikimedia.org/api/rest_v1/#/Mediarequests%20data/ for documentation.
+    @param cache: cache to use instead of fetching already known media requests.
     """
     if debug:
-        print(f"I'm looking up: {file.title()}")
-    file_path = file.get_file_url().partition('.org')[2]
+        print(f"I'm looking up: {file.title}")
+    file_path = file.file_path
+    fetch = partial(
+        request_media_requests, s, file_path, agent=agent, frequency=frequency, debug=debug)
+    if cache:
+        answered = []
+
+        def fetch_segment(seg_start: str, seg_end: str) -> list:
+            items = fetch(seg_start, seg_end)
+            answered.append(items is not None)
+            return items or []
+
+        data = cache.get_media_requests(
+            fetch_segment, file_path, start, end, agent, frequency)
+        # 404s are not stored, so a file without any cached points is taken to have had one
+        found = bool(data.get('items')) or any(answered)
+    else:
+        items = fetch(start, end)
+        found = items is not None
+        data = {'items': items or []}
+
+    if not found:
+        raise APIError(
+            '999', f'No page views for the provided time period. [{file.title}]')
+    return data
+
+
+def get_file_path(file: dict) -> str:
+    """Return the path of a file on upload.wikimedia.org, from its imageinfo url."""
+    return file.get('imageinfo')[0].get('url').partition('.org')[2]
+
+
+def request_media_requests(
+        s: requests.Session, file_path: str, start: str, end: str, agent: str = 'user',
+        frequency: str = 'monthly', debug: bool = True) -> list | None:
+    """Fetch the media requests for a file path from the REST-API.
+
+    Returns None if the REST-API has no media requests for the file in the time period (a 404).
+    Any backing off is handled by the session, see http_client.
+    """
     url = (
-        f'https://wikimedia.org/api/rest_v1/metrics/mediarequests/per-file/all-referers/'
+        f'{REST_API}/metrics/mediarequests/per-file/all-referers/'
         f'{agent}/{urllib.parse.quote(file_path, safe="")}/{frequency}/{start}/{end}')
+    action_api.count_request('rest')
     res = s.get(url, timeout=30)
 
     if debug:
         print(url)
         print(f"request_result: {res.status_code}")
     if res.status_code == 404:
-        raise APIError('999', f'No page views for the provided time period. [{file.title()}]')
+        return None
     if res.status_code == 400:
         raise APIError('666', f'Bad request: {res.json().get("detail")}')
-    data = res.json()
-    return data
+    if res.status_code in http_client.BACKOFF_STATUSES:
+        raise APIError(str(res.status_code), f'Server kept refusing requests. [{file_path}]')
+    return res.json().get('items', [])
 
 
 def make_meta(args: argparse.Namespace) -> dict:
@@ -145,6 +405,15 @@ def make_meta(args: argparse.Namespace) -> dict:
     meta = {arg: getattr(args, arg) for arg in vars(args)}
     del meta['out_file']
     del meta['user']
+    del meta['cache']
+    del meta['checkpoint']
+    del meta['snapshot']
+    del meta['snapshot_max_age']
+    if not meta['dumps']:
+        del meta['dumps']
+    del meta['resume']
+    del meta['profile']
+    del meta['prometheus']
     meta['today'] = date.today().strftime("%Y%m%d")
     return meta
 
@@ -189,28 +458,65 @@ def handle_args(argv: list = None) -> argparse.Namespace:
     parser.add_argument('-l', '--limit', type=int, action='store', metavar='N',
                         help='limit the number of files to analyse. Defaults to no limit.')
     parser.add_argument('-t', '--output_type', action='store',
-                        choices=['raw', 'file', 'month', 'day'], default='file',
-                        help='collate data per file/month/day, or return raw data. Default "file')
+                        choices=['raw', 'file', 'month', 'day', 'summary'], default='file',
+                        help=('collate data per file/month/day, summarise it, or return raw '
+                              'data. Default "file'))
+    parser.add_argument('--top', type=int, default=10, action='store', metavar='N',
+                        help='number of most viewed files to list in the summary. Defaults to 10')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        action='store', metavar='N',
+                        help=('number of concurrent requests to the REST-API, or of dumps read '
+                              'in parallel, and of categories walked concurrently. Defaults to 1'))
+    parser.add_argument('--rate', type=float, default=DEFAULT_RATE,
+                        action='store', metavar='N',
+                        help=('maximum number of requests per second to each API, across all '
+                              'workers. Lowered automatically on 429/503. '
+                              f'Defaults to {DEFAULT_RATE}'))
+    parser.add_argument('--cache', action='store', metavar='PATH',
+                        help=('sqlite file in which to cache media requests between runs, '
+                              'which can also be queried with query_store.py. '
+                              'Defaults to no caching.'))
+    parser.add_argument('--dumps', action='store', metavar='DIR',
+                        help=('read the media requests, of all agents, from the daily '
+                              'mediacounts dumps in this directory instead of the REST-API'))
     parser.add_argument('-d', '--debug', action='store_true',
                         help='verbose debugging info')
     parser.add_argument('-o', '--output', action='store', metavar='PATH',
                         default=DEFAULT_OUTPUT, dest='out_file',
                         help=f'output json file. Defaults to {{cwd}}/{DEFAULT_OUTPUT}')
+    parser.add_argument('--checkpoint', action='store', metavar='PATH',
+                        help=('ndjson file to which each file is written as soon as it has been '
+                              'processed. Defaults to the output file with a .ndjson suffix'))
+    parser.add_argument('--resume', action='store_true',
+                        help='skip files already in the checkpoint from an interrupted run')
     parser.add_argument('-u', '--user', action='store', required=True,
                         help='username/e-mail to add to User-Agent. See m:User-Agent_policy.')
+    category_snapshot.add_arguments(parser)
+    metrics.add_arguments(parser)
 
-    return parser.parse_args(argv)
+    args = parser.parse_args(argv)
+    if args.dumps and args.cache:
+        parser.error('--cache holds the media requests of human views, not those in --dumps')
+    return args
 
 
 def main() -> None:
     """Command line entrypoint."""
     args = handle_args()
     set_user_agent(args.user)
-    result = get_cat_media_views(
-        args.cat_name, limit=args.limit, recursion=args.recurse, start=args.start,
-        end=args.end, output_type=args.output_type, debug=args.debug)
-    result['_meta'] = make_meta(args)
-    output_result(result, args.out_file)
+    checkpoint_file = args.checkpoint or f'{args.out_file.rpartition(".")[0]}.ndjson'
+    with metrics.profiled(args.profile):
+        result = get_cat_media_views(
+            args.cat_name, limit=args.limit, recursion=args.recurse, start=args.start,
+            end=args.end, output_type=args.output_type, workers=args.workers, rate=args.rate,
+            cache_file=args.cache, top=args.top, checkpoint_file=checkpoint_file,
+            resume=args.resume, dump_dir=args.dumps,
+            snapshot=category_snapshot.open_snapshot(args, workers=args.workers),
+            debug=args.debug)
+        result['_meta'] = make_meta(args)
+        with METRICS.stage('output'):
+            output_result(result, args.out_file)
+    metrics.export(args.out_file, 'get_media_views', prometheus_file=args.prometheus)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,143 @@
+"""Columnar storage and collation of media requests.
+
+The media requests of all files are held in a single files x time bucket integer matrix, together
+with an index of the file titles and bucket timestamps. Cells for which the REST-API returned no
+data point are marked as missing, which keeps them apart from buckets with zero requests.
+
+All of the collated outputs are computed as vectorised reductions over this matrix.
+"""
+from collections.abc import Iterable
+
+import numpy as np
+
+MISSING = -1
+DTYPE = np.int32  # per file and bucket requests stay well below 2**31
+DEFAULT_PERCENTILES = (50, 90, 99)
+
+
+class MediaStats:
+    """Files x time bucket matrix of media requests."""
+
+    def __init__(self, buckets: Iterable[str] = (), capacity: int = 1024):
+        """
+        @param buckets: the expected bucket timestamps. Others are added as they are encountered.
+        @param capacity: the initial number of rows to allocate.
+        """
+        self.titles = []
+        self.buckets = list(buckets)
+        self.bucket_index = {bucket: i for i, bucket in enumerate(self.buckets)}
+        self._matrix = np.full((capacity, len(self.buckets)), MISSING, dtype=DTYPE)
+
+    def __len__(self) -> int:
+        return len(self.titles)
+
+    @classmethod
+    def from_stats(cls, stats: dict) -> 'MediaStats':
+        """Create the matrix from a dict of raw REST-API responses, keyed by file title."""
+        media_stats = cls(capacity=max(len(stats), 1))
+        for title, file_stats in stats.items():
+            media_stats.add(title, file_stats.get('items'))
+        return media_stats
+
+    @property
+    def matrix(self) -> np.ndarray:
+        """The populated part of the matrix."""
+        return self._matrix[:len(self.titles)]
+
+    def add(self, title: str, items: list) -> None:
+        """Add the REST-API items for a single file as a new row."""
+        row = len(self.titles)
+        if row == self._matrix.shape[0]:
+            self._grow(rows=row)
+        self.titles.append(title)
+        cols = []
+        for item in items:
+            col = self.bucket_index.get(item.get('timestamp'))
+            if col is None:
+                col = self._add_bucket(item.get('timestamp'))
+            cols.append(col)
+        self._matrix[row, cols] = [item.get('requests') for item in items]
+
+    def _grow(self, rows: int = 0, cols: int = 0) -> None:
+        """Extend the allocated matrix by the given number of rows and columns."""
+        matrix = np.full(
+            (self._matrix.shape[0] + rows, self._matrix.shape[1] + cols), MISSING, dtype=DTYPE)
+        matrix[:self._matrix.shape[0], :self._matrix.shape[1]] = self._matrix
+        self._matrix = matrix
+
+    def _add_bucket(self, bucket: str) -> int:
+        """Add a column for a previously unseen bucket and return its index."""
+        self._grow(cols=1)
+        self.bucket_index[bucket] = len(self.buckets)
+        self.buckets.append(bucket)
+        return self.bucket_index[bucket]
+
+    def file_totals(self) -> np.ndarray:
+        """Total requests per file, in row order."""
+        # summing the missing cells as is and correcting afterwards avoids copying the matrix
+        missing = (self.matrix == MISSING).sum(axis=1)
+        return self.matrix.sum(axis=1, dtype=np.int64) - MISSING * missing
+
+    def bucket_totals(self) -> np.ndarray:
+        """Total requests per bucket, in column order."""
+        missing = len(self) - self.viewed_files()
+        return self.matrix.sum(axis=0, dtype=np.int64) - MISSING * missing
+
+    def viewed_files(self) -> np.ndarray:
+        """Number of files with a data point per bucket, in column order."""
+        return (self.matrix != MISSING).sum(axis=0)
+
+    def per_file(self) -> dict:
+        """Output the total requests per file, {title: total_media_views}."""
+        return dict(zip(self.titles, self.file_totals().tolist()))
+
+    def per_time(self) -> dict:
+        """Output the requests per bucket, {timestamp: {total: int, items: [per file]}}.
+
+        Only buckets with at least one data point are included. The items are in row order.
+        """
+        time_stats = {}
+        totals = self.bucket_totals()
+        for col in np.flatnonzero(self.viewed_files()):
+            column = self.matrix[:, col]
+            time_stats[self.buckets[col][:-2]] = {
+                'total': int(totals[col]),
+                'items': column[column != MISSING].tolist()
+            }
+        return time_stats
+
+    def top_files(self, n: int = 10) -> list[dict]:
+        """The n files with the most requests in descending order."""
+        totals = self.file_totals()
+        n = min(n, len(totals))
+        top = np.argpartition(-totals, n - 1)[:n] if n else []
+        top = sorted(top, key=lambda row: (-totals[row], row))
+        return [{'file': self.titles[row], 'total': int(totals[row])} for row in top]
+
+    def percentiles(self, q: Iterable[float] = DEFAULT_PERCENTILES) -> dict:
+        """Percentiles of the per file requests for each bucket with any data points."""
+        q = list(q)
+        result = {}
+        for col in np.flatnonzero(self.viewed_files()):
+            column = self.matrix[:, col]
+            values = np.percentile(column[column != MISSING], q)
+            result[self.buckets[col][:-2]] = {
+                str(pct): float(value) for pct, value in zip(q, values)}
+        return result
+
+    def summary(self, top: int = 10) -> dict:
+        """Output overall and per bucket totals, percentiles and the most viewed files."""
+        percentiles = self.percentiles()
+        totals = self.bucket_totals()
+        viewed = self.viewed_files()
+        return {
+            'total': int(totals.sum()),
+            'files': len(self),
+            'top_files': self.top_files(top),
+            'buckets': {
+                self.buckets[col][:-2]: {
+                    'total': int(totals[col]),
+                    'viewed_files': int(viewed[col]),
+                    'percentiles': percentiles[self.buckets[col][:-2]]
+                } for col in np.flatnonzero(viewed)}
+        }
@@ -0,0 +1,140 @@
+"""Media requests from local copies of the daily mediacounts dumps, instead of the REST-API.
+
+The dumps, https://dumps.wikimedia.org/other/mediacounts/daily/, hold one tab separated line per
+file requested during a day, starting with the url-encoded path of the file on
+upload.wikimedia.org, followed by the bytes served and the total number of requests. Each dump is
+streamed, decompressing on the fly, and only the lines of the wanted files are kept. These are
+recognised by looking up the path in a hash set, without decoding or splitting the rest of the
+line. The days are processed in parallel, one process per dump.
+
+Unlike the REST-API the dumps do not tell human and automated requests apart, the counts are
+those of all agents.
+"""
+import bz2
+import gzip
+import os
+from collections import defaultdict
+from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, timedelta
+from urllib.parse import quote, unquote
+
+from request_cache import bucket_last_day, parse_date
+
+DUMP_NAME = 'mediacounts.{day}.v00.tsv'  # day as YYYY-MM-DD
+COMPRESSIONS = ('.bz2', '.gz', '')
+REQUESTS_COLUMN = 2  # total number of requests, the columns are numbered from 0
+AGENT = 'all-agents'
+
+_wanted = frozenset()  # the lookup keys of the wanted files, per worker process
+
+
+def dump_days(buckets: Iterable[str], frequency: str = 'monthly') -> list[date]:
+    """Return each day covered by the buckets."""
+    days = []
+    for bucket in buckets:
+        day = parse_date(bucket)
+        while day <= bucket_last_day(parse_date(bucket), frequency):
+            days.append(day)
+            day += timedelta(days=1)
+    return days
+
+
+def find_dump(dump_dir: str, day: date) -> str:
+    """Return the path of the dump of a day, in any of the supported compressions, if any.
+
+    The dumps may be kept either directly in the directory or in a subdirectory per year, as
+    on dumps.wikimedia.org.
+    """
+    name = DUMP_NAME.format(day=day.isoformat())
+    for directory in (dump_dir, os.path.join(dump_dir, str(day.year))):
+        for compression in COMPRESSIONS:
+            path = os.path.join(directory, name + compression)
+            if os.path.exists(path):
+                return path
+    return None
+
+
+def open_dump(path: str):
+    """Open a dump for reading bytes, decompressing it based on its suffix."""
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rb')
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def lookup_keys(file_path: str) -> set[bytes]:
+    """Return the forms in which the path of a file may appear in the dumps.
+
+    The dumps and the imageinfo urls do not necessarily escape the same characters, so both the
+    path as given, fully decoded and re-encoded are looked for.
+    """
+    decoded = unquote(file_path)
+    return {
+        form.encode('utf8')
+        for form in (file_path, decoded, quote(decoded, safe="/!$&'()*+,;=:@~"), quote(decoded))}
+
+
+def _init_worker(wanted: frozenset) -> None:
+    global _wanted
+    _wanted = wanted
+
+
+def count_day(path: str, column: int = REQUESTS_COLUMN) -> dict[bytes, int]:
+    """Return the number of requests of each wanted file in the dump of a single day."""
+    counts = {}
+    wanted = _wanted
+    with open_dump(path) as fp:
+        for line in fp:
+            key, _, rest = line.partition(b'\t')
+            if key in wanted:
+                counts[key] = counts.get(key, 0) + int(rest.split(b'\t', column)[column - 1])
+    return counts
+
+
+def dump_media_requests(
+        file_paths: Iterable[str], buckets: tuple, frequency: str, dump_dir: str,
+        workers: int = None, column: int = REQUESTS_COLUMN) -> tuple[dict, list]:
+    """Return the media requests of each file, in the REST-API format, and the missing days.
+
+    @param buckets: the timestamps of the (monthly or daily) buckets to count.
+    @param workers: number of dumps to process in parallel. Defaults to one per CPU.
+    @return: the REST-API items of each file path, and the days for which no dump was found.
+    """
+    owners = {}  # lookup key: file path
+    for file_path in file_paths:
+        for key in lookup_keys(file_path):
+            owners[key] = file_path
+
+    dumps = {}
+    missing = []
+    for day in dump_days(buckets, frequency):
+        path = find_dump(dump_dir, day)
+        if path:
+            dumps[day] = path
+        else:
+            missing.append(day)
+
+    totals = defaultdict(lambda: defaultdict(int))  # file path: bucket: requests
+    with ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_worker,
+            initargs=(frozenset(owners),)) as executor:
+        results = executor.map(count_day, dumps.values(), [column] * len(dumps))
+        for day, counts in zip(dumps, results):
+            bucket = (day if frequency == 'daily' else day.replace(day=1)).strftime('%Y%m%d00')
+            for key, requests in counts.items():
+                totals[owners[key]][bucket] += requests
+
+    media_requests = {}
+    for file_path, file_totals in totals.items():
+        media_requests[file_path] = [
+            {
+                'referer': 'all-referers',
+                'file_path': file_path,
+                'granularity': frequency,
+                'timestamp': bucket,
+                'agent': AGENT,
+                'requests': requests
+            } for bucket, requests in sorted(file_totals.items())]
+    return media_requests, missing
@@ -0,0 +1,170 @@
+"""Output media views from the store kept by get_media_views.py --cache.
+
+Gives the same outputs as get_media_views.py, per file, per month/day or as a summary, as well as
+the csv of timeseries_to_csv.py, but for any date range and any of the categories recorded in the
+store, without making any requests.
+
+Limitations:
+* Only media requests fetched by earlier runs are included. Files for which part of the date range
+  was never fetched are reported, rerun get_media_views.py with --cache to fill these in.
+* Daily and monthly media requests are stored separately, a day output needs a run with -t day.
+* The categories are those the files were directly in when last fetched. Files in subcategories
+  of a category fetched with --recurse are recorded under each subcategory, pass these as further
+  --category options to include them.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import date
+from itertools import groupby
+
+from checkpoint import csv_datestamp
+from media_stats import MediaStats
+from request_cache import MediaRequestsCache, buckets_in_range
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common.action_api import category_title  # noqa: E402
+
+DEFAULT_OUTPUT = 'query_output.json'
+OUTPUT_TYPES = ('file', 'month', 'day', 'summary', 'csv')
+
+
+def query_stats(
+        store: MediaRequestsCache, start: str, end: str, output_type: str = 'file',
+        categories: list = None, top: int = 10, daily: bool = False) -> dict | list:
+    """Collate the stored media requests of a date range in the given format.
+
+    @param start: start date in the format YYYYMMDD
+    @param end: end date in the format YYYYMMDD
+    @param categories: only include files in any of these categories. Defaults to all files.
+    @param daily: use the daily rather than monthly media requests for the csv or summary.
+    """
+    frequency = 'daily' if output_type == 'day' or daily else 'monthly'
+    categories = [category_title(category) for category in categories or []]
+    buckets = buckets_in_range(start, end, frequency)
+    if not buckets:
+        return {}
+    uncovered = store.uncovered_files(buckets, frequency=frequency, categories=categories)
+    if uncovered:
+        print(f'{uncovered} files were not fetched for the whole time span.')
+
+    if output_type == 'csv':
+        return [
+            (csv_datestamp(timestamp, daily=frequency == 'daily'), total, viewed)
+            for timestamp, total, viewed
+            in store.bucket_totals(
+                buckets[0], buckets[-1], frequency=frequency, categories=categories)]
+
+    stats = MediaStats(buckets)
+    points = store.iter_points(buckets[0], buckets[-1], frequency=frequency, categories=categories)
+    for title, file_points in groupby(points, key=lambda point: point[0]):
+        stats.add(title, [
+            {'timestamp': timestamp, 'requests': requests}
+            for _, timestamp, requests in file_points])
+    if output_type == 'file':
+        return stats.per_file()
+    elif output_type in ('month', 'day'):
+        return stats.per_time()
+    return stats.summary(top=top)
+
+
+def output_csv(rows: list, out_file: str) -> None:
+    """Output the totals per time unit as a tab separated file, as timeseries_to_csv.py."""
+    with open(out_file, 'w', encoding='utf8') as fp:
+        fp.write('date\tviews\tviewed_files\n')
+        for row in rows:
+            fp.write('{0}\t{1}\t{2}\n'.format(*row))
+    print(f'Data saved to {out_file}')
+
+
+def output_result(result: dict, out_file: str) -> None:
+    """Output result to file."""
+    if os.path.split(out_file)[0]:
+        os.makedirs(os.path.split(out_file)[0], exist_ok=True)
+    with open(out_file, 'w', encoding='utf8') as fp:
+        json.dump(result, fp, sort_keys=True, indent=2, ensure_ascii=False)
+    print(f'Data saved to {out_file}')
+
+
+def make_meta(args: argparse.Namespace) -> dict:
+    """Output metadata about the query."""
+    meta = {arg: getattr(args, arg) for arg in vars(args)}
+    del meta['out_file']
+    del meta['list']
+    meta['today'] = date.today().strftime("%Y%m%d")
+    return meta
+
+
+def handle_args(argv: list = None) -> argparse.Namespace:
+    """
+    Parse and handle command line arguments.
+
+    @param argv: arguments to parse. Defaults to sys.argv[1:].
+    """
+    parser = argparse.ArgumentParser(
+        description=('Output the media views of a time span and set of categories from the '
+                     'store kept by get_media_views.py --cache.'))
+    parser.add_argument('store', metavar='PATH',
+                        help='sqlite file given as --cache to get_media_views.py')
+    parser.add_argument('-c', '--category', action='append', metavar='CAT',
+                        dest='categories',
+                        help=('only include files in this category (with or without '
+                              'Category:-prefix). Can be repeated. Defaults to all files'))
+    parser.add_argument('-s', '--start', action='store', metavar='YYYYMMDD',
+                        help='start date')
+    parser.add_argument('-e', '--end', action='store', metavar='YYYYMMDD',
+                        default=date.today().strftime("%Y%m%d"),
+                        help='end date defaults to today')
+    parser.add_argument('-t', '--output_type', action='store', choices=OUTPUT_TYPES,
+                        default='file',
+                        help=('collate data per file/month/day, summarise it, or output the '
+                              'totals per month as csv. Default "file"'))
+    parser.add_argument('--daily', action='store_true',
+                        help='use the daily media requests for the summary or csv')
+    parser.add_argument('--top', type=int, default=10, action='store', metavar='N',
+                        help='number of most viewed files to list in the summary. Defaults to 10')
+    parser.add_argument('-o', '--output', action='store', metavar='PATH',
+                        default=DEFAULT_OUTPUT, dest='out_file',
+                        help=(f'output file. Defaults to {{cwd}}/{DEFAULT_OUTPUT}, with a .csv '
+                              'suffix for csv output'))
+    parser.add_argument('--list', action='store_true',
+                        help='list the categories in the store and their number of files')
+    args = parser.parse_args(argv)
+    if not args.list and not args.start:
+        parser.error('the following arguments are required: -s/--start')
+    return args
+
+
+def main() -> None:
+    """Command line entrypoint."""
+    args = handle_args()
+    if not os.path.exists(args.store):
+        print(f'No store found at {args.store}')
+        return
+    store = MediaRequestsCache(args.store)
+    if args.list:
+        for category, files in store.categories():
+            print(f'{category}\t{files}')
+        store.close()
+        return
+
+    start_time = time.perf_counter()
+    result = query_stats(
+        store, args.start, args.end, output_type=args.output_type,
+        categories=args.categories, top=args.top, daily=args.daily)
+    store.close()
+    print(f'Queried the store in {(time.perf_counter() - start_time) * 1000:.0f} ms.')
+    if args.output_type == 'csv':
+        out_file = args.out_file
+        if out_file == DEFAULT_OUTPUT:
+            out_file = f'{out_file.rpartition(".")[0]}.csv'
+        output_csv(result, out_file)
+    else:
+        result['_meta'] = make_meta(args)
+        output_result(result, args.out_file)
+
+
+if __name__ == "__main__":
+    main()
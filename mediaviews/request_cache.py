@@ -0,0 +1,277 @@
+"""Persistent cache, and local store, of per-file mediarequests.
+
+Statistics for a closed time bucket (a month or day which has passed) never change, so these are
+stored on disk and reused between runs. On a rerun only the buckets missing from the cache are
+fetched, e.g. the tail months when the end date is moved forward.
+
+Buckets which are still open (or so recent that the statistics may not have settled) are
+stored but marked as open, and are always fetched again.
+
+The cache is keyed by file path, agent and frequency. For each key it keeps the points returned
+by the REST-API as well as the (contiguous) span of closed buckets that has been fetched. The
+latter makes it possible to tell a bucket without any views apart from one never fetched.
+
+The title of each file and the categories it was found in are stored as well. This makes the
+cache a store which can be queried for any date range and subset of categories without any
+further requests, see query_store.py.
+"""
+import sqlite3
+import threading
+from collections import Counter
+from collections.abc import Callable, Iterable, Iterator
+from datetime import date, timedelta
+from functools import lru_cache
+
+SETTLE_DAYS = 7  # days after which the statistics for a bucket are assumed to be final
+
+
+def parse_date(datestamp: str) -> date:
+    """Return the date of a YYYYMMDD(HH) datestamp."""
+    return date(int(datestamp[:4]), int(datestamp[4:6]), int(datestamp[6:8]))
+
+
+def to_timestamp(day: date) -> str:
+    """Return a date in the YYYYMMDDHH format used by the REST-API."""
+    return f'{day.strftime("%Y%m%d")}00'
+
+
+def bucket_last_day(bucket: date, frequency: str) -> date:
+    """Return the last day included in the bucket starting on the given date."""
+    if frequency == 'daily':
+        return bucket
+    next_month = (bucket.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return next_month - timedelta(days=1)
+
+
+@lru_cache(maxsize=16)
+def buckets_in_range(start: str, end: str, frequency: str) -> tuple[str]:
+    """Return the timestamps of all buckets requested by a start and end date.
+
+    Daily buckets are included if they fall within the (inclusive) range. A monthly bucket is
+    included from the month of the start date but only if the full month is within the range.
+    """
+    first = parse_date(start)
+    last = parse_date(end)
+    if frequency != 'daily':
+        first = first.replace(day=1)
+    buckets = []
+    while bucket_last_day(first, frequency) <= last:
+        buckets.append(to_timestamp(first))
+        first = bucket_last_day(first, frequency) + timedelta(days=1)
+    return tuple(buckets)
+
+
+def next_bucket(timestamp: str, frequency: str) -> str:
+    """Return the timestamp of the bucket following the given one."""
+    return to_timestamp(bucket_last_day(parse_date(timestamp), frequency) + timedelta(days=1))
+
+
+class MediaRequestsCache:
+    """Thread safe sqlite backed cache of per-file mediarequests."""
+
+    def __init__(self, path: str, today: date = None):
+        self.today = today or date.today()
+        self.stats = Counter()  # hit, partial, miss, counted under the lock
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS coverage ('
+                'file_path TEXT, agent TEXT, frequency TEXT, first TEXT, last TEXT, '
+                'PRIMARY KEY (file_path, agent, frequency)) WITHOUT ROWID')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS points ('
+                'file_path TEXT, agent TEXT, frequency TEXT, timestamp TEXT, '
+                'requests INTEGER, closed INTEGER, '
+                'PRIMARY KEY (file_path, agent, frequency, timestamp)) WITHOUT ROWID')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS files ('
+                'title TEXT PRIMARY KEY, file_path TEXT) WITHOUT ROWID')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS members ('
+                'category TEXT, title TEXT, PRIMARY KEY (category, title)) WITHOUT ROWID')
+
+    def is_closed(self, timestamp: str, frequency: str) -> bool:
+        """Whether the statistics for the bucket are final."""
+        last_day = bucket_last_day(parse_date(timestamp), frequency)
+        return last_day + timedelta(days=SETTLE_DAYS) < self.today
+
+    def get_media_requests(
+            self, fetch: Callable[[str, str], list], file_path: str, start: str, end: str,
+            agent: str, frequency: str) -> dict:
+        """Return the media requests for a file, only fetching what is not cached.
+
+        @param fetch: callable taking a start and end date and returning the items provided by
+            the REST-API for that span. Should return an empty list if there were no views.
+        """
+        key = (file_path, agent, frequency)
+        wanted = buckets_in_range(start, end, frequency)
+        if not wanted:
+            with self.lock:
+                self.stats['miss'] += 1
+            return {'items': fetch(start, end)}
+
+        with self.lock:
+            coverage = self.conn.execute(
+                'SELECT first, last FROM coverage '
+                'WHERE file_path = ? AND agent = ? AND frequency = ?', key).fetchone()
+        missing = [
+            i for i, bucket in enumerate(wanted)
+            if not coverage or not (coverage[0] <= bucket <= coverage[1])]
+
+        # since the coverage is contiguous the missing buckets form at most a head and a tail
+        segments = []
+        for i in missing:
+            if segments and segments[-1][-1] == i - 1:
+                segments[-1].append(i)
+            else:
+                segments.append([i])
+        for segment in segments:
+            seg_start = start if segment[0] == 0 else wanted[segment[0]][:8]
+            if segment[-1] == len(wanted) - 1:
+                seg_end = end
+            else:
+                seg_end = bucket_last_day(parse_date(wanted[segment[-1]]), frequency)
+                seg_end = seg_end.strftime('%Y%m%d')
+            self._store(key, fetch(seg_start, seg_end))
+
+        if missing:
+            self._extend_coverage(key, coverage, wanted, frequency)
+
+        with self.lock:
+            if not missing:
+                self.stats['hit'] += 1
+            elif len(missing) < len(wanted):
+                self.stats['partial'] += 1
+            else:
+                self.stats['miss'] += 1
+            points = self.conn.execute(
+                'SELECT timestamp, requests FROM points '
+                'WHERE file_path = ? AND agent = ? AND frequency = ? '
+                'AND timestamp BETWEEN ? AND ? ORDER BY timestamp',
+                (*key, wanted[0], wanted[-1])).fetchall()
+        return {'items': [
+            {
+                'referer': 'all-referers',
+                'file_path': file_path,
+                'granularity': frequency,
+                'timestamp': timestamp,
+                'agent': agent,
+                'requests': requests
+            } for timestamp, requests in points]}
+
+    def _store(self, key: tuple, items: list) -> None:
+        """Store the fetched points, marking those in open buckets."""
+        rows = [
+            (*key, item.get('timestamp'), item.get('requests'),
+             self.is_closed(item.get('timestamp'), key[2]))
+            for item in items]
+        with self.lock, self.conn:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO points VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+    def _extend_coverage(
+            self, key: tuple, coverage: tuple, wanted: tuple, frequency: str) -> None:
+        """Record that all closed buckets in the wanted range have now been fetched."""
+        closed = [bucket for bucket in wanted if self.is_closed(bucket, frequency)]
+        if not closed:
+            return
+        first, last = closed[0], closed[-1]
+        if coverage and (
+                coverage[0] <= next_bucket(last, frequency)
+                and first <= next_bucket(coverage[1], frequency)):
+            # overlapping or adjacent spans can be merged, otherwise the old one is dropped
+            first, last = min(first, coverage[0]), max(last, coverage[1])
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO coverage VALUES (?, ?, ?, ?, ?)', (*key, first, last))
+
+    def add_members(
+            self, category: str, files: Iterable[tuple[str, str]], replace: bool = True) -> None:
+        """Record the files found in a category.
+
+        @param files: the title and file path of each file.
+        @param replace: whether these are all of the files in the category, replacing those
+            recorded earlier. Otherwise they are added to them.
+        """
+        files = list(files)
+        with self.lock, self.conn:
+            if replace:
+                self.conn.execute('DELETE FROM members WHERE category = ?', (category,))
+            self.conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?)', files)
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO members VALUES (?, ?)',
+                ((category, title) for title, _ in files))
+
+    def categories(self) -> list[tuple[str, int]]:
+        """Return each recorded category with its number of files."""
+        with self.lock:
+            return self.conn.execute(
+                'SELECT category, COUNT(*) FROM members GROUP BY category').fetchall()
+
+    def _selection(self, categories: Iterable[str] = None) -> tuple[str, list]:
+        """Return the FROM clause, and its arguments, of the files in any of the categories."""
+        categories = list(categories or [])
+        if not categories:
+            return 'files f', []
+        placeholders = ', '.join('?' * len(categories))
+        return (
+            f'(SELECT DISTINCT title FROM members WHERE category IN ({placeholders})) m '
+            'JOIN files f ON f.title = m.title', categories)
+
+    def iter_points(
+            self, first: str, last: str, agent: str = 'user', frequency: str = 'monthly',
+            categories: Iterable[str] = None) -> Iterator[tuple[str, str, int]]:
+        """Yield the title, timestamp and requests of the stored points, ordered by title.
+
+        @param first: timestamp of the first bucket to include.
+        @param last: timestamp of the last bucket to include.
+        @param categories: only include files in any of these categories. Defaults to all files.
+        """
+        selection, args = self._selection(categories)
+        with self.lock:
+            rows = self.conn.execute(
+                f'SELECT f.title, p.timestamp, p.requests FROM {selection} '
+                'JOIN points p ON p.file_path = f.file_path '
+                'AND p.agent = ? AND p.frequency = ? AND p.timestamp BETWEEN ? AND ? '
+                'ORDER BY f.title, p.timestamp',
+                (*args, agent, frequency, first, last)).fetchall()
+        yield from rows
+
+    def bucket_totals(
+            self, first: str, last: str, agent: str = 'user', frequency: str = 'monthly',
+            categories: Iterable[str] = None) -> list[tuple[str, int, int]]:
+        """Return the timestamp, total requests and number of viewed files of each bucket."""
+        selection, args = self._selection(categories)
+        with self.lock:
+            return self.conn.execute(
+                f'SELECT p.timestamp, SUM(p.requests), COUNT(*) FROM {selection} '
+                'JOIN points p ON p.file_path = f.file_path '
+                'AND p.agent = ? AND p.frequency = ? AND p.timestamp BETWEEN ? AND ? '
+                'GROUP BY p.timestamp ORDER BY p.timestamp',
+                (*args, agent, frequency, first, last)).fetchall()
+
+    def uncovered_files(
+            self, buckets: Iterable[str], agent: str = 'user', frequency: str = 'monthly',
+            categories: Iterable[str] = None) -> int:
+        """Return the number of files for which any of the closed buckets were never fetched.
+
+        Open buckets are not considered, since these are always fetched again.
+        """
+        closed = [bucket for bucket in buckets if self.is_closed(bucket, frequency)]
+        if not closed:
+            return 0
+        selection, args = self._selection(categories)
+        with self.lock:
+            return self.conn.execute(
+                f'SELECT COUNT(*) FROM {selection} '
+                'LEFT JOIN coverage c ON c.file_path = f.file_path '
+                'AND c.agent = ? AND c.frequency = ? '
+                'WHERE c.first IS NULL OR c.first > ? OR c.last < ?',
+                (*args, agent, frequency, closed[0], closed[-1])).fetchone()[0]
+
+    def close(self) -> None:
+        """Close the underlying database."""
+        with self.lock:
+            self.conn.close()
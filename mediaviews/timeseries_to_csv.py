@@ -1,17 +1,27 @@
-# take a get_media_views.py output file and output as a csv (totals per time unit)
+# take a get_media_views.py output file, or its .ndjson checkpoint, and output as a csv (totals
+# per time unit)
 import json
+
+from checkpoint import csv_datestamp, per_time_totals
+
 in_file = input('path to output file: ')
 out_file = f'{in_file.rpartition(".")[0]}.csv'
-with open(in_file, 'r', encoding ='utf8') as fp:
-    data = json.load(fp)
 
 new_data = []
 
-for k, v in data.items():
-    if k == '_meta':
-        continue
-    num = len(v.get('items'))
-    new_data.append((k[:-2], v.get('total'), num))
+if in_file.endswith('.ndjson'):
+    # stream over the checkpoint rather than loading the per file items
+    for k, (total, num) in per_time_totals(in_file).items():
+        new_data.append((csv_datestamp(k), total, num))
+else:
+    with open(in_file, 'r', encoding ='utf8') as fp:
+        data = json.load(fp)
+
+    for k, v in data.items():
+        if k == '_meta':
+            continue
+        num = len(v.get('items'))
+        new_data.append((csv_datestamp(k), v.get('total'), num))
 
 with open(out_file, 'w', encoding ='utf8') as fp:
     a= fp.write('date\tviews\tviewed_files\n')
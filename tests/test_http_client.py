@@ -0,0 +1,58 @@
+"""Tests of the throttling and retries of common/http_client.py against a local server."""
+import os
+import sys
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common import http_client  # noqa: E402
+
+
+class TooManyRequestsHandler(BaseHTTPRequestHandler):
+    """Answer every request with a 429 asking the client to retry after a second."""
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.hits += 1
+        self.send_response(429)
+        self.send_header('Retry-After', '1')
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), TooManyRequestsHandler)
+        self.server.hits = 0
+        self.server.lock = threading.Lock()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}/'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_single_request_for_single_429(self):
+        """The adapter returns a 429 as is, leaving the backoff to the session."""
+        s = http_client.make_session()
+        with mock.patch.object(http_client, 'MAX_BACKOFFS', 0):
+            res = s.get(self.url, timeout=10)
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(self.server.hits, 1)
+
+    def test_one_request_per_backoff(self):
+        s = http_client.make_session()
+        with mock.patch.object(http_client, 'MAX_BACKOFFS', 1):
+            res = s.get(self.url, timeout=10)
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(self.server.hits, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
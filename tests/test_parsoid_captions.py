@@ -0,0 +1,35 @@
+"""Tests of the caption extraction of wp_captions/parsoid_captions.py."""
+import os
+import sys
+import unittest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'wp_captions'))
+from parsoid_captions import page_captions  # noqa: E402
+
+FIGURE_WITH_INLINE_FILE = (
+    '<figure typeof="mw:File/Thumb">'
+    '<a href="./File:Main.jpg" class="mw-file-description">'
+    '<img resource="./File:Main.jpg" src="//upload.wikimedia.org/Main.jpg"/></a>'
+    '<figcaption>The '
+    '<span typeof="mw:File"><a href="./File:Flag_of_Sweden.svg" class="mw-file-description">'
+    '<img resource="./File:Flag_of_Sweden.svg" src="//upload.wikimedia.org/Flag.svg"/>'
+    '</a></span> flag caption</figcaption>'
+    '</figure>')
+
+
+class PageCaptionsTest(unittest.TestCase):
+
+    def test_inline_file_in_figcaption(self):
+        """An inline file in the caption does not replace the file of the figure."""
+        media, _ = page_captions(FIGURE_WITH_INLINE_FILE, drop_empty=False)
+        self.assertEqual(
+            media, {'Main.jpg': 'The  flag caption', 'Flag of Sweden.svg': None})
+
+    def test_inline_file_in_figcaption_dropped_when_empty(self):
+        media, _ = page_captions(FIGURE_WITH_INLINE_FILE)
+        self.assertEqual(media, {'Main.jpg': 'The  flag caption'})
+
+
+if __name__ == '__main__':
+    unittest.main()
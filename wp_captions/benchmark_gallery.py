@@ -0,0 +1,100 @@
+"""Benchmark gallery caption extraction against the earlier BeautifulSoup/html5lib implementation.
+
+Takes saved Parsoid HTML pages, e.g. fetched through
+  curl -o page.html "https://sv.wikipedia.org/api/rest_v1/page/html/<title>"
+and times both extractors on each, verifying that they return the same captions. With
+--synthetic N a generated page with N gallery entries (in the Parsoid markup) is used instead.
+
+Requires beautifulsoup4 and html5lib, which are not needed by get_caption.py itself.
+"""
+import argparse
+import time
+
+from bs4 import BeautifulSoup
+
+from parsoid_captions import gallery_captions
+
+PARAGRAPH = (
+    '<section data-mw-section-id="{i}" id="mwA{i}"><h2 id="Avsnitt_{i}">Avsnitt {i}</h2>'
+    '<p id="mwB{i}">Lorem ipsum <a rel="mw:WikiLink" href="./Länk_{i}" title="Länk {i}">dolor'
+    '</a> sit amet, <b>consectetur</b> adipiscing elit.<sup about="#mwt{i}" class="reference" '
+    'typeof="mw:Extension/ref"><a href="./Sida#cite_note-{i}">[{i}]</a></sup></p>'
+    '<figure class="mw-default-size" typeof="mw:File/Thumb"><a href="./Fil:Figur_{i}.jpg" '
+    'class="mw-file-description"><img resource="./Fil:Figur_{i}.jpg" src="//upload.wikimedia.org'
+    '/figur_{i}.jpg" class="mw-file-element" width="220" height="150"/></a>'
+    '<figcaption>Figur {i}</figcaption></figure></section>')
+GALLERYBOX = (
+    '<li class="gallerybox" style="width: 155px;"><div class="thumb" style="width: 150px;">'
+    '<span typeof="mw:File"><a href="./Fil:Galleri_{i}.jpg" class="mw-file-description" '
+    'title="Bildtext &amp; {i}"><img resource="./Fil:Galleri_{i}.jpg" src="//upload.wikimedia.org'
+    '/galleri_{i}.jpg" class="mw-file-element" width="120" height="90"/></a></span></div>'
+    '<div class="gallerytext">Bildtext &amp; {i}</div></li>')
+
+
+def soup_gallery_captions(html: str, gallery_id: str = None) -> dict:
+    """The earlier implementation of get_gallery_content, minus the fetching."""
+    soup = BeautifulSoup(html, features='html5lib')
+    captions = {}
+    for gb in soup.find_all('li', class_='gallerybox'):
+        if gallery_id and gb.parent.id != gallery_id:
+            continue
+        for mfd in gb.find_all('a', class_='mw-file-description'):
+            file = mfd.get('href').partition(':')[2]
+            captions[file.replace('_', ' ')] = mfd.get('title')
+    return captions
+
+
+def synthetic_page(entries: int) -> str:
+    """Generate a Parsoid style page with one section per ten gallery entries."""
+    body = []
+    for i in range(0, entries, 10):
+        body.append(PARAGRAPH.format(i=i))
+        body.append(
+            f'<ul class="gallery mw-gallery-traditional" typeof="mw:Extension/gallery" '
+            f'id="mwG{i}">')
+        body.extend(GALLERYBOX.format(i=j) for j in range(i, min(i + 10, entries)))
+        body.append('</ul>')
+    return f'<!DOCTYPE html><html><head></head><body>{"".join(body)}</body></html>'
+
+
+def time_extractor(extractor, html: str, repeats: int) -> tuple[float, dict]:
+    """Return the mean time of running the extractor on a page, and its output."""
+    start = time.perf_counter()
+    for _ in range(repeats):
+        captions = extractor(html)
+    return (time.perf_counter() - start) / repeats, captions
+
+
+def main() -> None:
+    """Command line entrypoint."""
+    parser = argparse.ArgumentParser(description=__doc__.partition('\n')[0])
+    parser.add_argument('pages', nargs='*', metavar='PATH',
+                        help='saved Parsoid HTML pages')
+    parser.add_argument('--synthetic', type=int, action='store', metavar='N',
+                        help='also benchmark a generated page with N gallery entries')
+    parser.add_argument('-n', '--repeats', type=int, default=5, action='store', metavar='N',
+                        help='number of times to process each page. Defaults to 5')
+    args = parser.parse_args()
+
+    pages = []
+    for path in args.pages:
+        with open(path, encoding='utf8') as fp:
+            pages.append((path, fp.read()))
+    if args.synthetic:
+        pages.append((f'synthetic ({args.synthetic} entries)', synthetic_page(args.synthetic)))
+    if not pages:
+        parser.error('provide saved pages and/or --synthetic N')
+
+    print('page\tsize_kb\tcaptions\tsoup_ms\tstream_ms\tspeedup')
+    for name, html in pages:
+        soup_time, expected = time_extractor(soup_gallery_captions, html, args.repeats)
+        stream_time, captions = time_extractor(gallery_captions, html, args.repeats)
+        if captions != expected:
+            print(f'{name}: outputs differ!')
+        print(f'{name}\t{len(html.encode()) // 1024}\t{len(captions)}\t'
+              f'{soup_time * 1000:.1f}\t{stream_time * 1000:.1f}\t'
+              f'{soup_time / stream_time:.0f}x')
+
+
+if __name__ == "__main__":
+    main()
@@ -3,69 +3,192 @@
 Limitations:
 * Not all Wikimedia wikis support returning captions.
 * Captions in <gallery>-tags are only returned if retrieve_gallery is set to True.
+* With single_fetch the page/html Rest-API is used for all captions, halving the number of calls for
+  pages with galleries. The media-list is then reconstructed from the html, which could differ from
+  that of the page/media-list endpoint in edge cases.
 * It does not filter by Namespace (but namespace is displayed in the results)
 
-This loops over all the images in the category and then over all pages which they appear on,
-so it isn't fast and doesn't make use of e.g. combined Action-API calls.
+The global usage of the images is retrieved in batches, together with the category members, but
+the captions are then retrieved through one Rest-API call per page the images appear on. These
+calls start as soon as a page has been discovered and are made concurrently, with a limit on the
+number of concurrent calls per host. With --cache the responses are kept between runs and only
+revalidated, so that pages which have not changed since the previous run are not fetched again.
+
+The output also holds the usage index, i.e. the files used on each page, of the run. With
+--previous only the pages which are new, use a different set of files or have been touched (e.g.
+edited) since an earlier run are fetched, and the captions of all other pages are carried over from
+the output of that run. The global usage is still retrieved in full, but together with the touched
+timestamps of the pages this takes one Action API request per batch of files or pages.
+
+With --snapshot the files of the category are read from a snapshot shared with the other scripts.
+Their global usage is retrieved by listing the categories of the snapshot again, see
+common/category_snapshot.py.
+
+Timings, request latencies and counts of the run are written next to the output, see
+common/metrics.py.
 """
 import argparse
 import json
 import urllib.parse
 import os
-from collections import defaultdict
-from datetime import date
+import sys
+import threading
+from collections import defaultdict, deque
+from collections.abc import Callable
+from typing import Any
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from datetime import date, datetime, timedelta, timezone
 
 import pywikibot
 import requests
-from requests.adapters import HTTPAdapter, Retry
-from bs4 import BeautifulSoup
 from pywikibot.exceptions import APIError
 from tqdm import tqdm
 
+from parsoid_captions import gallery_captions, page_captions
+from response_cache import DEFAULT_MAX_AGE, DEFAULT_MAX_SIZE, ResponseCache
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+from common import action_api, category_snapshot, http_client, metrics  # noqa: E402
+from common.category_snapshot import CategorySnapshot  # noqa: E402
+from common.metrics import METRICS  # noqa: E402
+
 DEFAULT_OUTPUT = 'caption_output.json'
 HEADERS = {
     'User-Agent': 'get_caption_pywiki.py/1.0 (https://gist.github.com/lokal-profil/ea58e2b8563cdf4ab4ccdbe75a701fa2; {})'
 }
-RETRIES = Retry(total=5, backoff_factor=0.1)
+DEFAULT_WORKERS = 16
+DEFAULT_HOST_LIMIT = 4
+DEFAULT_HOST_RATE = 50  # requests per second, well within the limits of the Rest-API
+TIMESTAMP = '%Y-%m-%dT%H:%M:%SZ'  # as used by the Action API
+TOUCHED_MARGIN = timedelta(minutes=10)  # allowed difference between our clock and the servers'
 
 
 def get_category_captions(
         cat_name: str, limit: int = None, recursion: int = 0,
-        retrieve_gallery: bool = False, debug: bool = False) -> tuple[dict, dict]:
-    """Retrieve captions from the provided category."""
-    commons = pywikibot.Site('commons', 'commons')
-    category = pywikibot.Category(commons, cat_name)
-    file_usages, stats = process_cat_members(category, recurse=recursion, limit=limit)
-    captions = get_multiple_captions(file_usages, retrieve_gallery=retrieve_gallery, debug=debug)
-    return captions, stats
+        retrieve_gallery: bool = False, single_fetch: bool = False,
+        workers: int = DEFAULT_WORKERS, host_limit: int = DEFAULT_HOST_LIMIT,
+        host_rate: float = DEFAULT_HOST_RATE, cache_file: str = None,
+        cache_max_age: float = DEFAULT_MAX_AGE,
+        cache_max_size: float = DEFAULT_MAX_SIZE, previous: dict = None,
+        snapshot: CategorySnapshot = None, debug: bool = False) -> tuple[dict, dict, dict]:
+    """Retrieve captions from the provided category.
+
+    The captions of a page are fetched as soon as the page has been found through the global
+    usage of a file, while the category members are still being processed. Pages in the usage
+    index of a previous run are only fetched once all files of the page are known, and only if
+    they have changed since.
+
+    @param single_fetch: get both kinds of captions from a single page/html call per page.
+    @param workers: maximum number of concurrent Rest-API calls. Also the number of categories
+        walked concurrently when recursing, up to host_limit as these are all on Commons.
+    @param host_limit: maximum number of concurrent Rest-API calls to a single host.
+    @param host_rate: maximum number of requests per second to a single host. Lowered
+        automatically if the host asks us to back off.
+    @param cache_file: path to a cache of previously fetched Rest-API responses.
+    @param cache_max_age: days after which an unused cached response is evicted.
+    @param cache_max_size: size in MiB above which the least recently used cached responses are
+        evicted.
+    @param previous: output of an earlier run to carry the captions of unchanged pages over from.
+    @param snapshot: snapshot to read the category members from instead of the Action API.
+    @return: the captions, the stats and the usage index of the run.
+    """
+    s = make_session(pool_maxsize=host_limit, rate=host_rate)
+    hosts = action_api.site_matrix(s)
+    cache = ResponseCache(cache_file, cache_max_age, cache_max_size) if cache_file else None
+    fetcher = CaptionFetcher(
+        s, {dbname: host for host, dbname in hosts.items()}, retrieve_gallery=retrieve_gallery,
+        single_fetch=single_fetch, workers=workers, host_limit=host_limit, cache=cache,
+        previous=previous, debug=debug)
+    file_usages, stats = process_cat_members(
+        s, cat_name, recurse=recursion, limit=limit, hosts=hosts, on_new_page=fetcher.submit,
+        snapshot=snapshot, workers=min(workers, host_limit))
+    if previous:
+        fetcher.refresh()
+    captions = fetcher.results(file_usages)
+    if cache:
+        close_cache(cache)
+    return captions, stats, fetcher.usage_index
+
+
+def make_session(
+        pool_maxsize: int = DEFAULT_HOST_LIMIT,
+        rate: float = DEFAULT_HOST_RATE) -> requests.Session:
+    """Run connection through a session to limit hammering.
+
+    @param pool_maxsize: number of connections to keep open per host.
+    @param rate: maximum number of requests per second to each host.
+    """
+    return http_client.make_session(HEADERS, pool_maxsize=pool_maxsize, rate=rate)
+
 
+def process_cat_members(
+        s: requests.Session, cat_name: str, recurse: int = 0, limit: int = None,
+        hosts: dict = None,
+        on_new_page: Callable[[str, str, list], None] = None,
+        snapshot: CategorySnapshot = None,
+        workers: int = DEFAULT_HOST_LIMIT) -> tuple[dict, dict]:
+    """Process each member file of a category and its global usage.
 
-def process_cat_members(cat: pywikibot.Category, recurse: int = 0, limit: int = None) -> tuple[dict, dict]:
-    """Process each member file of a category and its global usage."""
+    The global usage is retrieved together with the category members, for many files per
+    request, also for the files of the snapshot.
+
+    @param hosts: database names keyed by host name, as returned by action_api.site_matrix().
+    @param on_new_page: called with the site, page and (growing) list of files of the page
+        whenever a page is encountered for the first time.
+    @param workers: number of categories to walk, and retrieve the files of, concurrently.
+    """
     usage = {}
     used = 0  # differs from len(files) in that it only counts files with captions
-    files = set()
-    category_members = cat.members(recurse=recurse, member_type='file', total=limit)
-    total = (limit or cat.categoryinfo.get('files') if not recurse else None)
-    for file_page in tqdm(category_members, desc="Processing category members", total=total):
-        if file_page in files:
-            continue  # since same file can occur in recursive categories
-        files.add(file_page)
-        counted = False
-        file_usages = file_page.globalusage()  # would be great to discard transcluded pages
+    hosts = hosts or action_api.site_matrix(s)
+    params = {'prop': 'globalusage', 'gulimit': 'max'}
+
+    def discount(category: str, file: dict) -> None:
+        # the total counts a file in several of the categories once per category
+        progress.total -= 1
+
+    if snapshot:
+        category_members = snapshot.category_files(
+            s, cat_name, prop_params=params, recurse=recurse, limit=limit)
+        total = snapshot.file_count(s, cat_name, recurse)
+    elif limit:
+        # no need to walk the tree up front, the limit is the best guess of the total
+        category_members = action_api.category_files(
+            s, cat_name, prop_params=params, recurse=recurse, limit=limit, workers=workers)
+        total = limit
+    else:
+        # the tree is walked up front, giving the number of files in it
+        tree = dict(action_api.category_tree(s, cat_name, depth=recurse, workers=workers))
+        category_members = action_api.category_files(
+            s, cat_name, prop_params=params, recurse=recurse, categories=tree,
+            on_duplicate=discount, workers=workers)
+        total = sum(tree.values())
+    total = min(total, limit) if limit else total
+    progress = tqdm(category_members, desc="Processing category members", total=total)
+    category_members = METRICS.timed(progress, 'enumerate')
+    for file_page in category_members:
+        # would be great to discard transcluded pages
+        file_usages = file_page.get('globalusage', [])
+        if file_usages:
+            used += 1
+        file_title = file_page.get('title').partition(':')[2]
         for file_usage in file_usages:
-            if not counted:
-                used += 1
-                counted = True
-            fu_site = file_usage.site.dbName()
+            fu_site = hosts.get(file_usage.get('wiki'))
+            if not fu_site:
+                pywikibot.warning(f'Unknown site for global usage of {file_title}: {file_usage}')
+                continue
             if fu_site not in usage:
                 usage[fu_site] = defaultdict(list)
-            usage[fu_site][file_usage.title()].append(file_page.title(with_ns=False))
+            page = file_usage.get('title').replace('_', ' ')
+            new_page = page not in usage[fu_site]
+            usage[fu_site][page].append(file_title)
+            if new_page and on_new_page:
+                on_new_page(fu_site, page, usage[fu_site][page])
 
     num_pages = sum([len(us) for us in usage.values()])
     num_usages = sum([sum([len(pages) for pages in us.values()]) for us in usage.values()])
     pywikibot.output(
         f'Found {used} files used {num_usages} times across {num_pages} pages on {len(usage)} sites.')
+    pywikibot.output(f'Made {action_api.REQUEST_COUNTS["action"]} Action API requests.')
     stats = {
         'used files': used,
         'usages': num_usages,
@@ -76,61 +199,337 @@ def process_cat_members(cat: pywikibot.Category, recurse: int = 0, limit: int =
 
 
 def get_multiple_captions(
-        file_usages: dict, retrieve_gallery: bool = False, debug: bool = False) -> dict:
+        file_usages: dict, retrieve_gallery: bool = False, single_fetch: bool = False,
+        workers: int = DEFAULT_WORKERS, host_limit: int = DEFAULT_HOST_LIMIT,
+        host_rate: float = DEFAULT_HOST_RATE, cache_file: str = None,
+        debug: bool = False) -> dict:
     """For a given list of file_usages, retrieve all of the captions.
     
     retrieve_gallery checks for <gallery> contents if a file did not appear in the regular
-    captions. This might be slow.
+    captions. This might be slow, unless single_fetch is used.
     """
+    s = make_session(pool_maxsize=host_limit, rate=host_rate)
+    hosts = action_api.site_matrix(s)
+    cache = ResponseCache(cache_file) if cache_file else None
+    fetcher = CaptionFetcher(
+        s, {dbname: host for host, dbname in hosts.items()}, retrieve_gallery=retrieve_gallery,
+        single_fetch=single_fetch, workers=workers, host_limit=host_limit, cache=cache,
+        debug=debug)
+    for site, pages in file_usages.items():
+        for page, files in pages.items():
+            fetcher.submit(site, page, files)
+    captions = fetcher.results(file_usages)
+    if cache:
+        close_cache(cache)
+    return captions
 
-    # Run connection through a session to limit hammering
-    s = requests.Session()
-    s.mount(
-        'https://',
-        HTTPAdapter(max_retries=RETRIES))
-    s.headers.update(HEADERS)
 
-    captions = defaultdict(list)
-    for site, pages in file_usages.items():
-        site_obj = pywikibot.APISite.fromDBName(site)
-        site_url = site_obj.siteinfo.get('servername')
-        for page, files in tqdm(pages.items(), desc=f"Processing captions on {site}"):
-            missing_captions = False
-            try:
-                media = get_media_list(
-                    s, page, site_url, drop_empty=not(retrieve_gallery), debug=debug)
-            except APIError:
-                pywikibot.log(f"{site} does not support page/media-list endpoint.")
-                break  # also skips gallery retrieval for these
-            for file in files:
-                caption = media.get(file)
-                if caption:
-                    captions[file].append({
-                        'caption': caption,
-                        'site': site,
-                        'page': page})
-                elif caption is None:
-                    missing_captions = True
-
-            if retrieve_gallery and missing_captions:
-                try:
-                    gallery_caps = get_gallery_content(s, page, site_url, debug=debug)
-                except APIError:
-                    pywikibot.log(f"{site} does not support page/html endpoint.")
-                    break
+def load_previous(path: str, retrieve_gallery: bool, single_fetch: bool) -> dict:
+    """Load the output of an earlier run, if captions can be carried over from it.
+
+    Returns None if the output lacks a usage index, or was made with other caption options.
+    """
+    with open(path, encoding='utf8') as fp:
+        previous = json.load(fp)
+    meta = previous.get('meta', {})
+    if 'usage' not in previous or 'started' not in meta:
+        pywikibot.warning(f'{path} has no usage index, fetching all captions.')
+        return None
+    if (bool(meta.get('no_gallery')) != (not retrieve_gallery)
+            or bool(meta.get('single_fetch')) != single_fetch):
+        pywikibot.warning(
+            f'{path} was made with other --no_gallery/--single_fetch options, '
+            'fetching all captions.')
+        return None
+    return previous
+
+
+def untouched_pages(
+        s: requests.Session, site_url: str, pages: list, since: str) -> set:
+    """Return those of the pages on a site which have not been touched since the given time.
+
+    A page is touched whenever it is edited or its rendering may otherwise have changed, e.g.
+    through an edited template.
+    """
+    untouched = set()
+    for page in action_api.titles_pages(
+            s, pages, {'prop': 'info'}, api_url=f'https://{site_url}/w/api.php'):
+        if page.get('touched') and page.get('touched') < since:
+            untouched.add(page.get('title'))
+    return untouched
+
+
+def close_cache(cache: ResponseCache) -> None:
+    """Report on the use of the response cache, then evict stale entries and close it."""
+    pywikibot.output(
+        f'Cache: {cache.stats["hit"]} unchanged, {cache.stats["changed"]} changed '
+        f'and {cache.stats["miss"]} new responses.')
+    for result in ('hit', 'changed', 'miss'):
+        METRICS.count('cache', cache.stats[result], result=result)
+    cache.close()
+
+
+class CaptionFetcher:
+    """Fetch the captions of pages concurrently, starting as soon as each page is submitted.
+
+    The pages are fetched by a single pool of workers, while a semaphore per host limits the
+    concurrency per host. Pages are queued per host until both a worker and a slot on their host
+    are free, so that a busy host does not hold up the workers.
+
+    If a site turns out not to support an endpoint the remaining pages on that site are skipped,
+    exactly as if the pages had been processed one at a time in the order they were submitted.
+
+    Given the output of a previous run, pages in its usage index are held back until refresh() is
+    called, once all of their files are known. Unchanged pages then keep their captions from that
+    output, in place of being fetched.
+    """
+
+    def __init__(
+            self, s: requests.Session, site_urls: dict, retrieve_gallery: bool = False,
+            single_fetch: bool = False, workers: int = DEFAULT_WORKERS,
+            host_limit: int = DEFAULT_HOST_LIMIT, cache: ResponseCache = None,
+            previous: dict = None, debug: bool = False):
+        """
+        @param site_urls: host name keyed by database name.
+        @param single_fetch: get the media-list and gallery captions from a single page/html call.
+        @param cache: cache of Rest-API responses to revalidate instead of refetching.
+        @param previous: output of an earlier run, see load_previous().
+        """
+        self.s = s
+        self.site_urls = site_urls
+        self.retrieve_gallery = retrieve_gallery
+        self.single_fetch = single_fetch
+        self.host_limit = host_limit
+        self.cache = cache
+        self.debug = debug
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.Semaphore(workers)
+        self.host_slots = {}  # per host
+        self.queued = defaultdict(deque)  # per host: (future, site, page, entry) awaiting a slot
+        self.pages = {}  # (site, page): page entry
+        self.submitted = defaultdict(int)  # per site
+        self.unsupported = {}  # site: index of the first page an endpoint failed for
+        self.previous = previous
+        self.held_back = []  # (site, page) in the usage index of the previous run
+        self.usage_index = defaultdict(dict)  # site: page: files, for the completed pages
+        self.progress = tqdm(desc='Processing captions', total=0, unit='page')
+
+    def submit(self, site: str, page: str, files: list) -> None:
+        """Queue a page for caption retrieval.
+
+        @param files: the files used on the page. These may still be added to after submission.
+        """
+        with self.lock:
+            entry = {'index': self.submitted[site], 'files': files, 'media': None, 'gallery': None}
+            self.submitted[site] += 1
+            self.pages[(site, page)] = entry
+            if self.previous and page in self.previous['usage'].get(site, {}):
+                self.held_back.append((site, page))
+                return
+            self.progress.total += 1
+            self.progress.refresh()
+        self._schedule(site, page, entry)
+
+    def refresh(self) -> None:
+        """Carry over the captions of unchanged held back pages and fetch the others.
+
+        A page is unchanged if it uses the same files as in the previous run and has not been
+        touched since that run started.
+        """
+        previous_usage = self.previous['usage']
+        since = (datetime.strptime(self.previous['meta']['started'], TIMESTAMP)
+                 - TOUCHED_MARGIN).strftime(TIMESTAMP)
+        same_files = defaultdict(list)
+        for site, page in self.held_back:
+            if sorted(self.pages[(site, page)]['files']) == sorted(previous_usage[site][page]):
+                same_files[site].append(page)
+        unchanged = set()
+        with METRICS.stage('revalidate'):
+            for site, pages in same_files.items():
+                unchanged.update(
+                    (site, page)
+                    for page in untouched_pages(self.s, self.site_urls.get(site), pages, since))
+
+        rows = defaultdict(lambda: defaultdict(list))  # (site, page): file: rows
+        for file, file_rows in self.previous['results'].items():
+            for row in file_rows:
+                rows[(row.get('site'), row.get('page'))][file].append(row)
+        for site, page in self.held_back:
+            entry = self.pages[(site, page)]
+            if (site, page) in unchanged:
+                entry.update({'media': {}, 'gallery': {}, 'rows': rows.get((site, page), {})})
+                continue
+            self.progress.total += 1
+            self._schedule(site, page, entry)
+        self.progress.refresh()
+        METRICS.count('pages', len(unchanged), result='carried')
+        METRICS.count('pages', len(self.held_back) - len(unchanged), result='refetched')
+        pywikibot.output(
+            f'Carried over the captions of {len(unchanged)} unchanged pages, refetching '
+            f'{len(self.held_back) - len(unchanged)} changed pages.')
+
+    def results(self, file_usages: dict) -> dict:
+        """Wait for all pages to be processed and return the captions per file.
+
+        @param file_usages: the final usage[dbname][page] -> [files], i.e. after discovery.
+        """
+        with METRICS.stage('fetch'):
+            self._wait()
+
+        # a page may have gotten more files, with missing captions, after it was fetched
+        if self.retrieve_gallery:
+            for (site, page), entry in self.pages.items():
+                if (entry['media'] is not None and entry['gallery'] is None
+                        and self._missing_captions(entry)):
+                    self._schedule(site, page, entry)
+            with METRICS.stage('fetch'):
+                self._wait()
+        self.executor.shutdown()
+        self.progress.close()
+
+        captions = defaultdict(list)
+        for site, pages in file_usages.items():
+            for page, files in pages.items():
+                entry = self.pages.get((site, page))
+                if not entry or entry['media'] is None:
+                    break  # endpoint not supported, also skips gallery retrieval for these
+                if 'rows' in entry:
+                    for file in dict.fromkeys(files):
+                        if file in entry['rows']:
+                            captions[file].extend(entry['rows'][file])
+                    self.usage_index[site][page] = list(files)
+                    continue
+                media = entry['media']
+                missing_captions = False
                 for file in files:
-                    caption = gallery_caps.get(file)
+                    caption = media.get(file)
                     if caption:
                         captions[file].append({
                             'caption': caption,
                             'site': site,
                             'page': page})
-    return captions
+                    elif caption is None:
+                        missing_captions = True
+
+                if self.retrieve_gallery and missing_captions:
+                    if entry['gallery'] is None:
+                        break  # endpoint not supported
+                    for file in files:
+                        caption = entry['gallery'].get(file)
+                        if caption:
+                            captions[file].append({
+                                'caption': caption,
+                                'site': site,
+                                'page': page})
+                self.usage_index[site][page] = list(files)
+        return captions
+
+    def _wait(self) -> None:
+        """Wait for all submitted pages, raising any error other than an unsupported endpoint."""
+        futures = [entry.get('future') for entry in self.pages.values() if entry.get('future')]
+        wait(futures)
+        try:
+            for future in futures:
+                future.result()
+        except Exception:
+            with self.lock:
+                self.queued.clear()
+            self.executor.shutdown(cancel_futures=True)
+            self.progress.close()
+            raise
+
+    def _schedule(self, site: str, page: str, entry: dict) -> None:
+        """Queue a page to be fetched once both a worker and a slot on its host are free."""
+        site_url = self.site_urls.get(site)
+        entry['future'] = Future()
+        with self.lock:
+            if site_url not in self.host_slots:
+                self.host_slots[site_url] = threading.Semaphore(self.host_limit)
+            self.queued[site_url].append((entry['future'], site, page, entry))
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        """Start fetching queued pages for as long as there are free workers and host slots.
+
+        Pages are only handed to the pool once they can run, so that a page on a host with a free
+        slot never waits behind pages which could not start anyway.
+        """
+        with self.lock:
+            for site_url in list(self.queued):
+                queued = self.queued[site_url]
+                while queued and self.host_slots[site_url].acquire(blocking=False):
+                    if not self.slots.acquire(blocking=False):
+                        self.host_slots[site_url].release()
+                        return
+                    self.executor.submit(self._run, site_url, *queued.popleft())
+                if not queued:
+                    del self.queued[site_url]  # hosts queued again go last, taking turns
+
+    def _run(self, site_url: str, future: Future, site: str, page: str, entry: dict) -> None:
+        """Fetch a page, then hand its worker and host slot on to the next queued page."""
+        try:
+            if future.set_running_or_notify_cancel():
+                try:
+                    self._fetch(site, page, entry)
+                except BaseException as error:
+                    future.set_exception(error)
+                else:
+                    future.set_result(None)
+        finally:
+            self.host_slots[site_url].release()
+            self.slots.release()
+            self._dispatch()
+
+    def _skip(self, site: str, index: int) -> bool:
+        """Whether an earlier page on the site showed that an endpoint is not supported."""
+        return self.unsupported.get(site, index) < index
+
+    def _mark_unsupported(self, site: str, index: int, endpoint: str) -> None:
+        """Record that an endpoint failed for the page with the given index on the site."""
+        pywikibot.log(f"{site} does not support {endpoint} endpoint.")
+        METRICS.count('skipped', reason='unsupported')
+        with self.lock:
+            self.unsupported[site] = min(self.unsupported.get(site, index), index)
+
+    def _missing_captions(self, entry: dict) -> bool:
+        """Whether any of the files known to be on the page lack a media-list caption."""
+        return any(entry['media'].get(file) is None for file in list(entry['files']))
+
+    def _fetch(self, site: str, page: str, entry: dict) -> None:
+        """Fetch the media-list, and if needed the gallery captions, of a page."""
+        site_url = self.site_urls.get(site)
+        if entry['media'] is None:
+            self.progress.update()
+            if self._skip(site, entry['index']):
+                return
+            try:
+                if self.single_fetch:
+                    entry['media'], entry['gallery'] = get_page_captions(
+                        self.s, page, site_url, drop_empty=not(self.retrieve_gallery),
+                        debug=self.debug, cache=self.cache)
+                else:
+                    entry['media'] = get_media_list(
+                        self.s, page, site_url, drop_empty=not(self.retrieve_gallery),
+                        debug=self.debug, cache=self.cache)
+            except APIError:
+                self._mark_unsupported(
+                    site, entry['index'], 'page/html' if self.single_fetch else 'page/media-list')
+                return
+
+        if self.retrieve_gallery and entry['gallery'] is None and self._missing_captions(entry):
+            if self._skip(site, entry['index']):
+                return
+            try:
+                entry['gallery'] = get_gallery_content(
+                    self.s, page, site_url, debug=self.debug, cache=self.cache)
+            except APIError:
+                self._mark_unsupported(site, entry['index'], 'page/html')
 
 
 def get_media_list(
         s: requests.Session, page: str, site_url: str,
-        drop_empty: bool = True, debug: bool = True) -> dict:
+        drop_empty: bool = True, debug: bool = True, cache: ResponseCache = None) -> dict:
     """Return a simplified list of filenames and captions.
 
     Note that this does not capture captions inside <gallery>, T346352.
@@ -142,12 +541,13 @@ def get_media_list(
     if debug:
         print(f"I'm looking up: {page}")
     url = f'https://{site_url}/api/rest_v1/page/media-list/{urllib.parse.quote(page, safe="")}'
-    res = s.get(url, timeout=30)
-    if debug:
-        print(f"request_result: {res.status_code}")
-    if res.status_code == 404:
-        raise APIError('999', 'Rest-API endpoint not found')
-    data = res.json()
+    outdata = get_parsed(
+        s, url, lambda res: parse_media_list(res.json(), debug=debug), cache=cache, debug=debug)
+    return drop_empty_captions(outdata) if drop_empty else outdata
+
+
+def parse_media_list(data: dict, debug: bool = True) -> dict:
+    """Return the filenames and captions of a page/media-list response, keeping empty ones."""
     outdata = {}
     for image in data.get('items'):
         if not image.get('title'):
@@ -156,8 +556,6 @@ def get_media_list(
         caption = image.get('caption', {}).get('text')
         if caption:
             caption = caption.strip()
-        if not caption and drop_empty:
-            continue
         image = image.get('title').partition(':')[2]
         outdata[image.replace('_', ' ')] = caption
         if debug and caption:
@@ -166,9 +564,31 @@ def get_media_list(
     return outdata
 
 
+def drop_empty_captions(captions: dict) -> dict:
+    """Remove entries with blank or missing captions."""
+    return {file: caption for file, caption in captions.items() if caption}
+
+
+def get_page_captions(
+        s: requests.Session, page: str, site_url: str, drop_empty: bool = True,
+        debug: bool = True, cache: ResponseCache = None) -> tuple[dict, dict]:
+    """Return the media-list and gallery captions of a page from a single page/html call.
+
+    The first dict follows the format of get_media_list() and the second that of
+    get_gallery_content().
+    """
+    if debug:
+        print(f"I'm doing a single look-up of: {page}")
+    url = f'https://{site_url}/api/rest_v1/page/html/{urllib.parse.quote(page, safe="")}'
+    media, gallery = get_parsed(
+        s, url, lambda res: page_captions(res.text, drop_empty=False), cache=cache,
+        variant='captions', debug=debug)
+    return (drop_empty_captions(media) if drop_empty else media), gallery
+
+
 def get_gallery_content(
         s: requests.Session, page: str, site_url: str,
-        gallery_id: str = None, debug: bool = True) -> dict:
+        gallery_id: str = None, debug: bool = True, cache: ResponseCache = None) -> dict:
     """Retrieve all files and captions which appear in galleries on a page.
     
     This can either loop over all galleries or be restricted to only those galleries that match
@@ -181,24 +601,37 @@ def get_gallery_content(
     if debug:
         print(f"I'm doing a gallery look-up of: {page}")
     url = f'https://{site_url}/api/rest_v1/page/html/{urllib.parse.quote(page, safe="")}'
-    res = s.get(url, timeout=30)
+    return get_parsed(
+        s, url, lambda res: gallery_captions(res.text, gallery_id=gallery_id), cache=cache,
+        variant=f'gallery:{gallery_id or ""}', debug=debug)
+
+
+def get_parsed(
+        s: requests.Session, url: str, parse: Callable[[requests.Response], Any],
+        cache: ResponseCache = None, variant: str = '', debug: bool = True) -> Any:
+    """Fetch a Rest-API response and return it as parsed by the provided callable.
+
+    If a cache is provided the request is made conditional on the ETag of any stored response,
+    which is then reused, without parsing, if the response has not changed.
+    """
+    cached = cache.lookup(url, variant) if cache else None
+    headers = {'If-None-Match': cached[0]} if cached else {}
+    res = s.get(url, timeout=30, headers=headers)
     if debug:
         print(f"request_result: {res.status_code}")
     if res.status_code == 404:
         raise APIError('999', 'Rest-API endpoint not found')
-
-    # prepp beautiful soup
-    html = res.text
-    soup = BeautifulSoup(html, features='html5lib')
-    #
-    captions = {}  # assume no image appears more than once
-    for gb in soup.find_all('li', class_='gallerybox'):
-        if gallery_id and gb.parent.id != gallery_id:
-            continue
-        for mfd in gb.find_all('a', class_='mw-file-description'):
-            file = mfd.get('href').partition(':')[2]
-            captions[file.replace('_', ' ')] = mfd.get('title')
-    return captions
+    if res.status_code == 304 and cached:
+        cache.touch(url, variant)
+        return cached[1]
+    res.raise_for_status()
+    if res.status_code != 200:
+        raise requests.HTTPError(f'Unexpected status {res.status_code} for {url}', response=res)
+    with METRICS.stage('parse'):
+        data = parse(res)
+    if cache:
+        cache.store(url, res.headers.get('ETag'), data, variant, replaced=bool(cached))
+    return data
 
 
 def make_meta(args: argparse.Namespace) -> dict:
@@ -206,6 +639,11 @@ def make_meta(args: argparse.Namespace) -> dict:
     meta = {arg: getattr(args, arg) for arg in vars(args)}
     del meta['out_file']
     del meta['user']
+    del meta['cache']
+    del meta['snapshot']
+    del meta['snapshot_max_age']
+    del meta['profile']
+    del meta['prometheus']
     meta['today'] = date.today().strftime("%Y%m%d")
     return meta
 
@@ -240,11 +678,41 @@ def handle_args(argv: list = None) -> argparse.Namespace:
                         help='Commons category to process (with or without Category:-prefix)')
     parser.add_argument('--no_gallery', action='store_true',
                         help='do not retrieve captions from galleries (faster)')
+    parser.add_argument('--single_fetch', action='store_true',
+                        help=('get all captions from the page html, one call per page instead of '
+                              'two for pages with galleries'))
     parser.add_argument('-r', '--recurse', type=int, default=None,
                         action='store', metavar='N',
                         help='sub category depth to include. Defaults to 0')
     parser.add_argument('-l', '--limit', type=int, action='store', metavar='N',
                         help='limit the number of files to analyse. Defaults to no limit.')
+    parser.add_argument('-w', '--workers', type=int, default=DEFAULT_WORKERS,
+                        action='store', metavar='N',
+                        help=('maximum number of concurrent Rest-API calls, and of categories '
+                              'walked concurrently up to --host_limit. '
+                              f'Defaults to {DEFAULT_WORKERS}'))
+    parser.add_argument('--host_limit', type=int, default=DEFAULT_HOST_LIMIT,
+                        action='store', metavar='N',
+                        help=('maximum number of concurrent Rest-API calls to a single host. '
+                              f'Defaults to {DEFAULT_HOST_LIMIT}'))
+    parser.add_argument('--host_rate', type=float, default=DEFAULT_HOST_RATE,
+                        action='store', metavar='N',
+                        help=('maximum number of requests per second to a single host. Lowered '
+                              f'automatically on 429/503. Defaults to {DEFAULT_HOST_RATE}'))
+    parser.add_argument('--cache', action='store', metavar='PATH',
+                        help=('sqlite file in which to cache Rest-API responses between runs. '
+                              'Unchanged pages are then revalidated rather than fetched again'))
+    parser.add_argument('--cache_max_age', type=float, default=DEFAULT_MAX_AGE,
+                        action='store', metavar='DAYS',
+                        help=('evict cached responses not used for this many days. '
+                              f'Defaults to {DEFAULT_MAX_AGE}'))
+    parser.add_argument('--cache_max_size', type=float, default=DEFAULT_MAX_SIZE,
+                        action='store', metavar='MiB',
+                        help=('evict the least recently used responses when the cache exceeds '
+                              f'this size. Defaults to {DEFAULT_MAX_SIZE}'))
+    parser.add_argument('--previous', action='store', metavar='PATH',
+                        help=('output of an earlier run. Only captions of pages which have '
+                              'changed since are fetched, the others are carried over'))
     parser.add_argument('-d', '--debug', action='store_true',
                         help='verbose debugging info')
     parser.add_argument('-o', '--output', action='store', metavar='PATH',
@@ -252,6 +720,8 @@ def handle_args(argv: list = None) -> argparse.Namespace:
                         help=f'output json file. Defaults to {{cwd}}/{DEFAULT_OUTPUT}')
     parser.add_argument('-u', '--user', action='store', required=True,
                         help='username/e-mail to add to User-Agent. See m:User-Agent_policy.')
+    category_snapshot.add_arguments(parser)
+    metrics.add_arguments(parser)
 
     return parser.parse_args(argv)
 
@@ -260,15 +730,31 @@ def handle_args(argv: list = None) -> argparse.Namespace:
 def main() -> None:
     """Command line entrypoint."""
     args = handle_args()
-    results, stats = get_category_captions(
-        args.cat_name, limit=args.limit, recursion=args.recurse,
-        retrieve_gallery=not(args.no_gallery), debug=args.debug)
-    out_data = {
-        'meta': make_meta(args),
-        'stats': stats,
-        'results': results
-        }
-    output_result(out_data, args.out_file)
+    set_user_agent(args.user)
+    started = datetime.now(timezone.utc).strftime(TIMESTAMP)
+    previous = None
+    if args.previous:
+        previous = load_previous(
+            args.previous, retrieve_gallery=not(args.no_gallery), single_fetch=args.single_fetch)
+    with metrics.profiled(args.profile):
+        results, stats, usage = get_category_captions(
+            args.cat_name, limit=args.limit, recursion=args.recurse,
+            retrieve_gallery=not(args.no_gallery), single_fetch=args.single_fetch,
+            workers=args.workers, host_limit=args.host_limit, host_rate=args.host_rate,
+            cache_file=args.cache, cache_max_age=args.cache_max_age,
+            cache_max_size=args.cache_max_size, previous=previous,
+            snapshot=category_snapshot.open_snapshot(
+                args, workers=min(args.workers, args.host_limit)),
+            debug=args.debug)
+        out_data = {
+            'meta': {**make_meta(args), 'started': started},
+            'stats': stats,
+            'results': results,
+            'usage': usage
+            }
+        with METRICS.stage('output'):
+            output_result(out_data, args.out_file)
+    metrics.export(args.out_file, 'get_caption', prometheus_file=args.prometheus)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,139 @@
+"""Extract captions from Parsoid HTML without building a document tree.
+
+The parsers only track the little state needed to recognise the relevant elements, using the
+event API of the standard library html.parser, and keep no other part of the document.
+"""
+from html.parser import HTMLParser
+
+# elements which never have an end tag
+VOID_ELEMENTS = frozenset((
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param',
+    'source', 'track', 'wbr'))
+
+
+class GalleryCaptionParser(HTMLParser):
+    """Collect the files and captions of all <li class="gallerybox"> elements.
+
+    The caption is the title attribute of the a.mw-file-description link of each gallerybox.
+    """
+
+    def __init__(self, gallery_id: str = None):
+        """
+        @param gallery_id: only collect galleryboxes whose parent element has this id.
+        """
+        super().__init__(convert_charrefs=True)
+        self.gallery_id = gallery_id
+        self.captions = {}
+        self.stack = []  # (tag, id) of each open element
+        self.gallerybox_depth = None  # position in the stack of the current gallerybox
+
+    def handle_starttag(self, tag: str, attrs: list) -> None:
+        if tag in VOID_ELEMENTS:
+            return
+        attrs = dict(attrs)
+        classes = (attrs.get('class') or '').split()
+        if self.gallerybox_depth is None:
+            if tag == 'li' and 'gallerybox' in classes:
+                parent_id = self.stack[-1][1] if self.stack else None
+                if not self.gallery_id or parent_id == self.gallery_id:
+                    self.gallerybox_depth = len(self.stack)
+        elif tag == 'a' and 'mw-file-description' in classes:
+            file = (attrs.get('href') or '').partition(':')[2]
+            self.captions[file.replace('_', ' ')] = attrs.get('title')
+        self.stack.append((tag, attrs.get('id')))
+
+    def handle_endtag(self, tag: str) -> None:
+        # tolerate unclosed elements by closing everything up to the matching start tag
+        for depth in range(len(self.stack) - 1, -1, -1):
+            if self.stack[depth][0] == tag:
+                del self.stack[depth:]
+                if self.gallerybox_depth is not None and depth <= self.gallerybox_depth:
+                    self.gallerybox_depth = None
+                return
+
+
+class PageCaptionParser(GalleryCaptionParser):
+    """Collect both the media captions and the gallery captions of a page.
+
+    The media captions mimic the page/media-list REST-API: every media element (typeof="mw:File")
+    is included, with the text of its <figcaption> as caption. Media without a figcaption, e.g.
+    inline images and files in galleries, get a None-value. So do inline files within a
+    figcaption, e.g. a flag icon, which do not replace the file of the figure itself.
+    """
+
+    def __init__(self, gallery_id: str = None):
+        super().__init__(gallery_id=gallery_id)
+        self.media = {}
+        self.media_depth = None  # position in the stack of the current media element
+        self.media_file = None
+        self.nested_files = []  # inline files within the figcaption of the current media element
+        self.caption = None  # text parts of the figcaption of the current media element
+        self.caption_depth = None
+
+    def handle_starttag(self, tag: str, attrs: list) -> None:
+        attrs_dict = dict(attrs)
+        if self.media_depth is None:
+            typeof = (attrs_dict.get('typeof') or '').split()
+            if any(rdfa_type.startswith('mw:File') for rdfa_type in typeof):
+                self.media_depth = len(self.stack)
+                self.media_file = None
+                self.nested_files = []
+                self.caption = None
+        elif tag in ('img', 'video', 'audio') and attrs_dict.get('resource'):
+            if self.caption_depth is not None:
+                self.nested_files.append(attrs_dict.get('resource'))
+            elif self.media_file is None:
+                self.media_file = attrs_dict.get('resource')
+        elif tag == 'figcaption' and self.caption_depth is None:
+            self.caption_depth = len(self.stack)
+            self.caption = []
+        super().handle_starttag(tag, attrs)
+
+    def handle_data(self, data: str) -> None:
+        if self.caption_depth is not None:
+            self.caption.append(data)
+
+    def handle_endtag(self, tag: str) -> None:
+        super().handle_endtag(tag)
+        if self.caption_depth is not None and len(self.stack) <= self.caption_depth:
+            self.caption_depth = None
+        if self.media_depth is not None and len(self.stack) <= self.media_depth:
+            if self.media_file:
+                file = self.media_file.partition(':')[2].replace('_', ' ')
+                self.media[file] = ''.join(self.caption) if self.caption is not None else None
+            for resource in self.nested_files:
+                self.media.setdefault(resource.partition(':')[2].replace('_', ' '), None)
+            self.media_depth = None
+
+
+def page_captions(
+        html: str, drop_empty: bool = True, gallery_id: str = None) -> tuple[dict, dict]:
+    """Return both the media captions and the gallery captions of a Parsoid HTML page.
+
+    The media captions follow the format of get_media_list(), including the drop_empty handling,
+    while the gallery captions follow that of gallery_captions().
+    """
+    parser = PageCaptionParser(gallery_id=gallery_id)
+    parser.feed(html)
+    parser.close()
+    media = {}
+    for file, caption in parser.media.items():
+        if caption:
+            caption = caption.strip()
+        if not caption and drop_empty:
+            continue
+        media[file] = caption
+    return media, parser.captions
+
+
+def gallery_captions(html: str, gallery_id: str = None) -> dict:
+    """Return the files and captions of all galleries in a Parsoid HTML page.
+
+    Files without a caption get a None-value.
+    """
+    if 'gallerybox' not in html:
+        return {}  # most pages have no galleries, no need to parse these
+    parser = GalleryCaptionParser(gallery_id=gallery_id)
+    parser.feed(html)
+    parser.close()
+    return parser.captions
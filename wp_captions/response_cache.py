@@ -0,0 +1,106 @@
+"""Persistent cache of parsed Rest-API responses, revalidated through ETags.
+
+The page/media-list and page/html responses of a page only change when the page (or something
+transcluded on it) is edited. Each response is stored together with its ETag, which includes
+the revision of the page, and on later runs the request is made conditional through
+If-None-Match. An unchanged page then costs a 304 without any body, and since the parsed
+caption maps are stored rather than the raw responses it also does not need to be parsed again.
+
+Entries are keyed by the url and a variant, since the same response may be parsed in different
+ways, e.g. page/html for only the gallery captions or for all captions. Entries which have not
+been used for a given number of days are evicted, as are the least recently used ones once the
+cache grows beyond a given size.
+"""
+import json
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+DEFAULT_MAX_AGE = 180  # days
+DEFAULT_MAX_SIZE = 1024  # MiB
+
+
+class ResponseCache:
+    """Thread safe sqlite backed cache of parsed Rest-API responses."""
+
+    def __init__(
+            self, path: str, max_age: float = DEFAULT_MAX_AGE,
+            max_size: float = DEFAULT_MAX_SIZE):
+        """
+        @param max_age: number of days after which an unused entry is evicted.
+        @param max_size: size in MiB above which the least recently used entries are evicted.
+        """
+        self.max_age = max_age
+        self.max_size = max_size
+        self.stats = Counter()  # hit, changed, miss, counted under the lock
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute(
+                'CREATE TABLE IF NOT EXISTS responses ('
+                'url TEXT, variant TEXT, etag TEXT, data TEXT, size INTEGER, used REAL, '
+                'PRIMARY KEY (url, variant))')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS responses_used ON responses (used)')
+
+    def lookup(self, url: str, variant: str = '') -> tuple:
+        """Return the ETag and parsed data stored for a response, or None."""
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT etag, data FROM responses WHERE url = ? AND variant = ?',
+                (url, variant)).fetchone()
+        if not row:
+            return None
+        return row[0], json.loads(row[1])
+
+    def touch(self, url: str, variant: str = '') -> None:
+        """Record that a stored response was revalidated and used."""
+        with self.lock, self.conn:
+            self.stats['hit'] += 1
+            self.conn.execute(
+                'UPDATE responses SET used = ? WHERE url = ? AND variant = ?',
+                (time.time(), url, variant))
+
+    def store(self, url: str, etag: str, data, variant: str = '', replaced: bool = False) -> None:
+        """Store the parsed data of a response.
+
+        Responses without an ETag cannot be revalidated and are not stored.
+
+        @param replaced: whether this replaces a stored response which had changed.
+        """
+        with self.lock:
+            self.stats['changed' if replaced else 'miss'] += 1
+        if not etag:
+            return
+        data = json.dumps(data, ensure_ascii=False)
+        with self.lock, self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                (url, variant, etag, data, len(data) + len(url), time.time()))
+
+    def evict(self) -> int:
+        """Drop entries which are too old or exceed the size limit and return their number."""
+        with self.lock, self.conn:
+            evicted = self.conn.execute(
+                'DELETE FROM responses WHERE used < ?',
+                (time.time() - self.max_age * 86400, )).rowcount
+            size = 0
+            max_size = self.max_size * 1024 * 1024
+            cutoff = None
+            for used, row_size in self.conn.execute(
+                    'SELECT used, size FROM responses ORDER BY used DESC'):
+                size += row_size
+                if size > max_size:
+                    cutoff = used
+                    break
+            if cutoff is not None:
+                evicted += self.conn.execute(
+                    'DELETE FROM responses WHERE used <= ?', (cutoff, )).rowcount
+        return evicted
+
+    def close(self) -> None:
+        """Evict stale entries and close the underlying database."""
+        self.evict()
+        with self.lock:
+            self.conn.close()